@@ -12,12 +12,28 @@ import pickle
 import time
 import threading
 import queue
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
 
 LOGGER = logging.getLogger(os.path.basename(__file__).replace(".py", ""))
 
 LOOP_SLEEP = 0.1
 
+# consumed chunks released at most by batch of this size (see CommunicationSession.reclaim)
+RECLAIM_BATCH = 64
+# time a closing session waits for its consumed chunks to be released, before closing its connections
+RECLAIM_CLOSE_TIMEOUT = 5 # seconds
+# full messages a forwarding loop keeps to send them at once (see CommunicationSession.sendMany)
+SEND_BATCH = 8
+# limits of the chunks fetched in advance (see CommunicationSession.startPrefetch)
+PREFETCH_CHUNKS = 16
+PREFETCH_BYTES = 8 * 1024 * 1024
+# chunks of one send staged at the same time, new tries of a send that fails, and the wait before
+# the first one, doubled each time (see CommunicationSession.sendUnitsStaged)
+SEND_WORKERS = 4
+SEND_RETRIES = 2
+SEND_BACKOFF = 0.5 # seconds
+
 '''
 What is a communication layer?
 A way to transfer some data from one endpoint to another
@@ -51,6 +67,7 @@ class CommunicationClient:
 
     def __init__(self, cid):
         self.cid = cid
+        self.openedsessions = set()
 
     def createSession(self, cid, rid, sid):
         raise NotImplementedError
@@ -74,8 +91,16 @@ class CommunicationClient:
         chunk = nosession.receiveChunk()
         sid = int(chunk)
         session = self.createSession(self.cid, rid, sid)
+        # the closed ones released their consumed chunks (see CommunicationSession.close)
+        self.openedsessions = {opened for opened in self.openedsessions if not opened.closed}
+        self.openedsessions.add(session)
         return session
 
+    def flushReclaims(self, timeout=RECLAIM_CLOSE_TIMEOUT):
+        '''Waits for the consumed chunks of the opened sessions to be released, to call before closing
+        the connections they share'''
+        flushSessions(self.openedsessions, timeout)
+
 
 
 class CommunicationServer:
@@ -124,6 +149,12 @@ class CommunicationServer:
             for session in list(self.openedsessions):
                 session.close()
         self.stopped = True
+        # before the connections shared by the sessions are closed
+        self.flushReclaims()
+
+    def flushReclaims(self, timeout=RECLAIM_CLOSE_TIMEOUT):
+        '''Waits for the consumed chunks of the opened sessions to be released'''
+        flushSessions(self.openedsessions, timeout)
 
     def handleNoSessionMessage(self, cid, data):
         '''Processes one session message'''
@@ -138,6 +169,8 @@ class CommunicationServer:
             nosession.send(messagetosend)
             if not error:
                 newsession = self.createSession(cid, self.rid, self.nextsessionid)
+                if self.capabilities[service].prefetch:
+                    newsession.startPrefetch(*self.capabilities[service].prefetch)
                 self.openedsessions.add(newsession)
                 self.capabilities[service].start(newsession)
             self.nextsessionid += 1
@@ -169,12 +202,171 @@ class CommunicationServer:
         self.showCapabilities()
         self.loopForNoSessionMessages()
 
+def flushSessions(sessions, timeout):
+    '''Waits for the consumed chunks of the sessions to be released (see CommunicationSession.flushReclaims)
+    @param timeout: for all the sessions
+    @return: True if they are, False if timeout passed'''
+    deadline = time.time() + timeout
+    return all([session.flushReclaims(max(0, deadline - time.time())) for session in list(sessions)])
+
+class ReclaimJournal:
+    '''Record of the consumed chunks not released yet (see CommunicationSession.reclaim), to share between
+    the sessions of a server or a client. The ones not released before a crash are released when the next
+    run creates its first session (see CommunicationSession.recoverReclaims): a new session with the same id
+    does not receive them again.
+    One line per change, +identifier when consumed, -identifier when released. It is written without buffer,
+    so it survives a crash of the process, not of the system.'''
+    
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending = set()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as fin:
+                for line in fin:
+                    sign, identifier = line[:1], line[1:].rstrip('\n')
+                    if sign == '+':
+                        self.pending.add(identifier)
+                    elif sign == '-':
+                        self.pending.discard(identifier)
+        self.orphans = sorted(self.pending)
+        # compacted: only the ones still pending
+        temporary = path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as fout:
+            fout.writelines('+%s\n' % identifier for identifier in self.orphans)
+        os.replace(temporary, path)
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    
+    def write(self, sign, identifiers):
+        with self.lock:
+            if self.fd is None:
+                LOGGER.debug("Journal %s closed, %s%s not recorded", self.path, sign, identifiers)
+                return
+            os.write(self.fd, ''.join('%s%s\n' % (sign, identifier) for identifier in identifiers).encode('utf-8'))
+            if sign == '+':
+                self.pending.update(identifiers)
+            else:
+                self.pending.difference_update(identifiers)
+    
+    def consumed(self, identifiers):
+        self.write('+', identifiers)
+    
+    def released(self, identifiers):
+        self.write('-', identifiers)
+    
+    def takeOrphans(self):
+        '''@return: the identifiers not released by the previous run, only once'''
+        with self.lock:
+            orphans, self.orphans = self.orphans, []
+        return orphans
+    
+    def __contains__(self, identifier):
+        return identifier in self.pending
+    
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+
+class Prefetcher:
+    '''Fetches the chunks of a session in a thread (see CommunicationSession.receiveRawChunks), so that the transport
+    works while the application processes the previous chunks. At most maxChunks chunks, or maxBytes bytes
+    (and one chunk more), are kept in memory: the fetching waits for the application to take them.'''
+    
+    def __init__(self, session, maxChunks=PREFETCH_CHUNKS, maxBytes=PREFETCH_BYTES):
+        self.session = session
+        self.maxChunks = maxChunks
+        self.maxBytes = maxBytes
+        self.chunks = deque()
+        self.size = 0 # bytes in chunks
+        self.condition = threading.Condition()
+        self.finished = False # close message queued, session closed, or error
+        self.error = None # error of the transport, raised once the queued chunks are taken
+        self.thread = threading.Thread(target=self.loop, name="prefetch-%s-%s" % (session.me, session.sid), daemon=True)
+        self.thread.start()
+    
+    def room(self):
+        '''@return: the number of chunks that can be fetched now, 0 if the queue is full'''
+        if len(self.chunks) >= self.maxChunks or self.size >= self.maxBytes:
+            return 0
+        # a chunk may be maxdatalength bytes
+        return max(1, min(self.maxChunks - len(self.chunks), (self.maxBytes - self.size) // self.session.maxdatalength))
+    
+    def loop(self):
+        session = self.session
+        while not session.closed:
+            with self.condition:
+                room = self.room()
+                if not room:
+                    # until the application takes some
+                    self.condition.wait(session.cacheUpdateTime)
+                    continue
+            try:
+                chunks = session.receiveRawChunks(room)
+            except Exception as e:
+                if not session.closed:
+                    # as without prefetching, for the application
+                    LOGGER.warning("Unable to prefetch chunks of session %s: %s", session.sid, e)
+                    self.error = e
+                break
+            with self.condition:
+                for chunk in chunks:
+                    self.chunks.append(chunk)
+                    self.size += len(chunk)
+                if chunks:
+                    self.condition.notify_all()
+                    if chunks[-1] == session.data_to_close_session:
+                        # nothing will come after
+                        break
+                else:
+                    self.condition.wait(session.cacheUpdateTime)
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+    
+    def raiseError(self):
+        '''Raises the error of the transport once all the chunks fetched before it are taken'''
+        if not self.chunks and self.error is not None:
+            raise self.error
+    
+    def available(self):
+        self.raiseError()
+        return bool(self.chunks)
+    
+    def wait(self, timeout=None):
+        '''Waits for a chunk to be queued, or the end of the fetching
+        @return: True if there is a chunk'''
+        with self.condition:
+            self.condition.wait_for(lambda: self.chunks or self.finished, timeout)
+            self.raiseError()
+            return bool(self.chunks)
+    
+    def take(self, maximum=None):
+        '''@return: the queued chunks (maximum at most), without waiting'''
+        with self.condition:
+            self.raiseError()
+            toreturn = []
+            while self.chunks and (maximum is None or len(toreturn) < maximum):
+                chunk = self.chunks.popleft()
+                self.size -= len(chunk)
+                toreturn.append(chunk)
+            if toreturn:
+                # room for the fetching
+                self.condition.notify_all()
+        return toreturn
+
+
 class CommunicationSession:
     '''A CommunicationSession is something that can send/received data'''
 
     TOFROMANY = 'ANY'
+    # True if the transport can stage several chunks at the same time (see sendUnitsStaged)
+    CONCURRENT_SEND = False
 
-    def __init__(self, me, other, sid):
+    def __init__(self, me, other, sid, reclaimJournal=None):
+        '''@param reclaimJournal: the ReclaimJournal recording the consumed chunks not released yet, if any'''
         self.me = me
         self.other = other
         self.sid = sid
@@ -190,6 +382,21 @@ class CommunicationSession:
         self.sendingLock = threading.RLock() # multiple threads can send()
         # self.receivingLock = threading.RLock() not used for the moment, only one thread must read
         self.startingTime = time.time() # if you want to know some timeout
+        # consumed chunks released in the background (see reclaim)
+        self.reclaimJournal = reclaimJournal
+        self.reclaimQueue = queue.Queue()
+        self.reclaimLock = threading.Lock()
+        self.reclaimThread = None
+        self.reclaimBatch = RECLAIM_BATCH
+        self.reclaimedCount = 0
+        # chunks fetched in the background (see startPrefetch)
+        self.prefetcher = None
+        # chunks staged in parallel (see sendUnitsStaged)
+        self.sendWorkers = SEND_WORKERS
+        self.sendRetries = SEND_RETRIES
+        self.sendBackoff = SEND_BACKOFF
+        self.sendExecutor = None
+        self.stagedUnits = set() # numbers of the chunks of the current send staged, not published yet
 
     @property
     def elapsedTime(self):
@@ -202,21 +409,29 @@ class CommunicationSession:
 
     def send(self, data):
         '''Send data, that can be split if too big'''
+        self.sendMany([data])
+
+    def sendMany(self, datas):
+        '''Send several data, each split if too big, all their chunks at once (see sendUnits)
+        @param datas: list of bytes'''
         with self.sendingLock:
-            n = len(data)
-            LOGGER.debug('Sending %s bytes from %s to %s (session %s msg %s)%s', n, self.me, self.other, self.sid, self.sent, ': %s' % data if n < 60 else '')
-            if n > self.maxdatalength:
-                m, k = divmod(n, self.maxdatalength)
-                for i in range(m):
-                    self.sendUnit(data[i*self.maxdatalength:(i+1)*self.maxdatalength])
-                if k:
-                    self.sendUnit(data[m*self.maxdatalength:])
-            else:
-                self.sendUnit(data)
-            self.dataSent += n
-            if data == self.data_to_close_session:
+            units = []
+            for data in datas:
+                n = len(data)
+                LOGGER.debug('Sending %s bytes from %s to %s (session %s msg %s)%s', n, self.me, self.other, self.sid, self.sent + len(units), ': %s' % data if n < 60 else '')
+                units.extend(self.splitUnits(data))
+            if units:
+                self.sendUnits(units)
+            self.dataSent += sum(len(data) for data in datas)
+            if any(data == self.data_to_close_session for data in datas):
                 self.closed = True
 
+    def splitUnits(self, data):
+        '''@return: the chunks of data, of maxdatalength bytes at most'''
+        if len(data) <= self.maxdatalength:
+            return [data]
+        return [data[i:i+self.maxdatalength] for i in range(0, len(data), self.maxdatalength)]
+
     def close(self, silently=False):
         '''Close the session'''
         LOGGER.info("Connection %s between %s and %s closing %s", self.sid, self.me, self.other, "silently" if silently else "")
@@ -227,6 +442,11 @@ class CommunicationSession:
             else:
                 if not silently:
                     self.send(self.data_to_close_session)
+        # before the transport closes its connections
+        self.flushReclaims(RECLAIM_CLOSE_TIMEOUT)
+        if self.sendExecutor is not None:
+            self.sendExecutor.shutdown(wait=False)
+            self.sendExecutor = None
 
     # Context manager
     def __enter__(self):
@@ -244,8 +464,99 @@ class CommunicationSession:
         # implement me!
         # remember to increase sent
 
+    def sendUnits(self, units):
+        '''Send several chunks in order, one sendUnit each, or staged in parallel if the transport is
+        CONCURRENT_SEND: override it if the transport can send them with fewer operations
+        @param units: list of bytes, of maxdatalength bytes at most'''
+        if self.CONCURRENT_SEND:
+            return self.sendUnitsStaged(units)
+        for data in units:
+            self.sendUnit(data)
+
+    def sendUnitsStaged(self, units):
+        '''Send several chunks in two steps: each one is staged (see stageUnit), sendWorkers at the same time,
+        then they are published in order (see publishUnit), as the other side reads them in order.
+        When a chunk cannot be staged or published, the chunks not published yet are tried again, sendRetries
+        times after a wait (sendBackoff, doubled each time), without staging again the ones that were.
+        When it still fails, they are dropped (see discardUnit) before raising: no chunk of a failed send is
+        sent later, the next send starts at the first one not published.
+        @param units: list of bytes, of maxdatalength bytes at most'''
+        units = list(units)
+        first = self.sent
+        try:
+            for attempt in range(self.sendRetries + 1):
+                try:
+                    self.stageAndPublish(units[self.sent - first:])
+                    return
+                except Exception as e:
+                    if attempt == self.sendRetries or self.closed:
+                        raise
+                    LOGGER.warning("Chunks %s to %s of session %s not sent, trying again: %s", self.sent, first + len(units) - 1, self.sid, e)
+                    time.sleep(self.sendBackoff * 2 ** attempt)
+        except BaseException:
+            self.discardStaged()
+            raise
+
+    def stageAndPublish(self, units):
+        '''Stages the chunks, numbered from sent, in parallel if sendWorkers, and publishes them in order'''
+        first = self.sent
+        futures = None
+        if self.sendWorkers > 1 and len(units) > 1:
+            LOGGER.debug('Sending %s chunks from %s to %s (session %s msg %s) in parallel', len(units), self.me, self.other, self.sid, first)
+            if self.sendExecutor is None:
+                self.sendExecutor = ThreadPoolExecutor(self.sendWorkers, "send-%s-%s" % (self.me, self.sid))
+            futures = [self.sendExecutor.submit(self.stageUnitOnce, first + index, data) for index, data in enumerate(units)]
+        try:
+            for index, data in enumerate(units):
+                if futures is None:
+                    self.stageUnitOnce(first + index, data)
+                else:
+                    futures[index].result()
+                self.publishUnit(first + index)
+                self.stagedUnits.discard(first + index)
+                self.sent += 1
+        finally:
+            if futures is not None:
+                # no chunk is still written when the others are staged again or dropped
+                wait(futures)
+
+    def stageUnitOnce(self, number, data):
+        '''stageUnit if not done by a previous try of the send'''
+        if number not in self.stagedUnits:
+            self.stageUnit(number, data)
+            self.stagedUnits.add(number)
+
+    def discardStaged(self):
+        '''Drops the chunks staged by a failed send, their numbers are used again by the next send'''
+        for number in sorted(self.stagedUnits):
+            try:
+                self.discardUnit(number)
+            except Exception as e:
+                LOGGER.warning("Staged chunk %s of session %s not removed: %s", number, self.sid, e)
+        self.stagedUnits.clear()
+
+    def stageUnit(self, number, data):
+        '''CONCURRENT_SEND: stores the chunk, not readable by the other side yet, called from several
+        threads at the same time
+        @param number: the number of the chunk (value of sent when it is published)'''
+        raise NotImplementedError()
+
+    def publishUnit(self, number):
+        '''CONCURRENT_SEND: makes the staged chunk readable by the other side, called in order'''
+        pass
+
+    def discardUnit(self, number):
+        '''CONCURRENT_SEND: removes a staged chunk never published, when the send fails'''
+        pass
+
     def checkIfDataAvailable(self):
         '''Returns True if a new chunk is available, False otherwise'''
+        if self.prefetcher is not None:
+            return self.prefetcher.available()
+        return self.checkIfRawDataAvailable()
+
+    def checkIfRawDataAvailable(self):
+        '''Returns True if the transport has a new chunk, False otherwise'''
         return False
 
     def discover(self, onlyOne=False):
@@ -261,13 +572,111 @@ class CommunicationSession:
         # remember to increase received!
         return b''
 
+    def receiveRawChunks(self, maximum=None):
+        '''Receives the chunks available, one receiveRawChunk each: override it if the transport can
+        receive them with fewer operations
+        @param maximum: number of chunks at most, None for all
+        @return: a list of bytes, the close message being the last one'''
+        toreturn = []
+        while maximum is None or len(toreturn) < maximum:
+            try:
+                chunk = self.receiveRawChunk()
+            except Exception as e:
+                if not toreturn:
+                    raise
+                # already counted as received: returned, the next call meets the error again
+                LOGGER.warning("Error after %s chunks of session %s, returning them: %s", len(toreturn), self.sid, e)
+                break
+            if not chunk:
+                break
+            toreturn.append(chunk)
+            if chunk == self.data_to_close_session:
+                break
+        return toreturn
+
+    ################################################################# Reclamation of consumed chunks
+    def releaseConsumed(self, identifiers):
+        '''Releases consumed chunks: deletes their files, their e-mails... (see reclaim)
+        @param identifiers: list of what reclaim was given'''
+        # implement me!
+
+    def reclaim(self, identifier):
+        '''Releases a consumed chunk, in the background and by batch (see releaseConsumed), so that
+        the reader does not wait for it. Discovery sessions release it at once: the next one reads the same identifiers.
+        @param identifier: a str identifying the chunk for the transport (file name, uid...)'''
+        if self.sid == 0 or self.sid == '0':
+            self.releaseConsumed([identifier])
+            self.reclaimedCount += 1
+            return
+        if self.reclaimJournal is not None:
+            self.reclaimJournal.consumed([identifier])
+        with self.reclaimLock:
+            self.reclaimQueue.put(identifier)
+            if self.reclaimThread is None:
+                self.reclaimThread = threading.Thread(target=self.reclaimLoop, name="reclaimer-%s-%s" % (self.me, self.sid), daemon=True)
+                self.reclaimThread.start()
+
+    def reclaimLoop(self):
+        try:
+            while True:
+                try:
+                    batch = [self.reclaimQueue.get(timeout=1)]
+                except queue.Empty:
+                    with self.reclaimLock:
+                        if self.closed and self.reclaimQueue.empty():
+                            self.reclaimThread = None
+                            return
+                    continue
+                while len(batch) < self.reclaimBatch:
+                    try:
+                        batch.append(self.reclaimQueue.get_nowait())
+                    except queue.Empty:
+                        break
+                try:
+                    self.releaseConsumed(batch)
+                    if self.reclaimJournal is not None:
+                        self.reclaimJournal.released(batch)
+                    self.reclaimedCount += len(batch)
+                except Exception as e:
+                    # still in the journal, released by the next run
+                    LOGGER.warning("Unable to release %s consumed chunks of session %s: %s", len(batch), self.sid, e)
+                finally:
+                    for _identifier in batch:
+                        self.reclaimQueue.task_done()
+        finally:
+            # stopped by an error: the next reclaim starts a new one
+            with self.reclaimLock:
+                if self.reclaimThread is threading.current_thread():
+                    self.reclaimThread = None
+
+    def flushReclaims(self, timeout=None):
+        '''Waits for the consumed chunks to be released
+        @return: True if they are, False if timeout passed'''
+        with self.reclaimQueue.all_tasks_done:
+            return self.reclaimQueue.all_tasks_done.wait_for(lambda: not self.reclaimQueue.unfinished_tasks, timeout)
+
+    def recoverReclaims(self):
+        '''Releases the chunks consumed but not released by a previous run (see ReclaimJournal),
+        to call when the session is ready to release chunks'''
+        if self.reclaimJournal is None:
+            return
+        orphans = self.reclaimJournal.takeOrphans()
+        if orphans:
+            LOGGER.info("Releasing %s chunks consumed before a restart", len(orphans))
+            self.releaseConsumed(orphans)
+            self.reclaimJournal.released(orphans)
+
 
     def receiveChunk(self):
         '''Receives some data (one chunk)
         @return: None if no more data available, a bytes if data available (possibly empty)'''
         if self.closed:
             return None
-        toreturn = self.receiveRawChunk()
+        if self.prefetcher is not None:
+            chunks = self.prefetcher.take(1)
+            toreturn = chunks[0] if chunks else b''
+        else:
+            toreturn = self.receiveRawChunk()
         if toreturn:
             LOGGER.debug("%s received raw chunk from %s (session %s) of size %s", self.me, self.other, self.sid, len(toreturn))
         if toreturn == self.data_to_close_session:
@@ -276,6 +685,23 @@ class CommunicationSession:
             self.closed = True
         return toreturn
 
+    def receiveAvailable(self, maximum=None):
+        '''Receives the chunks available (see receiveRawChunks)
+        @param maximum: number of chunks at most, None for all
+        @return: None if no more data available, a list of bytes otherwise (possibly empty)'''
+        if self.closed:
+            return None
+        toreturn = self.prefetcher.take(maximum) if self.prefetcher is not None else self.receiveRawChunks(maximum)
+        if toreturn:
+            LOGGER.debug("%s received %s raw chunks from %s (session %s) of size %s", self.me, len(toreturn), self.other, self.sid, sum(len(chunk) for chunk in toreturn))
+        if toreturn and toreturn[-1] == self.data_to_close_session:
+            # close the session, the chunks before are still returned
+            toreturn.pop()
+            self.closed = True
+            if not toreturn:
+                return None
+        return toreturn
+
 
     def receiveChunkWait(self, timeout=None, raiseTimeoutError=True):
         '''Receives some data (one chunk)
@@ -286,16 +712,28 @@ class CommunicationSession:
         toreturn = b''
         end = timeout + time.time() if timeout else None
         while toreturn is not None and (end is None or end > time.time()):
+            if self.prefetcher is not None:
+                # woken up as soon as a chunk is queued
+                self.prefetcher.wait(None if end is None else max(0, end - time.time()))
             toreturn = self.receiveChunk()
             if toreturn:
                 return toreturn
-            time.sleep(self.cacheUpdateTime)
+            if self.prefetcher is None:
+                time.sleep(self.cacheUpdateTime)
         if toreturn is None: # closed
             return toreturn
         if raiseTimeoutError:
             raise TimeoutError
         return toreturn
 
+    def startPrefetch(self, maxChunks=PREFETCH_CHUNKS, maxBytes=PREFETCH_BYTES):
+        '''From now on, the chunks are fetched in the background (see Prefetcher), the receive methods take them
+        from memory. Not for discovery sessions.
+        @param maxChunks: number of chunks kept in memory at most
+        @param maxBytes: size of the chunks kept in memory at most, one chunk more may be fetched'''
+        if self.prefetcher is None and not self.closed and self.sid not in (0, '0'):
+            self.prefetcher = Prefetcher(self, maxChunks, maxBytes)
+
     ################################################################# Cache for one byte
     def receiveOneByte(self, timeout=None):
         '''Receives one byte, or None if timeout is passed.'''
@@ -327,6 +765,9 @@ class CommunicationSession:
 
 class ActionServer:
     '''Abstract class that describes an action'''
+    # (maxChunks, maxBytes) to fetch the chunks of its sessions in the background, None otherwise (see CommunicationSession.startPrefetch)
+    prefetch = None
+    
     def __init__(self, capability):
         self.capability = capability
 
@@ -360,7 +801,7 @@ class QueueCommunicationSession(CommunicationSession):
         # creating a copy, in case data is a bytearray that may be cleared
         self.sentqueue.put(bytes(data))
 
-    def checkIfDataAvailable(self):
+    def checkIfRawDataAvailable(self):
         '''Returns True if a new chunk is available, False otherwise'''
         return not self.recqueue.empty()
 
@@ -497,10 +938,10 @@ class StoreAllActionServer(ActionServer):
 
     def loop(self):
         while not self.session.closed:
-            received = self.session.receiveChunk()
+            received = self.session.receiveAvailable()
             if received:
-                LOGGER.info("Dummy server (session %s) received a chunk of %s bytes", self.session.sid, len(received))
-                self.received.append(received)
+                LOGGER.info("Dummy server (session %s) received %s chunks of %s bytes", self.session.sid, len(received), sum(len(chunk) for chunk in received))
+                self.received.extend(received)
             if received is None:
                 break
 
@@ -520,10 +961,10 @@ class EchoActionServer(ActionServer):
         while not self.session.closed:
             while not self.session.checkIfDataAvailable() and not self.session.closed:
                 time.sleep(0.1)
-            received = self.session.receiveChunk()
+            received = self.session.receiveAvailable()
             if received:
-                LOGGER.info("Echo server (session %s) received a chunk of %s bytes", self.session.sid, len(received))
-                self.session.send(received)
+                LOGGER.info("Echo server (session %s) received %s chunks of %s bytes", self.session.sid, len(received), sum(len(chunk) for chunk in received))
+                self.session.sendMany(received)
             if received is None:
                 break
 
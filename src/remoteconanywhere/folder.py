@@ -6,28 +6,106 @@ Created on 10 avr. 2020
 @author: Cedric
 '''
 from remoteconanywhere.communication import CommunicationSession, CommunicationServer, CommunicationClient
-import os, fnmatch, logging
+import os, re, fnmatch, logging, threading, time
+from concurrent.futures import ThreadPoolExecutor
 
 
 LOGGER = logging.getLogger(os.path.basename(__file__).replace(".py", ""))
 
+# durability policies for written chunks
+DURABILITY_NONE = 'none' # no fsync at all, the OS decides
+DURABILITY_FSYNC = 'fsync' # fsync of each chunk and of the directory
+DURABILITY_GROUP = 'group' # fsync of the written chunks and the directory, once per interval
+
+GROUP_COMMIT_INTERVAL = 0.05 # seconds
+GROUP_COMMIT_RETRY = 1 # seconds before a failed group commit is tried again
+
+# time after which the presence of the next chunk is checked even if the hint file says there is nothing
+HINT_VERIFY_INTERVAL = 5 # seconds
+
+# coarsest modification time resolution of the file systems (FAT: 2s), a folder modified more recently is always listed
+MTIME_GRANULARITY = 2 # seconds
+
+# garbage collection of the files of dead sessions
+GC_INTERVAL = 600 # seconds between two collections
+GC_MAX_AGE = 24 * 3600 # seconds without activity before a session is considered dead
+GC_TEMP_MAX_AGE = 3600 # seconds before a temporary file is considered abandoned
+GC_MAX_FILES = 1000 # files removed by collection at most, the rest is for the next one
+
 
 class FolderCommunicationSession(CommunicationSession):
     
     FILENAMESTEMPLATE = "{me},{other},{sid},{sent}.bin"
     FILENAMERTEMPLATE = "{other},{me},{sid},{received}.bin"
+    # highest chunk number published by the writer
+    HINTSTEMPLATE = ".{me},{other},{sid}.hwm"
+    HINTRTEMPLATE = ".{other},{me},{sid}.hwm"
     TOFROMANY = 'ANY'
     
-    def __init__(self, me, other, sid, folderReception, folderEmission):
+    def __init__(self, me, other, sid, folderReception, folderEmission,
+                 durability=DURABILITY_NONE, groupCommitInterval=GROUP_COMMIT_INTERVAL,
+                 useHintFile=False, readAhead=0, readAheadWorkers=2, reclaimJournal=None):
         if folderEmission is None:
             folderEmission = folderReception
-        super().__init__(me, other, sid)
+        if durability not in (DURABILITY_NONE, DURABILITY_FSYNC, DURABILITY_GROUP):
+            raise ValueError("Unknown durability policy %r" % durability)
+        super().__init__(me, other, sid, reclaimJournal)
         self.folderReception = folderReception
         self.folderEmission = folderEmission
-        self.alreadyProcessed = set()
+        self.alreadyProcessed = dict() # broadcast file name => modification time
+        self.discoverySignature = None
+        # durability
+        self.durability = durability
+        self.groupCommitInterval = groupCommitInterval
+        self.groupCommitPending = []
+        self.groupCommitTimer = None
+        self.groupCommitLock = threading.Lock() # for the pending list only
+        self.groupCommitRunLock = threading.Lock() # one commit at a time: chunks published in order
+        self.groupCommitted = 0 # chunks published by the group commits
+        self.groupCommitRetry = GROUP_COMMIT_RETRY
+        self.groupCommitError = None # error of the last group commit, while its chunks are not published
+        # fsync statistics
+        self.fsyncCount = 0
+        self.fsyncTime = 0.
+        self.fsyncMaxTime = 0.
+        # hint file, not for discovery sessions
+        self.useHintFile = useHintFile and sid not in (0, '0')
+        self.hintHighWaterMark = None
+        self.hintLastVerification = time.time()
+        # read-ahead of the next chunks
+        self.readAhead = readAhead
+        self.readAheadWorkers = readAheadWorkers
+        self.readAheadExecutor = None
+        self.readAheadFutures = dict() # chunk number => future of the content (None if absent)
+        self.recoverReclaims()
     
     def sendUnit(self, data):
         '''Send some data'''
+        self.sendUnits([data])
+    
+    def sendUnits(self, units):
+        '''Send several chunks, the hint file being written and the folder synced once for all.
+        With DURABILITY_GROUP, they are published by the next group commit (see commitGroup).'''
+        if self.durability == DURABILITY_GROUP:
+            self.raiseGroupCommitError()
+            for data in units:
+                self.addToGroupCommit(self.writeChunkFile(data, publish=False))
+            return
+        for data in units:
+            self.writeChunkFile(data)
+        if self.useHintFile:
+            self.writeHintFile()
+        if self.durability == DURABILITY_FSYNC:
+            self.fsyncDirectory()
+    
+    @staticmethod
+    def temporaryPath(final):
+        return os.path.join(os.path.dirname(final), "." + os.path.basename(final) + ".tmp")
+    
+    def writeChunkFile(self, data, publish=True):
+        '''Writes the next chunk file, through a temporary file
+        @param publish: if False, the temporary file is not renamed (see temporaryPath)
+        @return: its path'''
         filename = self.FILENAMESTEMPLATE.format(**self.__dict__)
         filenametmp = "."+filename+".tmp"
         final = os.path.join(self.folderEmission, filename)
@@ -36,47 +114,298 @@ class FolderCommunicationSession(CommunicationSession):
         self.sent += 1
         with open(temporary, "wb") as fout:
             fout.write(data)
-        os.rename(temporary, final)
+            if self.durability == DURABILITY_FSYNC:
+                fout.flush()
+                self.timedFsync(fout.fileno())
+        if publish:
+            os.rename(temporary, final)
+        return final
+    
+    ################################################################# Durability
+    @property
+    def fsyncMeanTime(self):
+        '''Mean time of one fsync, in seconds'''
+        return self.fsyncTime / self.fsyncCount if self.fsyncCount else 0.
+    
+    def timedFsync(self, fd):
+        '''fsync the given file descriptor, updating the statistics'''
+        start = time.perf_counter()
+        os.fsync(fd)
+        elapsed = time.perf_counter() - start
+        self.fsyncCount += 1
+        self.fsyncTime += elapsed
+        self.fsyncMaxTime = max(self.fsyncMaxTime, elapsed)
+    
+    def fsyncDirectory(self):
+        '''fsync the emission folder, so that renames are durable'''
+        if os.name == 'nt':
+            # directories cannot be opened on Windows
+            return
+        fd = os.open(self.folderEmission, os.O_RDONLY)
+        try:
+            self.timedFsync(fd)
+        finally:
+            os.close(fd)
+    
+    def addToGroupCommit(self, filepath):
+        '''Registers a chunk file written under its temporary name, for the next group commit'''
+        with self.groupCommitLock:
+            self.groupCommitPending.append(filepath)
+            self.scheduleGroupCommit(self.groupCommitInterval)
+    
+    def scheduleGroupCommit(self, delay):
+        '''Starts the timer of the next group commit, if not started, with groupCommitLock held'''
+        if self.groupCommitTimer is None:
+            self.groupCommitTimer = threading.Timer(delay, self.commitGroup)
+            self.groupCommitTimer.daemon = True
+            self.groupCommitTimer.start()
+    
+    def commitGroup(self):
+        '''fsync all the chunk files written since last group commit, then publishes them: renamed in order,
+        the directory synced, then the hint file written. A chunk is never visible before being durable.
+        On error, the chunks not published stay pending, tried again after groupCommitRetry: the error is
+        raised by the next send or close if they are still not published (see raiseGroupCommitError).'''
+        with self.groupCommitRunLock:
+            with self.groupCommitLock:
+                # the next chunks can be written meanwhile
+                pending = self.groupCommitPending
+                self.groupCommitPending = []
+                if self.groupCommitTimer is not None:
+                    self.groupCommitTimer.cancel()
+                    self.groupCommitTimer = None
+            if not pending:
+                return
+            published = 0
+            try:
+                for filepath in pending:
+                    fd = os.open(self.temporaryPath(filepath), os.O_RDWR | getattr(os, 'O_BINARY', 0))
+                    try:
+                        self.timedFsync(fd)
+                    finally:
+                        os.close(fd)
+                for filepath in pending:
+                    os.rename(self.temporaryPath(filepath), filepath)
+                    published += 1
+                self.fsyncDirectory()
+                error = None
+            except OSError as e:
+                LOGGER.warning("Group commit of session %s failed after %s chunks of %s: %s", self.sid, published, len(pending), e)
+                error = e
+            with self.groupCommitLock:
+                # the chunks already renamed are visible: only the others fail the sender
+                self.groupCommitError = error if published < len(pending) else None
+                if self.groupCommitError is not None:
+                    # before the ones written meanwhile, published in order
+                    self.groupCommitPending[:0] = pending[published:]
+                    self.scheduleGroupCommit(self.groupCommitRetry)
+            if published:
+                self.groupCommitted += published
+                if self.useHintFile:
+                    try:
+                        self.writeHintFile(self.groupCommitted)
+                    except OSError as e:
+                        # the other side checks the chunk files from time to time
+                        LOGGER.warning("Hint file of session %s not written: %s", self.sid, e)
+        LOGGER.debug("Group commit of %s files for session %s", published, self.sid)
+    
+    def raiseGroupCommitError(self):
+        '''Raises the error of the last group commit, once, if its chunks are still not published'''
+        with self.groupCommitLock:
+            error, self.groupCommitError = self.groupCommitError, None
+        if error is not None:
+            raise error
+    
+    ################################################################# Hint file
+    def writeHintFile(self, count=None):
+        '''Publishes the number of chunks written so far
+        @param count: the number of chunks published, if not all the ones written'''
+        hintfile = os.path.join(self.folderEmission, self.HINTSTEMPLATE.format(**self.__dict__))
+        temporary = hintfile + ".tmp"
+        with open(temporary, "w") as fout:
+            fout.write(str(self.sent if count is None else count))
+        os.replace(temporary, hintfile)
+    
+    def readHintFile(self):
+        '''Reads the number of chunks published by the other side
+        @return: the number, or None if there is no hint file'''
+        hintfile = os.path.join(self.folderReception, self.HINTRTEMPLATE.format(**self.__dict__))
+        try:
+            with open(hintfile) as fin:
+                self.hintHighWaterMark = int(fin.read())
+        except (FileNotFoundError, ValueError):
+            # not written by the other side (yet), or being replaced
+            self.hintHighWaterMark = None
+        return self.hintHighWaterMark
+    
+    def removeHintFile(self):
+        hintfile = os.path.join(self.folderEmission, self.HINTSTEMPLATE.format(**self.__dict__))
+        try:
+            os.remove(hintfile)
+        except FileNotFoundError:
+            pass
+    
+    ################################################################# Read-ahead
+    def receptionFilePath(self, index):
+        return os.path.join(self.folderReception, self.FILENAMERTEMPLATE.format(other=self.other, me=self.me, sid=self.sid, received=index))
+    
+    def readChunkFile(self, index):
+        '''@return: the content of the chunk, None if it does not exist'''
+        try:
+            with open(self.receptionFilePath(index), "rb") as fin:
+                return fin.read()
+        except FileNotFoundError:
+            return None
+    
+    def scheduleReadAhead(self):
+        '''Prefetches the next chunks not already being read'''
+        if self.readAheadExecutor is None:
+            self.readAheadExecutor = ThreadPoolExecutor(self.readAheadWorkers, "folder-readahead-%s-%s" % (self.me, self.sid))
+        for index in range(self.received, self.received + self.readAhead):
+            if self.useHintFile and self.hintHighWaterMark is not None and index >= self.hintHighWaterMark:
+                # not published yet
+                break
+            future = self.readAheadFutures.get(index)
+            if future is None or (future.done() and (future.exception() is not None or future.result() is None)):
+                # not read yet, or read before being written: read again
+                self.readAheadFutures[index] = self.readAheadExecutor.submit(self.readChunkFile, index)
+    
+    def stopReadAhead(self):
+        self.readAheadFutures.clear()
+        if self.readAheadExecutor is not None:
+            self.readAheadExecutor.shutdown(wait=False)
+            self.readAheadExecutor = None
+    
+    def receiveReadAheadChunk(self):
+        '''Receives one chunk, using the chunks read in advance'''
+        index = self.received
+        future = self.readAheadFutures.pop(index, None)
+        data = future.result() if future is not None else None
+        if data is None:
+            # not prefetched, or prefetched before being written
+            if future is None and not self.checkIfRawDataAvailable():
+                return b''
+            data = self.readChunkFile(index)
+            if data is None:
+                return b''
+        self.received += 1
+        self.reclaim(self.receptionFilePath(index))
+        if data == self.data_to_close_session:
+            # nothing will come after
+            self.stopReadAhead()
+        else:
+            self.scheduleReadAhead()
+        return data
+    
+    def releaseConsumed(self, identifiers):
+        '''Deletes consumed files (see reclaim)'''
+        for filepath in identifiers:
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                LOGGER.warning("Consumed file %s already deleted", filepath)
+            else:
+                LOGGER.debug("Deleted consumed file %s", filepath)
+    
+    def close(self, silently=False):
+        super().close(silently)
+        try:
+            self.commitGroup()
+            with self.groupCommitLock:
+                # not tried again once closed
+                if self.groupCommitTimer is not None:
+                    self.groupCommitTimer.cancel()
+                    self.groupCommitTimer = None
+            self.raiseGroupCommitError()
+        finally:
+            self.stopReadAhead()
+            if self.useHintFile:
+                # the other side will check the chunk files directly
+                self.removeHintFile()
     
     @property
     def nextReceptionFileName(self):
         return self.FILENAMERTEMPLATE.format(**self.__dict__)
     
-    def checkIfDataAvailable(self):
+    def checkIfRawDataAvailable(self):
         '''Returns True if a new chunk is available, False otherwise'''
+        future = self.readAheadFutures.get(self.received)
+        if future is not None and future.done() and future.result() is not None:
+            return True
+        if self.useHintFile:
+            if self.hintHighWaterMark is not None and self.received < self.hintHighWaterMark:
+                # already known, no need to ask the file system
+                return True
+            if self.readHintFile() is not None:
+                if self.received < self.hintHighWaterMark:
+                    return True
+                if time.time() - self.hintLastVerification < HINT_VERIFY_INTERVAL:
+                    return False
+                # the hint may be lost (crash of the other side), check from time to time
+                self.hintLastVerification = time.time()
         return os.path.exists(os.path.join(self.folderReception, self.nextReceptionFileName))
     
+    def receptionFolderChanged(self):
+        '''Checks, with only one stat, if the reception folder may have changed since the last full discovery'''
+        st = os.stat(self.folderReception)
+        signature = (st.st_mtime_ns, st.st_size, st.st_nlink)
+        if time.time() - st.st_mtime <= MTIME_GRANULARITY:
+            # a modification in the same time unit would not be seen
+            signature = None
+        changed = signature is None or signature != self.discoverySignature
+        return changed, signature
+    
     def discover(self, onlyOne=False):
         '''@return a list of [('other', b'data')]'''
+        changed, signature = self.receptionFolderChanged()
+        if not changed:
+            return []
         filenamewithstar = self.FILENAMERTEMPLATE.format(other='*', me=self.me, sid=self.sid, received=0)
+        filenamewithdoublestar = self.FILENAMERTEMPLATE.format(other='*', me=self.TOFROMANY, sid=self.sid, received=0)
         toreturn = []
-        for fil in os.listdir(self.folderReception):
-            if fnmatch.fnmatch(fil, filenamewithstar):
-                otherid = fil.split(',' + self.me)[0]
-                filepath = os.path.join(self.folderReception, fil)
-                with open(filepath, 'rb') as fin:
-                    toreturn.append((otherid, fin.read()))
-                # file is only for me, deleted
-                os.remove(filepath)
-                if os.path.exists(filepath):
-                    LOGGER.warning("Deleted discovered file %s but seems to be still there", filepath)
+        broadcastfiles = dict()
+        complete = True
+        with os.scandir(self.folderReception) as entries:
+            for entry in entries:
+                fil = entry.name
+                filepath = entry.path
+                if fnmatch.fnmatch(fil, filenamewithstar):
+                    otherid = fil.split(',' + self.me)[0]
+                    try:
+                        with open(filepath, 'rb') as fin:
+                            toreturn.append((otherid, fin.read()))
+                    except FileNotFoundError:
+                        continue
+                    # file is only for me, deleted
+                    os.remove(filepath)
+                    if os.path.exists(filepath):
+                        LOGGER.warning("Deleted discovered file %s but seems to be still there", filepath)
+                    else:
+                        LOGGER.debug("Really deleted discovered file %s", filepath)
+                elif fnmatch.fnmatch(fil, filenamewithdoublestar):
+                    try:
+                        mtime = entry.stat().st_mtime_ns
+                    except FileNotFoundError:
+                        continue
+                    if self.alreadyProcessed.get(fil) == mtime:
+                        broadcastfiles[fil] = mtime
+                        continue
+                    otherid = fil.split(',')[0]
+                    try:
+                        with open(filepath, 'rb') as fin:
+                            toreturn.append((otherid, fin.read()))
+                    except FileNotFoundError:
+                        continue
+                    # no deletion as it is also for other targets, but do not process again
+                    self.alreadyProcessed[fil] = broadcastfiles[fil] = mtime
                 else:
-                    LOGGER.debug("Really deleted discovered file %s", filepath)
-                if onlyOne:
-                    return toreturn
-        filenamewithdoublestar = self.FILENAMERTEMPLATE.format(other='*', me=self.TOFROMANY, sid=self.sid, received=0)
-        for fil in os.listdir(self.folderReception):
-            if fnmatch.fnmatch(fil, filenamewithdoublestar):
-                key = fil + os.path.getmtime(filepath)
-                if key in self.alreadyProcessed: continue
-                otherid = fil.split(',')[0]
-                filepath = os.path.join(self.folderReception, fil)
-                with open(filepath, 'rb') as fin:
-                    toreturn.append((otherid, fin.read()))
-                # no deletion as it is also for other targets, but do not process again
-                self.alreadyProcessed.add(key)
-                if onlyOne:
-                    return toreturn
+                    continue
+                if onlyOne and toreturn:
+                    complete = False
+                    break
+        if complete:
+            # forget the broadcast files that disappeared, and do not list again until something changes
+            self.alreadyProcessed = broadcastfiles
+            self.discoverySignature = signature
         if toreturn:
             LOGGER.debug("Discovered messages for %s (session %s): %s", self.me, self.sid,
                          ", ".join('%s sent %s bytes' % (k, len(j)) for k, j in toreturn)
@@ -98,38 +427,81 @@ class FolderCommunicationSession(CommunicationSession):
         @return: None if no more data available, a bytes if data available (possibly empty)'''
         if self.closed:
             return None
-        filename = self.nextReceptionFileName
-        realfile = os.path.join(self.folderReception, filename)
-        toreturn = b''
-        if os.path.exists(realfile):
+        if self.readAhead:
+            return self.receiveReadAheadChunk()
+        if self.useHintFile and not self.checkIfRawDataAvailable():
+            return b''
+        # without hint file, opening the file is the check
+        realfile = os.path.join(self.folderReception, self.nextReceptionFileName)
+        try:
             with open(realfile, "rb") as fin:
                 toreturn = fin.read()
-            os.remove(realfile)
-            if os.path.exists(realfile):
-                LOGGER.warning("Deleted file %s but seems to be still there", realfile)
-            else:
-                LOGGER.debug("Really deleted file %s", realfile)
-            self.received += 1
+        except FileNotFoundError:
+            return b''
+        self.received += 1
+        # deleted in the background
+        self.reclaim(realfile)
         # remember to increase received!
         return toreturn
+    
+    def receiveRawChunks(self, maximum=None):
+        '''Receives the chunks available: if the next one is there, the reception folder is listed once
+        to find the following ones, instead of trying to open each of them'''
+        if self.closed or self.readAhead or self.useHintFile:
+            # the chunks are already known without listing
+            return super().receiveRawChunks(maximum)
+        first = self.receiveRawChunk()
+        if not first or first == self.data_to_close_session or maximum == 1:
+            return [first] if first else []
+        prefix = self.FILENAMERTEMPLATE.format(other=self.other, me=self.me, sid=self.sid, received='')[:-len('.bin')]
+        numbers = set()
+        with os.scandir(self.folderReception) as entries:
+            for entry in entries:
+                number = entry.name[len(prefix):-len('.bin')]
+                if entry.name.startswith(prefix) and entry.name.endswith('.bin') and number.isdigit():
+                    numbers.add(int(number))
+        toreturn = [first]
+        while self.received in numbers and (maximum is None or len(toreturn) < maximum):
+            data = self.readChunkFile(self.received)
+            if data is None:
+                break
+            self.reclaim(self.receptionFilePath(self.received))
+            self.received += 1
+            toreturn.append(data)
+            if data == self.data_to_close_session:
+                break
+        return toreturn
 
 class FolderCommServer(CommunicationServer):
     
     CAPABILITYTEMPLATE = '{rid}.capa'
     
-    def __init__(self, rid, folderReception, folderEmission=None):
-        '''Initializes a server'''
+    # files of a session: chunks and hint files
+    SESSIONFILE_RX = re.compile(r"^\.?(?P<me>[^,]+),(?P<other>[^,]+),(?P<sid>[^,]+)(,\d+\.bin|\.hwm)$")
+    TEMPFILE_RX = re.compile(r"^\..*\.tmp$")
+    
+    def __init__(self, rid, folderReception, folderEmission=None, gcInterval=None, gcMaxAge=GC_MAX_AGE, **sessionOptions):
+        '''Initializes a server
+        @param gcInterval: if set, files of dead sessions are collected in the background every gcInterval seconds
+        @param gcMaxAge: time without activity after which a session is considered dead
+        @param sessionOptions: given to each FolderCommunicationSession (durability, useHintFile...)'''
         if folderEmission is None:
             folderEmission = folderReception
         self.folderReception = folderReception
         self.folderEmission = folderEmission
+        self.sessionOptions = sessionOptions
+        self.gcInterval = gcInterval
+        self.gcMaxAge = gcMaxAge
+        self.gcThread = None
+        self.gcStop = threading.Event() # set by stop()
+        self.reclaimedBytes = 0
         for dire in (folderEmission, folderReception):
             if not os.path.exists(dire):
                 os.makedirs(dire)
         super().__init__(rid)
     
     def createSession(self, cid, rid, sid):
-        return FolderCommunicationSession(rid, cid, sid, self.folderReception, self.folderEmission)
+        return FolderCommunicationSession(rid, cid, sid, self.folderReception, self.folderEmission, **self.sessionOptions)
     
     @property
     def capabilityFile(self):
@@ -148,27 +520,102 @@ class FolderCommServer(CommunicationServer):
         for d in set([self.folderReception, self.folderEmission]):
             LOGGER.warn("Cleaning up %s", d)
             for f in os.listdir(d):
-                if os.path.isfile(f):
-                    os.remove(os.path.join(d, f))
+                path = os.path.join(d, f)
+                if os.path.isfile(path):
+                    os.remove(path)
+    
+    def collectGarbage(self, maxAge=None, tempMaxAge=GC_TEMP_MAX_AGE, maxFiles=GC_MAX_FILES):
+        '''Removes the files of the sessions without activity for maxAge seconds, and the abandoned temporary files.
+        Opened sessions of this server are kept. At most maxFiles files are removed.
+        @return: the number of bytes reclaimed'''
+        if maxAge is None:
+            maxAge = self.gcMaxAge
+        now = time.time()
+        opened = set((s.me, s.other, str(s.sid)) for s in self.openedsessions if not s.closed)
+        lastactivity = dict() # session (both directions) => last modification
+        filesbysession = dict() # session => [(path, size)]
+        toremove = []
+        for d in set([self.folderReception, self.folderEmission]):
+            with os.scandir(d) as entries:
+                for entry in entries:
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    if self.TEMPFILE_RX.match(entry.name):
+                        if now - st.st_mtime > tempMaxAge:
+                            toremove.append((entry.path, st.st_size))
+                        continue
+                    m = self.SESSIONFILE_RX.match(entry.name)
+                    if not m:
+                        continue
+                    me, other, sid = m.group('me', 'other', 'sid')
+                    if (me, other, sid) in opened or (other, me, sid) in opened:
+                        continue
+                    key = (min(me, other), max(me, other), sid)
+                    lastactivity[key] = max(lastactivity.get(key, 0), st.st_mtime)
+                    filesbysession.setdefault(key, []).append((entry.path, st.st_size))
+        for key, last in lastactivity.items():
+            if now - last > maxAge:
+                LOGGER.debug("Session %s without activity for %ss", key, int(now - last))
+                toremove.extend(filesbysession[key])
+        reclaimed = 0
+        for path, size in toremove[:maxFiles]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            reclaimed += size
+        self.reclaimedBytes += reclaimed
+        if toremove:
+            LOGGER.info("Garbage collection removed %s files (%s bytes), %s left for later",
+                        min(len(toremove), maxFiles), reclaimed, max(0, len(toremove) - maxFiles))
+        return reclaimed
+    
+    def startGarbageCollector(self, interval=None):
+        '''Collects garbage in the background until the server is stopped'''
+        if interval is not None:
+            self.gcInterval = interval
+        if self.gcThread is not None and self.gcThread.is_alive():
+            return
+        self.gcThread = threading.Thread(target=self.garbageCollectorLoop, name="folder-gc-%s" % self.rid, daemon=True)
+        self.gcThread.start()
+    
+    def garbageCollectorLoop(self):
+        while not self.gcStop.is_set():
+            try:
+                self.collectGarbage()
+            except Exception:
+                LOGGER.warning("Error during garbage collection", exc_info=True)
+            # woken up by stop()
+            self.gcStop.wait(self.gcInterval)
+    
+    def serveForever(self):
+        if self.gcInterval:
+            self.startGarbageCollector()
+        super().serveForever()
     
     def stop(self):
+        self.gcStop.set()
         super().stop()
         os.remove(self.capabilityFile)
 
 class FolderCommClient(CommunicationClient):
 
-    def __init__(self, cid, folderReception, folderEmission=None):
+    def __init__(self, cid, folderReception, folderEmission=None, **sessionOptions):
+        '''@param sessionOptions: given to each FolderCommunicationSession (durability, useHintFile...)'''
         super().__init__(cid)
         if folderEmission is None:
             folderEmission = folderReception
         self.folderReception = folderReception
         self.folderEmission = folderEmission
+        self.sessionOptions = sessionOptions
         for dire in (folderEmission, folderReception):
             if not os.path.exists(dire):
                 os.makedirs(dire)
     
     def createSession(self, cid, rid, sid):
-        return FolderCommunicationSession(cid, rid, sid, self.folderReception, self.folderEmission)
+        return FolderCommunicationSession(cid, rid, sid, self.folderReception, self.folderEmission, **self.sessionOptions)
     
     def listServers(self):
         '''List the servers rid'''
@@ -6,16 +6,32 @@ Created on 13 avr. 2020
 @author: Cedric
 '''
 
-from remoteconanywhere.communication import CommunicationSession, CommunicationServer, CommunicationClient
+from remoteconanywhere.communication import CommunicationSession, CommunicationServer, CommunicationClient, LOOP_SLEEP
 from ftplib import FTP, FTP_TLS, FTP_PORT
 from remoteconanywhere.cred import CredentialManager
-import fnmatch, logging
+import fnmatch, logging, re, struct, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from io import BytesIO
 
 import os
 import ftplib
 LOGGER = logging.getLogger(os.path.basename(__file__).replace(".py", ""))
 
+# control connections opened at most by a server or a client, shared by its sessions
+POOL_SIZE = 4
+# a free connection not used for this time is kept alive with a NOOP
+KEEPALIVE_INTERVAL = 60 # seconds
+# files transferred at the same time by a session: parts of a big send, or consecutive chunks received
+PARALLEL_TRANSFERS = 4
+# in stream mode, size after which the sender continues in a new stream file
+STREAM_ROTATE_SIZE = 1024 * 1024 # bytes
+# a lost connection is replaced and the operation run again (see FtpConnectionPool.run):
+# at once, then after a delay doubled each time
+RECONNECT_RETRIES = 5
+RECONNECT_BACKOFF = 0.5 # seconds
+RECONNECT_BACKOFF_MAX = 30 # seconds
+
 def createFtpConnection(folder, hostname, credmanager, port=FTP_PORT, tls=False):
     user, pwd = credmanager.getcredentials(hostname)
     if tls:
@@ -30,75 +46,480 @@ def createFtpConnection(folder, hostname, credmanager, port=FTP_PORT, tls=False)
     try:
         ftp.cwd(folder)
     except:
-        ftp.mkd(folder)
+        try:
+            ftp.mkd(folder)
+        except ftplib.error_perm:
+            # created by another connection in the meantime
+            pass
         ftp.cwd(folder)
     return ftp
 
+
+class FtpConnectionPool:
+    '''Logged-in control connections to the FTP server, shared by the sessions of a server or a client.
+    A connection is borrowed for one operation (see connection), so that it is never used by two threads at the same time.
+    The free connections are kept alive with a NOOP when not used for a while.
+    A lost connection is replaced by a new one, the operation is run again (see run).'''
+    
+    def __init__(self, ftpFactory=None, size=POOL_SIZE, keepalive=KEEPALIVE_INTERVAL, ftp=None,
+                 retries=RECONNECT_RETRIES, backoff=RECONNECT_BACKOFF):
+        '''@param ftpFactory: opens a new connection (see createFtpConnection)
+        @param size: maximum number of connections opened at the same time
+        @param keepalive: time after which a free connection receives a NOOP, None to never send one
+        @param ftp: an already opened connection, the only one if there is no factory
+        @param retries: times an operation is run again when its connection is lost
+        @param backoff: delay before the second retry, doubled for each next one'''
+        self.ftpFactory = ftpFactory
+        self.size = size
+        self.keepalive = keepalive
+        self.retries = retries
+        self.backoff = backoff
+        self.reconnectCount = 0
+        self.condition = threading.Condition()
+        self.connections = [] # all the opened connections
+        self.free = [] # the ones not borrowed, the most recently used at the end
+        self.opening = 0 # connections being opened
+        self.closed = False
+        self.closing = threading.Event()
+        self.keepaliveThread = None
+        self.noopCount = 0
+        if ftp is not None:
+            self.adopt(ftp)
+            self.connections.append(ftp)
+            self.free.append(ftp)
+    
+    ################################################################# connections
+    @staticmethod
+    def adopt(ftp):
+        ftp.lastUse = time.time()
+        return ftp
+    
+    def newConnection(self):
+        '''Opens a new connection'''
+        if self.ftpFactory is None:
+            raise ftplib.error_temp("421 No way to open a new connection")
+        ftp = self.adopt(self.ftpFactory())
+        self.startKeepalive()
+        return ftp
+    
+    @staticmethod
+    def shutdown(ftp):
+        '''Quits, ignoring the errors'''
+        try:
+            ftp.quit()
+        except Exception as e:
+            LOGGER.debug("Error while closing connection: %s", e)
+            ftp.close()
+    
+    @staticmethod
+    def isConnectionError(e):
+        '''@return: True if the connection cannot be used anymore after this error'''
+        if isinstance(e, ftplib.error_temp):
+            # 421: service not available, closing control connection
+            return str(e).startswith('421')
+        return isinstance(e, (OSError, EOFError, ftplib.error_reply, ftplib.error_proto))
+    
+    def borrow(self):
+        '''@return: a connection for the exclusive use of the caller, to give back (see connection)'''
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise ftplib.error_temp("421 Connection pool closed")
+                if self.free:
+                    return self.free.pop()
+                if len(self.connections) + self.opening < self.size:
+                    self.opening += 1
+                    break
+                self.condition.wait()
+        try:
+            ftp = self.newConnection()
+        finally:
+            with self.condition:
+                self.opening -= 1
+                self.condition.notify()
+        with self.condition:
+            self.connections.append(ftp)
+        return ftp
+    
+    def giveBack(self, ftp):
+        ftp.lastUse = time.time()
+        with self.condition:
+            if self.closed or ftp not in self.connections:
+                if ftp in self.connections:
+                    self.connections.remove(ftp)
+                toclose = ftp
+            else:
+                self.free.append(ftp)
+                toclose = None
+            self.condition.notify()
+        if toclose is not None:
+            self.shutdown(toclose)
+    
+    def discard(self, ftp):
+        '''Forgets a broken connection'''
+        with self.condition:
+            if ftp in self.connections:
+                self.connections.remove(ftp)
+            self.condition.notify()
+        ftp.close()
+    
+    @contextmanager
+    def connection(self):
+        '''Borrows a connection, a free one if possible'''
+        ftp = self.borrow()
+        try:
+            yield ftp
+        except BaseException as e:
+            if self.isConnectionError(e):
+                self.discard(ftp)
+            else:
+                self.giveBack(ftp)
+            raise
+        self.giveBack(ftp)
+    
+    def run(self, operation, *args):
+        '''Runs operation(ftp, *args) with a connection of the pool. If the connection is lost (idle timeout
+        of the server, 421...), the operation is run again with a new connection: at once, then after
+        a delay doubled each time. The operation must give the same result if it is run again.
+        Without factory, the error is raised at once.
+        @return: what operation returns'''
+        delay = 0
+        for attempt in range(self.retries + 1):
+            try:
+                with self.connection() as ftp:
+                    return operation(ftp, *args)
+            except Exception as e:
+                if self.closed or self.ftpFactory is None or attempt >= self.retries or not self.isConnectionError(e):
+                    raise
+                LOGGER.warning("FTP connection lost (%s), retry %s/%s in %.1fs", e, attempt + 1, self.retries, delay)
+                self.reconnectCount += 1
+            if delay and self.closing.wait(delay):
+                raise ftplib.error_temp("421 Connection pool closed")
+            delay = min(max(delay * 2, self.backoff), RECONNECT_BACKOFF_MAX)
+    
+    ################################################################# keepalive
+    def startKeepalive(self):
+        with self.condition:
+            if not self.keepalive or self.closed or self.keepaliveThread is not None:
+                return
+            self.keepaliveThread = threading.Thread(target=self.keepaliveLoop, name="ftp-keepalive", daemon=True)
+        self.keepaliveThread.start()
+    
+    def keepaliveLoop(self):
+        while not self.closing.wait(self.keepalive / 2):
+            now = time.time()
+            with self.condition:
+                idle = [ftp for ftp in self.free if now - ftp.lastUse >= self.keepalive]
+                for ftp in idle:
+                    self.free.remove(ftp)
+            for ftp in idle:
+                try:
+                    self.noopCount += 1
+                    ftp.voidcmd('NOOP')
+                except ftplib.all_errors as e:
+                    LOGGER.debug("Idle connection lost: %s", e)
+                    self.discard(ftp)
+                else:
+                    self.giveBack(ftp)
+    
+    def close(self):
+        with self.condition:
+            self.closed = True
+            toclose = self.free
+            self.free = []
+            self.connections = [ftp for ftp in self.connections if ftp not in toclose]
+            self.condition.notify_all()
+        self.closing.set()
+        for ftp in toclose:
+            self.shutdown(ftp)
+
+
+class FtpPoller:
+    '''Lists the folder of the FTP server (one MLSD) at most once per pollInterval for all the sessions
+    of a server or a client, and indexes the chunk and stream files present. The sessions ask the index
+    if their next chunk is there instead of asking the server.'''
+    
+    # see FtpCommunicationSession.FILENAMESTEMPLATE and STREAMSTEMPLATE, the temporary files start with a dot
+    CHUNKFILE_RX = re.compile(r"^(?P<writer>[^,.][^,]*),(?P<reader>[^,]+),(?P<sid>[^,]+),(?P<number>\d+)\.(bin|stream)$")
+    
+    def __init__(self, pool, pollInterval=LOOP_SLEEP):
+        '''@param pool: the FtpConnectionPool to use
+        @param pollInterval: minimum time between two listings'''
+        self.pool = pool
+        self.pollInterval = pollInterval
+        self.lastPoll = 0
+        self.pollLock = threading.Lock()
+        self.indexLock = threading.Lock()
+        self.files = dict() # file name => (writer, reader, sid, number, modification time, size)
+        self.forgotten = set() # files consumed during the current listing
+        self.pollCount = 0
+    
+    def poll(self, force=False):
+        '''Lists the folder, if not done for pollInterval'''
+        with self.pollLock:
+            if not force and time.time() - self.lastPoll < self.pollInterval:
+                return
+            with self.indexLock:
+                self.forgotten = set()
+            # the default facts, to avoid an OPTS each time
+            listing = self.pool.run(lambda ftp: list(ftp.mlsd()))
+            self.pollCount += 1
+            files = dict()
+            for name, facts in listing:
+                m = self.CHUNKFILE_RX.match(name)
+                if m and facts.get('type', 'file') == 'file':
+                    writer, reader, sid, number = m.group('writer', 'reader', 'sid', 'number')
+                    size = int(facts.get('size', -1))
+                    files[name] = (writer, reader, sid, int(number), facts.get('modify', size), size)
+            with self.indexLock:
+                for name in self.forgotten:
+                    # listed before being consumed
+                    files.pop(name, None)
+                self.files = files
+            self.lastPoll = time.time()
+    
+    def isAvailable(self, filename, offset=None):
+        '''@param offset: if given, the file must also be bigger than offset (stream file partly read)
+        @return: True if the file was listed, the folder is listed again if it was not'''
+        if self.isListed(filename, offset):
+            return True
+        self.poll()
+        return self.isListed(filename, offset)
+    
+    def isListed(self, filename, offset=None):
+        entry = self.files.get(filename)
+        if entry is None:
+            return False
+        # size unknown (-1) if the server does not give it
+        return offset is None or entry[5] < 0 or entry[5] > offset
+    
+    def forget(self, filename):
+        '''Removes a consumed file from the index'''
+        with self.indexLock:
+            self.files.pop(filename, None)
+            self.forgotten.add(filename)
+    
+    def entries(self):
+        '''@return: list of (file name, (writer, reader, sid, number, modification time, size)) of the listed files'''
+        with self.indexLock:
+            return list(self.files.items())
+
+
 class FtpCommunicationSession(CommunicationSession):
     
     FILENAMESTEMPLATE = "{me},{other},{sid},{sent}.bin"
     FILENAMERTEMPLATE = "{other},{me},{sid},{received}.bin"
+    STREAMSTEMPLATE = "{me},{other},{sid},{streamSent}.stream"
+    STREAMRTEMPLATE = "{other},{me},{sid},{streamReceived}.stream"
     TOFROMANY = 'ANY'
+    # stream mode: each chunk is a frame, its length then its data
+    FRAME_HEADER = struct.Struct(">I")
+    # length of the last frame of a stream file, the next chunks are in the next file
+    FRAME_END_OF_FILE = 0xFFFFFFFF
+    # the chunk files are uploaded on several connections of the pool, then renamed in order
+    CONCURRENT_SEND = True
     
-    def __init__(self, me, other, sid, ftp):
-        super().__init__(me, other, sid)
+    def __init__(self, me, other, sid, ftp, poller=None, parallelTransfers=PARALLEL_TRANSFERS,
+                 streamMode=False, rotateSize=STREAM_ROTATE_SIZE, reclaimJournal=None):
+        '''@param ftp: the FtpConnectionPool of the server or client, or a connection for this session only
+        @param poller: the FtpPoller shared with the other sessions, if None the session lists the folder for itself
+        @param parallelTransfers: files transferred at the same time, each on its own connection of the pool
+        @param streamMode: if True, the chunks are appended (APPE) to one file per direction, read from where
+        the previous reading stopped (REST + RETR), instead of one file per chunk. Both sides must use it.
+        The discovery session (0) always uses one file per message.
+        @param rotateSize: in stream mode, size after which the sender continues in a new file, the reader
+        deletes a file when it has read all of it
+        @param reclaimJournal: the ReclaimJournal of the consumed files not deleted yet'''
+        super().__init__(me, other, sid, reclaimJournal)
         self.alreadyProcessed = set()
-        self.ftp = ftp
+        self.ownPool = not isinstance(ftp, FtpConnectionPool)
+        #: :type pool: FtpConnectionPool
+        self.pool = FtpConnectionPool(size=1, ftp=ftp) if self.ownPool else ftp
+        #: :type poller: FtpPoller
+        self.poller = poller if poller is not None else FtpPoller(self.pool, pollInterval=0)
+        self.parallelTransfers = max(1, min(parallelTransfers, self.pool.size))
+        self.transferExecutor = None
+        self.sendWorkers = self.parallelTransfers
+        self.sendRetries = 0 # the pool already tries again on a new connection
+        self.fetchedChunks = dict() # chunk number => data, received in advance
+        # the protocol state is kept here, the connections can be lost and replaced (see FtpConnectionPool.run)
+        self.pendingFrames = [] # stream mode: chunks not appended yet
+        self.streamMode = streamMode and sid not in (0, '0')
+        self.rotateSize = rotateSize
+        self.streamSent = 0 # number of the stream file written
+        self.streamSentSize = 0 # bytes already in it
+        self.streamReceived = 0 # number of the stream file read
+        self.streamOffset = 0 # bytes of it already read
+        self.recoverReclaims()
     
     def sendUnit(self, data):
         '''Send some data'''
-        filename = self.FILENAMESTEMPLATE.format(**self.__dict__)
+        self.sendUnits([data])
+    
+    def sendFileName(self, number):
+        return self.FILENAMESTEMPLATE.format(me=self.me, other=self.other, sid=self.sid, sent=number)
+    
+    def stageUnit(self, number, data):
+        '''Uploads the chunk in its temporary file'''
+        self.pool.run(self.upload, self.sendFileName(number), data)
+    
+    def publishUnit(self, number):
+        '''Renames the temporary file of the chunk, the other side can read it'''
+        try:
+            self.pool.run(self.rename, self.sendFileName(number))
+        except ftplib.error_perm:
+            # uploaded again by the next try, if any
+            self.stagedUnits.discard(number)
+            self.discardUnit(number)
+            raise
+    
+    def discardUnit(self, number):
+        '''Deletes the temporary file of a chunk of a failed send'''
+        self.pool.run(self.remove, "."+self.sendFileName(number)+".tmp")
+    
+    @staticmethod
+    def rename(ftp, filename):
+        '''Renames the uploaded temporary file of filename, the other side can read it'''
+        try:
+            ftp.rename("."+filename+".tmp", filename)
+        except ftplib.error_perm as e:
+            try:
+                ftp.size(filename)
+            except ftplib.error_perm:
+                # refused, or the upload is lost: the chunk does not exist
+                LOGGER.warning("Chunk %s not renamed: %s", filename, e)
+                raise e
+            # the connection was lost after the renaming
+            LOGGER.warning("Temporary file of %s not there, already renamed: %s", filename, e)
+    
+    @staticmethod
+    def upload(ftp, filename, data):
+        '''Stores the data in the temporary file of filename, to be renamed when complete'''
         filenametmp = "."+filename+".tmp"
         try:
-            self.ftp.delete(filename)
-            self.ftp.delete(filenametmp)
-        except:
+            ftp.delete(filename)
+            ftp.delete(filenametmp)
+        except ftplib.error_perm:
             pass
-        self.sent += 1
-        self.ftp.storbinary('STOR ' + filenametmp, BytesIO(data))
-        self.ftp.rename(filenametmp, filename)
+        ftp.storbinary('STOR ' + filenametmp, BytesIO(data))
+    
+    def sendUnits(self, units):
+        '''Send several chunks: in stream mode all in one APPE, otherwise uploaded in parallel and renamed in order
+        (see sendUnitsStaged)'''
+        if self.streamMode:
+            return self.appendFrames(units)
+        self.sendUnitsStaged(units)
+    
+    def appendFrames(self, chunks):
+        '''Stream mode: appends the chunks to the stream file in one transfer, after the ones of a previous
+        transfer that failed'''
+        # a failed transfer may have written a part of its frames
+        rewrite = [bool(self.pendingFrames)]
+        self.pendingFrames.extend(chunks)
+        frames = bytearray()
+        for chunk in self.pendingFrames:
+            frames += self.FRAME_HEADER.pack(len(chunk))
+            frames += chunk
+        filename = self.STREAMSTEMPLATE.format(**self.__dict__)
+        rotate = self.streamSentSize + len(frames) >= self.rotateSize
+        if rotate:
+            frames += self.FRAME_HEADER.pack(self.FRAME_END_OF_FILE)
+        
+        def store(ftp):
+            if rewrite[0] or not self.streamSentSize:
+                # from the end of the last complete transfer, a new file replaces what a previous session
+                # with the same id could have left
+                ftp.storbinary('STOR ' + filename, BytesIO(frames), rest=self.streamSentSize or None)
+            else:
+                rewrite[0] = True
+                ftp.storbinary('APPE ' + filename, BytesIO(frames))
+        self.pool.run(store)
+        self.sent += len(self.pendingFrames)
+        self.pendingFrames = []
+        if rotate:
+            self.streamSent += 1
+            self.streamSentSize = 0
+        else:
+            self.streamSentSize += len(frames)
+    
+    def executor(self):
+        if self.transferExecutor is None:
+            self.transferExecutor = ThreadPoolExecutor(self.parallelTransfers, "ftp-transfer-%s-%s" % (self.me, self.sid))
+        return self.transferExecutor
     
     @property
     def nextReceptionFileName(self):
+        if self.streamMode:
+            return self.STREAMRTEMPLATE.format(**self.__dict__)
         return self.FILENAMERTEMPLATE.format(**self.__dict__)
     
-    def checkIfDataAvailable(self):
+    def checkIfRawDataAvailable(self):
         '''Returns True if a new chunk is available, False otherwise'''
+        if self.received in self.fetchedChunks:
+            return True
         try:
-            toreturn = self.ftp.size(self.nextReceptionFileName) is not None
-        except ftplib.Error:
-            toreturn = False
+            toreturn = self.poller.isAvailable(self.nextReceptionFileName, self.streamOffset if self.streamMode else None)
+        except ftplib.error_temp:
+            if self.pool.closed:
+                return False
+            raise
         if toreturn:
             LOGGER.info("File %s exists.", self.nextReceptionFileName)
         return toreturn
     
+    def retrieve(self, ftp, filename, offset=0):
+        '''@param offset: where to start in the file
+        @return: the content of the file, None if it does not exist anymore'''
+        toreturn = bytearray()
+        try:
+            ftp.retrbinary('RETR ' + filename, toreturn.extend, rest=offset or None)
+        except ftplib.error_perm as e:
+            LOGGER.debug("File %s listed but not there: %s", filename, e)
+            self.poller.forget(filename)
+            return None
+        return bytes(toreturn)
+    
+    def remove(self, ftp, filename):
+        '''Deletes a consumed file'''
+        try:
+            ftp.delete(filename)
+        except ftplib.error_perm as e:
+            # the connection was lost after the deletion
+            LOGGER.debug("File %s already deleted: %s", filename, e)
+        self.poller.forget(filename)
+    
     def discover(self, onlyOne=False):
         '''@return a list of [('other', b'data')]'''
-        filenamewithstar = self.FILENAMERTEMPLATE.format(other='*', me=self.me, sid=self.sid, received=0)
         toreturn = []
-        for fil in self.ftp.nlst():
-            if fnmatch.fnmatch(fil, filenamewithstar):
-                otherid = fil.split(',' + self.me)[0]
-                towrite = bytearray()
-                self.ftp.retrbinary('RETR ' + fil, towrite.extend)
-                toreturn.append((otherid, towrite))
-                # file is only for me, deleted
-                self.ftp.delete(fil)
-                if onlyOne:
-                    return toreturn
-        filenamewithdoublestar = self.FILENAMERTEMPLATE.format(other='*', me=self.TOFROMANY, sid=self.sid, received=0)
-        for fil, facts in self.ftp.mlsd(facts=['modify']):
-            if fnmatch.fnmatch(fil, filenamewithdoublestar):
-                key = fil + facts['modify']
-                if key in self.alreadyProcessed: continue
-                otherid = fil.split(',')[0]
-                towrite = bytearray()
-                self.ftp.retrbinary('RETR ' + fil, towrite.extend)
-                toreturn.append((otherid, towrite))
-                # no deletion as it is also for other targets, but do not process again
-                self.alreadyProcessed.add(key)
-                if onlyOne:
-                    return toreturn
+        try:
+            self.poller.poll()
+            found = [] # (file name, other, delete)
+            for filename, (writer, reader, sid, number, modified, _size) in self.poller.entries():
+                if sid != str(self.sid) or number != 0 or not filename.endswith('.bin'):
+                    continue
+                if reader == self.me:
+                    # file is only for me, deleted
+                    found.append((filename, writer, True))
+                elif reader == self.TOFROMANY:
+                    # no deletion as it is also for other targets, but do not process again
+                    key = filename + str(modified)
+                    if key not in self.alreadyProcessed:
+                        self.alreadyProcessed.add(key)
+                        found.append((filename, writer, False))
+                if onlyOne and found:
+                    break
+            for filename, otherid, delete in found:
+                data = self.pool.run(self.retrieve, filename)
+                if data is None:
+                    continue
+                toreturn.append((otherid, data))
+                if delete:
+                    self.pool.run(self.remove, filename)
+        except ftplib.error_temp:
+            if self.pool.closed:
+                # stopped in the meantime
+                return toreturn
+            raise
         if toreturn:
             LOGGER.debug("Discovered messages for %s (session %s): %s", self.me, self.sid,
                          ", ".join('%s sent %s bytes' % (k, len(j)) for k, j in toreturn)
@@ -108,55 +529,175 @@ class FtpCommunicationSession(CommunicationSession):
     def deleteLastMessage(self):
         self.sent -= 1
         filename = self.FILENAMESTEMPLATE.format(**self.__dict__)
-        self.ftp.delete(filename)
+        self.pool.run(lambda ftp: ftp.delete(filename))
     
     def receiveRawChunk(self):
         '''Receives some data (one chunk)
         @return: None if no more data available, a bytes if data available (possibly empty)'''
         if self.closed:
             return None
-        filename = self.nextReceptionFileName
-        toreturn = b''
+        toreturn = self.takeChunk()
+        return b'' if toreturn is None else toreturn
+    
+    def receiveRawChunks(self, maximum=None):
+        '''Receives the chunks available with one listing of the folder (MLSD): the ones it shows are fetched,
+        in parallel, without asking the server again if they are there'''
+        if self.closed:
+            return []
         try:
-            fileexists = self.ftp.size(filename) is not None
-        except (ftplib.Error, AttributeError):
-            fileexists = False
-        if not fileexists:
-            LOGGER.debug("File %s doesn't exist.", filename)
-        if fileexists:
-            toreturn = bytearray()
-            self.ftp.retrbinary('RETR ' + filename, toreturn.extend)
-            self.ftp.delete(filename)
-            self.received += 1
+            self.poller.poll()
+        except ftplib.error_temp:
+            if self.pool.closed:
+                return []
+            raise
+        toreturn = []
+        while maximum is None or len(toreturn) < maximum:
+            try:
+                chunk = self.takeChunk(listedOnly=True)
+            except Exception as e:
+                if not toreturn:
+                    raise
+                # already counted as received: returned, the next call meets the error again
+                LOGGER.warning("Error after %s chunks of session %s, returning them: %s", len(toreturn), self.sid, e)
+                break
+            if chunk is None:
+                break
+            toreturn.append(chunk)
+            if chunk == self.data_to_close_session:
+                break
+        return toreturn
+    
+    def takeChunk(self, listedOnly=False):
+        '''@param listedOnly: if True, the chunk must be in the last listing, the folder is not listed again
+        @return: the next chunk, fetched if needed, None if not there'''
+        toreturn = self.fetchedChunks.pop(self.received, None)
+        if toreturn is None:
+            if listedOnly:
+                available = self.poller.isListed(self.nextReceptionFileName, self.streamOffset if self.streamMode else None)
+            else:
+                available = self.checkIfRawDataAvailable()
+            if not available:
+                LOGGER.debug("File %s doesn't exist.", self.nextReceptionFileName)
+                return None
+            self.fetchChunks()
+            toreturn = self.fetchedChunks.pop(self.received, None)
+            if toreturn is None:
+                return None
+        self.received += 1
         # remember to increase received!
-        return bytes(toreturn)
+        if self.streamMode and toreturn == self.data_to_close_session:
+            # nothing will be appended anymore
+            self.deleteStream()
+        return toreturn
+    
+    def receptionFileName(self, index):
+        return self.FILENAMERTEMPLATE.format(other=self.other, me=self.me, sid=self.sid, received=index)
+    
+    def fetchChunk(self, index):
+        '''Retrieves and deletes a chunk file
+        @return: its content, None if it is not there'''
+        filename = self.receptionFileName(index)
+        toreturn = self.pool.run(self.retrieve, filename)
+        if toreturn is not None:
+            # deleted in the background
+            self.poller.forget(filename)
+            self.reclaim(filename)
+        return toreturn
+    
+    def fetchChunks(self):
+        '''Retrieves the next chunk, and in parallel the following ones already listed (see fetchedChunks)'''
+        if self.streamMode:
+            return self.readStream()
+        indexes = [self.received]
+        while len(indexes) < self.parallelTransfers and self.receptionFileName(indexes[-1] + 1) in self.poller.files:
+            indexes.append(indexes[-1] + 1)
+        if len(indexes) == 1:
+            data = self.fetchChunk(self.received)
+            if data is not None:
+                self.fetchedChunks[self.received] = data
+            return
+        futures = [(index, self.executor().submit(self.fetchChunk, index)) for index in indexes]
+        error = None
+        for index, future in futures:
+            try:
+                data = future.result()
+            except Exception as e:
+                LOGGER.warning("Error while receiving chunk %s of session %s: %s", index, self.sid, e)
+                error = error or e
+                continue
+            if data is not None:
+                # kept even if a previous one failed, it is already deleted
+                self.fetchedChunks[index] = data
+        if error is not None and self.received not in self.fetchedChunks:
+            raise error
+    
+    def readStream(self):
+        '''Stream mode: reads the stream file from streamOffset, keeps the complete frames in fetchedChunks.
+        A frame being appended is read again next time.'''
+        filename = self.nextReceptionFileName
+        data = self.pool.run(self.retrieve, filename, self.streamOffset)
+        if data is None:
+            return
+        position, index, endOfFile = 0, self.received, False
+        header = self.FRAME_HEADER.size
+        while position + header <= len(data):
+            (length, ) = self.FRAME_HEADER.unpack_from(data, position)
+            if length == self.FRAME_END_OF_FILE:
+                position += header
+                endOfFile = True
+                break
+            if position + header + length > len(data):
+                break
+            self.fetchedChunks[index] = data[position + header:position + header + length]
+            index += 1
+            position += header + length
+        self.streamOffset += position
+        if endOfFile:
+            # completely read, the next chunks are in the next file
+            self.poller.forget(filename)
+            self.reclaim(filename)
+            self.streamReceived += 1
+            self.streamOffset = 0
+    
+    def deleteStream(self):
+        '''Stream mode: deletes the stream file being read'''
+        self.poller.forget(self.nextReceptionFileName)
+        self.reclaim(self.nextReceptionFileName)
+    
+    def releaseConsumed(self, identifiers):
+        '''Deletes consumed files (see reclaim), on one connection'''
+        def removeAll(ftp):
+            for filename in identifiers:
+                self.remove(ftp, filename)
+        self.pool.run(removeAll)
     
     def close(self, silently=False):
         super().close(silently)
-        self.ftp.__exit__()
+        if self.transferExecutor is not None:
+            self.transferExecutor.shutdown(wait=False)
+            self.transferExecutor = None
+        if self.ownPool:
+            self.pool.close()
 
 class FtpCommServer(CommunicationServer):
     
     CAPABILITYTEMPLATE = '{rid}.capa'
     
-    def __init__(self, rid, ftpFactory, share=False):
-        '''Initializes a server'''
+    def __init__(self, rid, ftpFactory, share=False, connections=POOL_SIZE, keepalive=KEEPALIVE_INTERVAL, **sessionOptions):
+        '''Initializes a server
+        @param share: if True, only one connection is used by all sessions
+        @param connections: maximum number of connections used by all the sessions (see FtpConnectionPool)
+        @param keepalive: time after which a free connection receives a NOOP
+        @param sessionOptions: given to each FtpCommunicationSession (parallelTransfers...)'''
         self.ftpFactory = ftpFactory
-        self.currentftp = None
         self.share = share
+        self.sessionOptions = sessionOptions
+        self.pool = FtpConnectionPool(ftpFactory, 1 if share else connections, keepalive)
+        self.poller = FtpPoller(self.pool)
         super().__init__(rid)
     
-    @property
-    def ftp(self):
-        try:
-            self.currentftp.pwd()
-            return self.currentftp
-        except:
-            self.currentftp = self.ftpFactory()
-            return self.currentftp
-        
     def createSession(self, cid, rid, sid):
-        return FtpCommunicationSession(rid, cid, sid, self.ftp if self.share else self.ftpFactory())
+        return FtpCommunicationSession(rid, cid, sid, self.pool, self.poller, **self.sessionOptions)
     
     @property
     def capabilityFile(self):
@@ -171,49 +712,55 @@ class FtpCommServer(CommunicationServer):
             towrite.extend(b'\n')
         LOGGER.info("Indicating capabilities of %s: %s bytes (%s capabilities)",
                     self.rid, len(towrite), len(self.capabilities))
-        self.ftp.storbinary('STOR ' + self.capabilityFile, BytesIO(towrite))
+        self.pool.run(lambda ftp: ftp.storbinary('STOR ' + self.capabilityFile, BytesIO(towrite)))
     
     def stop(self):
         LOGGER.info("Stopping server %s", self.rid)
         super().stop()
         try:
-            self.ftp.delete(self.capabilityFile)
+            self.pool.run(lambda ftp: ftp.delete(self.capabilityFile))
         except ftplib.Error as e:
             LOGGER.warning("File %s doesn't exist anymore: %s", self.capabilityFile, e)
-        self.ftp.__exit__()
+        self.pool.close()
 
 class FtpCommClient(CommunicationClient):
 
-    def __init__(self, cid, ftpFactory, share=False):
+    def __init__(self, cid, ftpFactory, share=False, connections=POOL_SIZE, keepalive=KEEPALIVE_INTERVAL, **sessionOptions):
+        '''@param share: if True, only one connection is used by all sessions
+        @param connections: maximum number of connections used by all the sessions (see FtpConnectionPool)
+        @param keepalive: time after which a free connection receives a NOOP
+        @param sessionOptions: given to each FtpCommunicationSession (parallelTransfers...)'''
         self.ftpFactory = ftpFactory
-        self.currentftp = None
         self.share = share
+        self.sessionOptions = sessionOptions
+        self.pool = FtpConnectionPool(ftpFactory, 1 if share else connections, keepalive)
+        self.poller = FtpPoller(self.pool)
         super().__init__(cid)
     
-    @property
-    def ftp(self):
-        try:
-            self.currentftp.pwd()
-            return self.currentftp
-        except:
-            self.currentftp = self.ftpFactory()
-            return self.currentftp
-    
     def createSession(self, cid, rid, sid):
-        return FtpCommunicationSession(cid, rid, sid, self.ftp if self.share or sid in (0, '0') else self.ftpFactory())
+        return FtpCommunicationSession(cid, rid, sid, self.pool, self.poller, **self.sessionOptions)
     
     def listServers(self):
         '''List the servers rid'''
         toreturn = []
-        for fil in self.ftp.nlst():
+        files = self.pool.run(lambda ftp: ftp.nlst())
+        for fil in files:
             if fnmatch.fnmatch(fil, FtpCommServer.CAPABILITYTEMPLATE.format(rid='*')):
                 toreturn.append(fil.split('.')[0])
         return toreturn
     
     def capabilities(self, rid):
         '''Check the capabilities of a server'''
-        towrite = bytearray()
-        self.ftp.retrbinary('RETR ' + FtpCommServer.CAPABILITYTEMPLATE.format(rid=rid), towrite.extend)
+        def retrieve(ftp):
+            towrite = bytearray()
+            ftp.retrbinary('RETR ' + FtpCommServer.CAPABILITYTEMPLATE.format(rid=rid), towrite.extend)
+            return towrite
+        towrite = self.pool.run(retrieve)
         return towrite.decode('utf-8', errors='replace').split()
+    
+    def close(self):
+        '''Closes the connections, the sessions cannot be used anymore'''
+        self.flushReclaims()
+        self.pool.close()
 
     
\ No newline at end of file
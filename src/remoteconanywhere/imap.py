@@ -5,8 +5,9 @@ Created on 21 avr. 2020
 
 @author: Cedric
 '''
-from remoteconanywhere.communication import CommunicationSession, CommunicationServer, CommunicationClient
-import os, logging, re, time
+from remoteconanywhere.communication import CommunicationSession, CommunicationServer, CommunicationClient, LOOP_SLEEP
+import os, logging, re, time, types, uuid
+from contextlib import contextmanager
 import imaplib
 
 from email.parser import BytesParser
@@ -20,11 +21,843 @@ LOGGER = logging.getLogger(os.path.basename(__file__).replace(".py", ""))
 # time before needing to restart connection
 RESTART_AFTER = 3600 # seconds
 
+# IDLE (RFC 2177) must be restarted before the server logs out an inactive client (30 minutes)
+IDLE_TIMEOUT = 29 * 60 # seconds
+# while IDLE works, searches are only done when notified, or after this time in case a notification is lost
+IDLE_FALLBACK_POLL = 30 # seconds
+# time before reconnecting after an error on the IDLE connection
+IDLE_RETRY_AFTER = 5 # seconds
+
+# consumed e-mails are flagged and expunged in batches, when there are this many of them...
+EXPUNGE_THRESHOLD = 32
+# ... or after this time
+EXPUNGE_INTERVAL = 5 # seconds
+
+# a connection that succeeded a command less than this time ago is not checked (NOOP) before use
+HEALTH_TTL = 30 # seconds
+# a connection replaced while being used by another thread is logged out after this time
+RETIRE_GRACE = 60 # seconds
+
+# the client reuses the servers and capabilities it found for this time before searching them again
+CAPABILITIES_TTL = 60 # seconds
+
+
+class ImapConnectionPool:
+    '''Connections to the IMAP server, checked only when unused for a while (HEALTH_TTL),
+    replaced after RESTART_AFTER by a new connection opened in the background, before the old one is logged out.
+    Some connections can be kept ready (prewarm) to be given to new sessions (see take).'''
+    
+    def __init__(self, clientfactory=None, size=1, healthTTL=HEALTH_TTL, prewarm=0, client=None):
+        '''@param clientfactory: creates the connections (see createImapClient), if None they are duplicated
+        @param size: maximum number of connections borrowed at the same time (see connection)
+        @param healthTTL: time after a successful command during which a connection is not checked
+        @param prewarm: number of connections kept ready for take()
+        @param client: a first connection'''
+        self.clientfactory = clientfactory
+        self.size = size
+        self.healthTTL = healthTTL
+        self.prewarm = prewarm
+        self.condition = threading.Condition()
+        self.clients = [] # all the connections that can be borrowed
+        self.free = [] # the ones not borrowed
+        self.opening = 0 # connections being opened
+        self.spares = [] # ready for take()
+        self.warming = 0
+        self.main = None # see client()
+        self.closed = False
+        self.renewCount = 0
+        self.noopCount = 0
+        if client is not None:
+            self.adopt(client)
+            self.clients.append(client)
+            self.free.append(client)
+        self.refillSpares()
+    
+    ################################################################# connections
+    @staticmethod
+    def adopt(client):
+        if not hasattr(client, 'lastSuccess'):
+            client.lastSuccess = time.time()
+        client.renewing = False
+        client.retired = False
+        return client
+    
+    def newClient(self):
+        '''Opens a new connection'''
+        if self.clientfactory is not None:
+            return self.adopt(self.clientfactory())
+        for client in list(self.clients) + [self.main]:
+            if client is not None and hasattr(client, 'duplicate'):
+                return self.adopt(client.duplicate())
+        raise imaplib.IMAP4.error("No way to open a new connection")
+    
+    def canRenew(self):
+        return self.clientfactory is not None or any(hasattr(client, 'duplicate') for client in self.clients + [self.main] if client)
+    
+    @staticmethod
+    def shutdown(client):
+        '''Logs out, ignoring the errors'''
+        try:
+            if client.state == 'SELECTED':
+                client.close()
+            client.logout()
+        except Exception as e:
+            LOGGER.debug("Error while closing connection: %s", e)
+    
+    def isHealthy(self, client):
+        '''Checks the connection with a NOOP, if it was not used successfully for healthTTL'''
+        if time.time() - client.lastSuccess < self.healthTTL:
+            return True
+        try:
+            self.noopCount += 1
+            client.noop()
+        except Exception as e:
+            LOGGER.debug("Connection not healthy: %s", e)
+            return False
+        client.lastSuccess = time.time()
+        return True
+    
+    def renewIfOld(self, client):
+        '''Opens in the background the replacement of an old connection'''
+        if client.renewing or time.time() - getattr(client, 'startingtime', time.time()) <= RESTART_AFTER or not self.canRenew():
+            return
+        client.renewing = True
+        LOGGER.info("Renewing a connection after %s hour", RESTART_AFTER/3600)
+        threading.Thread(target=self.renew, args=(client,), name="imap-renew", daemon=True).start()
+    
+    def renew(self, client):
+        try:
+            newclient = self.newClient()
+        except Exception as e:
+            LOGGER.warning("Unable to renew a connection: %s", e)
+            client.renewing = False
+            return
+        toclose = None
+        with self.condition:
+            self.renewCount += 1
+            client.retired = True
+            if self.main is client:
+                self.main = newclient
+                # maybe in use by another thread
+                timer = threading.Timer(RETIRE_GRACE, self.shutdown, args=(client,))
+                timer.daemon = True
+                timer.start()
+            elif client in self.clients:
+                self.clients[self.clients.index(client)] = newclient
+                self.free.append(newclient)
+                if client in self.free:
+                    self.free.remove(client)
+                    toclose = client
+                # else: closed when given back
+            else:
+                toclose = newclient
+            self.condition.notify()
+        if toclose is not None:
+            self.shutdown(toclose)
+    
+    def borrow(self):
+        '''@return: a connection for the exclusive use of the caller, to give back (see connection)'''
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise imaplib.IMAP4.abort("connection pool closed")
+                if self.free:
+                    client = self.free.pop()
+                    break
+                if len(self.clients) + self.opening < self.size:
+                    client = None
+                    self.opening += 1
+                    break
+                self.condition.wait()
+        if client is not None and not self.isHealthy(client):
+            self.discard(client, reopening=True)
+            client = None
+        if client is None:
+            try:
+                client = self.newClient()
+            finally:
+                with self.condition:
+                    self.opening -= 1
+            with self.condition:
+                self.clients.append(client)
+        self.renewIfOld(client)
+        return client
+    
+    def giveBack(self, client):
+        with self.condition:
+            if client.retired or client not in self.clients or self.closed:
+                if client in self.clients:
+                    self.clients.remove(client)
+                toclose = client
+            else:
+                self.free.append(client)
+                toclose = None
+            self.condition.notify()
+        if toclose is not None:
+            self.shutdown(toclose)
+    
+    def discard(self, client, reopening=False):
+        '''Forgets a broken connection'''
+        with self.condition:
+            if client in self.clients:
+                self.clients.remove(client)
+            if reopening:
+                self.opening += 1
+            self.condition.notify()
+        try:
+            client.shutdown()
+        except Exception:
+            pass
+    
+    @contextmanager
+    def connection(self):
+        '''Borrows a connection, a free one if possible'''
+        client = self.borrow()
+        try:
+            yield client
+        except (imaplib.IMAP4.abort, OSError):
+            self.discard(client)
+            raise
+        except BaseException:
+            self.giveBack(client)
+            raise
+        client.lastSuccess = time.time()
+        self.giveBack(client)
+    
+    def client(self):
+        '''@return: the main connection, not borrowed, for the occasional commands of a server or a client'''
+        with self.condition:
+            client = self.main
+        if client is None or not self.isHealthy(client):
+            if client is not None:
+                LOGGER.debug("Initializing a new connection")
+                try:
+                    client.shutdown()
+                except Exception:
+                    pass
+            client = self.newClient()
+            with self.condition:
+                self.main = client
+        self.renewIfOld(client)
+        # supposed successful, else checked next time
+        client.lastSuccess = time.time()
+        return client
+    
+    ################################################################# connections for the sessions
+    def take(self):
+        '''@return: a connection (pre-warmed if possible) given to the caller, that will close it'''
+        client = None
+        while client is None:
+            with self.condition:
+                client = self.spares.pop(0) if self.spares else None
+            if client is None:
+                client = self.newClient()
+            elif not self.isHealthy(client):
+                self.shutdown(client)
+                client = None
+        self.refillSpares()
+        client.renewing = client.retired = False
+        return client
+    
+    def refillSpares(self):
+        '''Opens in the background the connections missing for take()'''
+        with self.condition:
+            missing = self.prewarm - len(self.spares) - self.warming
+            if missing <= 0 or self.closed or not self.canRenew():
+                return
+            self.warming += missing
+        for _ in range(missing):
+            threading.Thread(target=self.warmUp, name="imap-prewarm", daemon=True).start()
+    
+    def warmUp(self):
+        try:
+            client = self.newClient()
+        except Exception as e:
+            LOGGER.warning("Unable to open a connection in advance: %s", e)
+            client = None
+        with self.condition:
+            self.warming -= 1
+            if client is not None and not self.closed:
+                self.spares.append(client)
+                client = None
+        if client is not None:
+            self.shutdown(client)
+    
+    def close(self):
+        with self.condition:
+            self.closed = True
+            toclose = self.free + self.spares + ([self.main] if self.main is not None else [])
+            self.clients = [client for client in self.clients if client not in self.free]
+            self.free, self.spares, self.main = [], [], None
+            self.condition.notify_all()
+        for client in toclose:
+            self.shutdown(client)
+
+
+class ImapDispatcher:
+    '''Connection(s) to the IMAP server shared by all the sessions of one endpoint.
+    One search per tick finds all the e-mails for this endpoint (or for anyone), which are then routed
+    to the sessions by their subject.'''
+    
+    # subject of the data e-mails, see ImapCommSession.EXPECTED_SUBJECT_SENT
+    SUBJECT_RX = re.compile(r"^(?P<other>.+)-(?P<sid>\d+)-(?P<me>.+)-Message-(?P<received>\d+)th$")
+    SUBJECT_HEADER_RX = re.compile(rb"(?im)^Subject:[ \t]*(.*(?:\r?\n[ \t].*)*)")
+    UID_RX = re.compile(rb"UID (\d+)")
+    EXISTS_RX = re.compile(rb"^\* (\d+) EXISTS", re.I)
+    STATUS_ITEM_RX = re.compile(rb"(UIDNEXT|UIDVALIDITY|MESSAGES|HIGHESTMODSEQ) (\d+)", re.I)
+    CHUNKS_HEADER_RX = re.compile(rb"(?im)^X-Remoteconanywhere-Chunks:[ \t]*(\d+)")
+    BINARY_PART_RX = re.compile(rb"BINARY\[(\d+)\]", re.I)
+    FETCH_ITEM_RX = re.compile(rb"([A-Z0-9.]+\[[^\]]*\](?:<\d+>)?) ~?\{\d+\}$", re.I)
+    HEADERS_TO_FETCH = '(BODY.PEEK[HEADER.FIELDS (SUBJECT X-REMOTECONANYWHERE-CHUNKS)])'
+    
+    def __init__(self, me, clientfactory=None, connections=1, pollInterval=LOOP_SLEEP, client=None, idle=False,
+                 expungeThreshold=EXPUNGE_THRESHOLD, expungeInterval=EXPUNGE_INTERVAL, mailbox=None, parent=None, pool=None):
+        '''@param clientfactory: creates the connections (see createImapClient)
+        @param connections: number of connections to the server (if no pool given)
+        @param pollInterval: minimum time between two searches
+        @param client: an existing connection to use, instead of the factory
+        @param idle: if True, an additional connection waits for notifications of new e-mails (IDLE),
+                     searches are then done only when notified
+        @param expungeThreshold: number of consumed e-mails triggering their deletion
+        @param expungeInterval: maximum time before the deletion of a consumed e-mail
+        @param mailbox: mailbox dedicated to one session (see forMailbox), None for the folder of the connections
+        @param parent: dispatcher whose connections are used
+        @param pool: the connections (see ImapConnectionPool), created if None'''
+        self.me = me
+        self.mailbox = mailbox
+        self.parent = parent
+        self.clientfactory = clientfactory
+        self.ownPool = pool is None and parent is None
+        if self.ownPool:
+            pool = ImapConnectionPool(clientfactory, connections, client=client)
+        #: :type pool: ImapConnectionPool
+        self.pool = pool
+        self.pollInterval = pollInterval
+        self.lastPoll = 0
+        self.pollLock = threading.Lock()
+        self.indexLock = threading.RLock()
+        self.index = dict() # subject => uid
+        self.subjects = dict() # uid => (other, sid, me, received) from the subject
+        self.chunks = dict() # uid => number of chunks, for the e-mails with octet-stream parts
+        # state of the mailbox: only the new e-mails are searched
+        self.uidValidity = None
+        self.lastUid = 0
+        self.mailboxSignature = None
+        self.skippedPolls = 0
+        self.closed = False
+        # IDLE
+        self.idleClient = None
+        self.idling = False
+        self.idleDoneSent = False
+        self.idleThread = None
+        self.changed = threading.Event()
+        # deferred deletions
+        self.expungeThreshold = expungeThreshold
+        self.expungeInterval = expungeInterval
+        self.pendingDeletions = set()
+        self.deletionLock = threading.Lock()
+        self.deletionTimer = None
+        self.deletedCount = 0
+        self.expungeCount = 0
+        if idle:
+            self.startIdle()
+    
+    ################################################################# connections
+    @contextmanager
+    def connection(self, select=True):
+        '''Borrows one of the connections, a free one if possible
+        @param select: if True, the mailbox of this dispatcher is selected on the connection'''
+        pool = self.parent.pool if self.parent is not None else self.pool
+        with pool.connection() as client:
+            if select:
+                self.selectMailbox(client)
+            yield client
+    
+    def mailboxOf(self, client):
+        '''@return: the name of the mailbox of this dispatcher'''
+        return self.mailbox or client.forceMailbox or 'INBOX'
+    
+    def selectMailbox(self, client):
+        '''Selects the mailbox of this dispatcher, if another one is selected on the connection'''
+        mailbox = self.mailboxOf(client)
+        if getattr(client, 'selectedMailbox', mailbox) != mailbox:
+            typ, response = client.select(mailbox)
+            if typ != 'OK':
+                raise client.error("Unable to select %s: %s" % (mailbox, response))
+            client.selectedMailbox = mailbox
+            # its EXISTS responses were consumed by the select (see selectedStatus)
+            client.selectionChanges = getattr(client, 'selectionChanges', 0) + 1
+    
+    ################################################################# dedicated mailboxes
+    def forMailbox(self, mailbox):
+        '''@return: a dispatcher for the e-mails of a mailbox dedicated to one session, using the same connections'''
+        return ImapDispatcher(self.me, pollInterval=self.pollInterval, expungeThreshold=self.expungeThreshold,
+                              expungeInterval=self.expungeInterval, mailbox=mailbox, parent=self)
+    
+    def createMailbox(self):
+        '''Creates the mailbox of this dispatcher, if it does not exist'''
+        with self.connection(select=False) as client:
+            typ, response = client.create(self.mailboxOf(client))
+        LOGGER.debug("Creation of mailbox %s: %s %s", self.mailbox, typ, response)
+    
+    def deleteMailbox(self):
+        '''Deletes the mailbox of this dispatcher, with all its e-mails'''
+        with self.deletionLock:
+            if self.deletionTimer is not None:
+                self.deletionTimer.cancel()
+                self.deletionTimer = None
+            self.pendingDeletions.clear()
+        with self.connection(select=False) as client:
+            mailbox = self.mailboxOf(client)
+            if getattr(client, 'selectedMailbox', None) == mailbox:
+                client.close()
+                client.selectedMailbox = None
+            typ, response = client.delete(mailbox)
+        LOGGER.debug("Deletion of mailbox %s: %s %s", mailbox, typ, response)
+    
+    @property
+    def anyClient(self):
+        '''One of the connections, for its parameters only'''
+        with self.connection(select=False) as client:
+            return client
+    
+    def close(self):
+        self.closed = True
+        self.stopIdling()
+        if self.idleThread is not None:
+            self.idleThread.join(5)
+        self.flushDeletions()
+        if self.ownPool:
+            self.pool.close()
+    
+    ################################################################# index
+    @classmethod
+    def parseFetch(cls, response):
+        '''Parses the response of a UID FETCH of one item for several e-mails
+        @return: dict uid => bytes of the item'''
+        toreturn = dict()
+        data = None
+        for portion in response:
+            if isinstance(portion, tuple):
+                data = portion[1]
+                muid = cls.UID_RX.search(portion[0])
+            elif isinstance(portion, bytes) and data is not None:
+                # the UID may be sent after the item
+                muid = cls.UID_RX.search(portion)
+            else:
+                continue
+            if muid:
+                toreturn[muid.group(1).decode()] = data
+                data = None
+        return toreturn
+    
+    @classmethod
+    def parseFetchItems(cls, response):
+        '''Parses the response of a UID FETCH of several items for several e-mails
+        @return: dict uid => dict item name (upper case) => bytes of the item'''
+        toreturn = dict()
+        uid = None
+        items = dict()
+        for portion in response:
+            line = portion[0] if isinstance(portion, tuple) else portion
+            if not isinstance(line, bytes):
+                continue
+            muid = cls.UID_RX.search(line)
+            if muid:
+                uid = muid.group(1).decode()
+            if isinstance(portion, tuple):
+                mitem = cls.FETCH_ITEM_RX.search(line)
+                if mitem:
+                    items[mitem.group(1).upper()] = portion[1]
+            elif line.rstrip().endswith(b')'):
+                # end of the e-mail
+                if uid is not None:
+                    toreturn[uid] = items
+                uid = None
+                items = dict()
+        return toreturn
+    
+    @classmethod
+    def headerSubject(cls, header):
+        '''@return: the subject in the header, None if not found'''
+        msubject = cls.SUBJECT_HEADER_RX.search(header)
+        if msubject:
+            subject = re.sub(rb"\r?\n[ \t]", b" ", msubject.group(1)).strip()
+            return subject.decode('utf-8', errors='replace')
+        return None
+    
+    @classmethod
+    def parseSubjects(cls, response):
+        '''Parses the response of a fetch of the subjects
+        @return: dict uid => subject'''
+        toreturn = dict()
+        for uid, header in cls.parseFetch(response).items():
+            subject = cls.headerSubject(header)
+            if subject is not None:
+                toreturn[uid] = subject
+        return toreturn
+    
+    @classmethod
+    def parseBinaryParts(cls, response):
+        '''Parses the response of a fetch of BINARY[n] parts of one e-mail
+        @return: dict part number => bytes'''
+        toreturn = dict()
+        for portion in response:
+            if isinstance(portion, tuple):
+                for number in cls.BINARY_PART_RX.findall(portion[0])[-1:]:
+                    toreturn[int(number)] = portion[1]
+        return toreturn
+    
+    def poll(self, force=False):
+        '''Searches for the new e-mails for this endpoint, at most once per pollInterval,
+        or only when notified if IDLE is running'''
+        if self.closed:
+            return
+        with self.pollLock:
+            sincelast = time.time() - self.lastPoll
+            if not force:
+                if self.idling and not self.changed.is_set() and sincelast < IDLE_FALLBACK_POLL:
+                    return
+                if sincelast < self.pollInterval:
+                    return
+            self.changed.clear()
+            try:
+                with self.connection(select=False) as client:
+                    if getattr(client, 'selectedMailbox', self.mailboxOf(client)) == self.mailboxOf(client):
+                        status = self.selectedStatus(client)
+                    else:
+                        status = self.mailboxStatus(client)
+                    if status is not None and status == self.mailboxSignature:
+                        # nothing changed since last search
+                        self.lastPoll = time.time()
+                        self.skippedPolls += 1
+                        return
+                    self.selectMailbox(client)
+                    newuids, deleted, lastUid = self.searchChanges(client, status)
+                    headers = dict()
+                    if newuids:
+                        _typ, response = client.uid('fetch', newuids, self.HEADERS_TO_FETCH)
+                        headers = self.parseFetch(response)
+            except Exception as e:
+                if not self.closed:
+                    LOGGER.warning("While checking for e-mail, got error: %s", e)
+                return
+            self.lastPoll = time.time()
+            self.mailboxSignature = status
+            self.lastUid = lastUid
+            with self.indexLock:
+                for uid in deleted:
+                    # deleted by someone else
+                    self.forget(uid)
+                for uid, header in headers.items():
+                    if uid in self.subjects or uid in self.pendingDeletions:
+                        continue
+                    subject = self.headerSubject(header)
+                    m = self.SUBJECT_RX.match(subject) if subject else None
+                    if not m or m.group('me') not in (self.me, CommunicationSession.TOFROMANY):
+                        continue
+                    if subject in self.index:
+                        LOGGER.warning("More than one e-mail correspond to %s", subject)
+                        continue
+                    self.index[subject] = uid
+                    self.subjects[uid] = m.group('other', 'sid', 'me', 'received')
+                    mchunks = self.CHUNKS_HEADER_RX.search(header)
+                    if mchunks:
+                        self.chunks[uid] = int(mchunks.group(1))
+            if headers:
+                LOGGER.debug("Dispatcher for %s found %s new e-mails", self.me, len(headers))
+    
+    def mailboxStatus(self, client):
+        '''@return: (UIDVALIDITY, UIDNEXT, MESSAGES, HIGHESTMODSEQ) of the mailbox, None if unknown'''
+        items = 'UIDVALIDITY UIDNEXT MESSAGES'
+        if 'CONDSTORE' in client.capabilities:
+            # also changes when flags change
+            items += ' HIGHESTMODSEQ'
+        try:
+            typ, response = client.status(self.mailboxOf(client), '(%s)' % items)
+        except client.error as e:
+            LOGGER.debug("STATUS not possible: %s", e)
+            return None
+        if typ != 'OK' or not response or not response[0]:
+            return None
+        values = {key.upper(): int(value) for key, value in self.STATUS_ITEM_RX.findall(response[-1])}
+        return (values.get(b'UIDVALIDITY'), values.get(b'UIDNEXT'), values.get(b'MESSAGES'), values.get(b'HIGHESTMODSEQ'))
+    
+    def selectedStatus(self, client):
+        '''STATUS is not to be used on the selected mailbox (RFC 3501), some servers answer cached values:
+        its changes are given by the untagged responses of a NOOP (EXISTS, EXPUNGE, FETCH)
+        @return: (UIDVALIDITY, None, None, changes of the selection on this connection)'''
+        typ, _response = client.noop()
+        changed = typ != 'OK'
+        for code in ('EXISTS', 'EXPUNGE', 'FETCH', 'RECENT'):
+            _typ, data = client.response(code)
+            changed = changed or data[-1] is not None
+        _typ, data = client.response('UIDVALIDITY')
+        if data[-1] is not None:
+            # given by the last select
+            client.selectedUidValidity = int(data[-1])
+        if changed:
+            client.selectionChanges = getattr(client, 'selectionChanges', 0) + 1
+        return (getattr(client, 'selectedUidValidity', None), None, None,
+                (id(client), getattr(client, 'selectionChanges', 0)))
+    
+    def searchChanges(self, client, status):
+        '''Searches the e-mails arrived since the last search, and the known e-mails that disappeared
+        @return: (set of new uids to fetch, set of deleted uids, last uid seen)'''
+        if status is not None and status[0] is not None and status[0] != self.uidValidity:
+            if self.uidValidity is not None:
+                LOGGER.warning("UIDVALIDITY of mailbox changed, all e-mails are searched again")
+                with self.indexLock:
+                    self.index.clear()
+                    self.subjects.clear()
+            self.uidValidity = status[0]
+            self.lastUid = 0
+        if self.mailbox is not None and status is not None and status[1]:
+            # dedicated mailbox: all the new e-mails are for the session, no need to search them
+            newuids = None
+            if status[1] - 1 > self.lastUid:
+                newuids = '%d:%d' % (self.lastUid + 1, status[1] - 1)
+            return newuids, self.searchDeleted(client), max(self.lastUid, status[1] - 1)
+        search = ['NOT DELETED', 'OR',
+                  'HEADER', 'Subject', '-%s-Message-' % self.me,
+                  'HEADER', 'Subject', '-%s-Message-' % CommunicationSession.TOFROMANY]
+        if self.lastUid:
+            search[:0] = ['UID', '%d:*' % (self.lastUid + 1)]
+        _typ, uids = client.uid('search', *search)
+        uids = set(uids[0].decode().split()) if uids and uids[0] else set()
+        # n:* always contains the last e-mail, even if older
+        newuids = {uid for uid in uids if int(uid) > self.lastUid}
+        lastUid = self.lastUid
+        if status is not None and status[1]:
+            lastUid = max(lastUid, status[1] - 1)
+        elif newuids:
+            lastUid = max(lastUid, max(int(uid) for uid in newuids))
+        # consumed but not yet deleted
+        newuids.difference_update(self.pendingDeletions)
+        newuids.difference_update(self.subjects)
+        return ",".join(sorted(newuids, key=int)), self.searchDeleted(client), lastUid
+    
+    def searchDeleted(self, client):
+        '''@return: the known e-mails that are not there anymore'''
+        known = sorted(self.subjects, key=int)
+        if not known:
+            return set()
+        _typ, stillthere = client.uid('search', 'UID', ",".join(known), 'NOT DELETED')
+        stillthere = set(stillthere[0].decode().split()) if stillthere and stillthere[0] else set()
+        return set(known).difference(stillthere)
+    
+    ################################################################# IDLE
+    def startIdle(self):
+        if self.clientfactory is None:
+            LOGGER.warning("IDLE needs a client factory, polling only.")
+            return
+        self.idleThread = threading.Thread(target=self.idleLoop, name="imap-idle-%s" % self.me, daemon=True)
+        self.idleThread.start()
+    
+    def idleLoop(self):
+        '''Waits for notifications on a dedicated connection, until closed'''
+        client = None
+        while not self.closed:
+            try:
+                if client is not None and time.time() - client.startingtime > RESTART_AFTER:
+                    LOGGER.info("Reconnection of IDLE connection after %s hour", RESTART_AFTER/3600)
+                    client = client.renew()
+                if client is None:
+                    client = self.clientfactory()
+                if 'IDLE' not in client.capabilities:
+                    LOGGER.info("IMAP server does not support IDLE, polling only.")
+                    break
+                self.idleOnce(client)
+            except Exception as e:
+                self.idling = False
+                if self.closed:
+                    break
+                LOGGER.warning("Error on IDLE connection, retrying in %ss: %s", IDLE_RETRY_AFTER, e)
+                try:
+                    client.shutdown()
+                except Exception:
+                    pass
+                client = None
+                time.sleep(IDLE_RETRY_AFTER)
+        self.idling = False
+        if client is not None:
+            try:
+                client.logout()
+            except Exception as e:
+                LOGGER.debug("Error while closing IDLE connection: %s", e)
+    
+    def idleOnce(self, client):
+        '''One IDLE command, until timeout (IDLE_TIMEOUT) or close'''
+        tag = client._new_tag()
+        self.idleDoneSent = False
+        self.idleClient = client
+        client.send(tag + b' IDLE\r\n')
+        line = client._get_line()
+        if not line.startswith(b'+'):
+            raise client.error("IDLE refused: %r" % line)
+        self.idling = True
+        # in case a message arrived before IDLE
+        self.changed.set()
+        timer = threading.Timer(IDLE_TIMEOUT, self.stopIdling)
+        timer.daemon = True
+        timer.start()
+        try:
+            while True:
+                line = client._get_line()
+                if line.startswith(tag):
+                    break
+                if self.EXISTS_RX.match(line):
+                    LOGGER.debug("IDLE notification for %s: %r", self.me, line)
+                    self.changed.set()
+                    # immediate search, the sessions will find the e-mails in the index
+                    self.poll()
+        finally:
+            timer.cancel()
+            self.idling = False
+            client.tagged_commands.pop(tag, None)
+        if not line.startswith(tag + b' OK'):
+            raise client.error("IDLE ended with %r" % line)
+    
+    def stopIdling(self):
+        '''Ends the current IDLE command'''
+        client = self.idleClient
+        if client is not None and self.idling and not self.idleDoneSent:
+            self.idleDoneSent = True
+            try:
+                client.send(b'DONE\r\n')
+            except Exception as e:
+                LOGGER.debug("Unable to stop IDLE: %s", e)
+    
+    def forget(self, uid):
+        with self.indexLock:
+            self.chunks.pop(uid, None)
+            if self.subjects.pop(uid, None) is not None:
+                for subject, indexeduid in list(self.index.items()):
+                    if indexeduid == uid:
+                        del self.index[subject]
+    
+    def find(self, subject, poll=True):
+        '''@param poll: if False, only the e-mails already indexed are considered
+        @return: the uid of the e-mail with the given subject, None if not found'''
+        uid = self.index.get(subject)
+        if uid is None and poll:
+            self.poll()
+            uid = self.index.get(subject)
+        return uid
+    
+    def chunkCount(self, uid):
+        '''@return: the number of chunks in the e-mail, None if it is a text e-mail'''
+        return self.chunks.get(uid)
+    
+    def entries(self):
+        '''@return: list of (uid, (other, sid, me, received)) of the known e-mails'''
+        with self.indexLock:
+            return list(self.subjects.items())
+    
+    ################################################################# operations
+    def fetch(self, uid):
+        with self.connection() as client:
+            typ, resp = client.uid('fetch', uid, '(RFC822)')
+        LOGGER.debug("Fetch response: %s %r", typ, resp)
+        return resp
+    
+    def fetchMany(self, uids, item='RFC822'):
+        '''Fetches several e-mails with one command
+        @return: dict uid => bytes of the item'''
+        if not uids:
+            return dict()
+        with self.connection() as client:
+            typ, resp = client.uid('fetch', ",".join(uids), '(%s)' % item)
+        LOGGER.debug("Fetch response for %s e-mails: %s", len(uids), typ)
+        return self.parseFetch(resp)
+    
+    def fetchBinaryParts(self, uid, count):
+        '''Fetches the decoded parts 1..count of an e-mail, with one command (needs BINARY)
+        @return: list of bytes'''
+        items = " ".join('BINARY.PEEK[%d]' % number for number in range(1, count + 1))
+        with self.connection() as client:
+            typ, resp = client.uid('fetch', uid, '(%s)' % items)
+        parts = self.parseBinaryParts(resp)
+        if typ != 'OK' or len(parts) != count:
+            raise ValueError("Unable to fetch %s parts of e-mail %s: %s %r" % (count, uid, typ, resp))
+        return [parts[number] for number in range(1, count + 1)]
+    
+    def delete(self, uid, immediately=False):
+        '''Delete an used e-mail from the server, later (see expungeThreshold and expungeInterval)
+        @param immediately: if True, all pending deletions are done now'''
+        LOGGER.debug("Delete e-mail uid %s", uid)
+        self.forget(uid)
+        with self.deletionLock:
+            self.pendingDeletions.add(uid)
+            flush = immediately or len(self.pendingDeletions) >= self.expungeThreshold
+            if not flush and self.deletionTimer is None:
+                self.deletionTimer = threading.Timer(self.expungeInterval, self.flushDeletions)
+                self.deletionTimer.daemon = True
+                self.deletionTimer.start()
+        if flush:
+            self.flushDeletions()
+    
+    def flushDeletions(self):
+        '''Flags and expunges all the consumed e-mails'''
+        with self.deletionLock:
+            if self.deletionTimer is not None:
+                self.deletionTimer.cancel()
+                self.deletionTimer = None
+            uids = sorted(self.pendingDeletions, key=int)
+            if not uids:
+                return
+            uidset = ",".join(uids)
+            try:
+                with self.connection() as client:
+                    client.uid('store', uidset, r'+FLAGS.SILENT (\Deleted)')
+                    if 'UIDPLUS' in client.capabilities:
+                        # only ours, not the ones flagged by someone else
+                        client.uid('expunge', uidset)
+                    else:
+                        client.expunge()
+            except Exception as e:
+                LOGGER.warning("Unable to delete %s e-mails: %s", len(uids), e)
+                return
+            self.pendingDeletions.difference_update(uids)
+            self.deletedCount += len(uids)
+            self.expungeCount += 1
+        LOGGER.debug("Deleted %s e-mails", len(uids))
+    
+    def append(self, maildata, binary=False):
+        '''Appends an e-mail to the mailbox, created if it does not exist
+        @param maildata: the e-mail, or a list of e-mails appended with one command (needs MULTIAPPEND)
+        @param binary: if True, the e-mail is sent as is in a literal8 (needs BINARY)'''
+        with self.connection(select=False) as client:
+            mailbox = self.mailboxOf(client)
+            typ, response = self.appendTo(client, mailbox, maildata, binary)
+            if typ == 'NO' and self.mailbox is not None and b'TRYCREATE' in b' '.join(r for r in response if r).upper():
+                # the other side did not create it yet
+                client.create(mailbox)
+                typ, response = self.appendTo(client, mailbox, maildata, binary)
+            return typ, response
+    
+    @staticmethod
+    def appendTo(client, mailbox, maildata, binary):
+        maildatas = maildata if isinstance(maildata, list) else [maildata]
+        if not binary and len(maildatas) == 1:
+            return client.append(mailbox, None, None, maildata)
+        # imaplib.append would change the line endings, and knows neither literal8 nor several e-mails:
+        # each literal is followed by the announce of the next one
+        announce = '~{%d}' if binary else '{%d}'
+        literals = iter([data + b' ' + (announce % len(following)).encode() for data, following in zip(maildatas, maildatas[1:])]
+                        + maildatas[-1:])
+        def literal(_self, _continuation):
+            return next(literals)
+        client.literal = types.MethodType(literal, client)
+        return client._simple_command('APPEND', mailbox, announce % len(maildatas[0]))
+    
+    def supports(self, capability):
+        '''@return: True if the server has the capability'''
+        return capability in self.anyClient.capabilities
 
-# TODO: Imap with only one IMAP client that dispatch data to queues of sessions
 
 class ImapCommSession(CommunicationSession):
-    '''CommunicationSession that has its own connection to the server'''
+    '''CommunicationSession using a connection to the server, shared or not (see ImapDispatcher)'''
     
     EXPECTED_SUBJECT_SENT = "{me}-{sid}-{other}-Message-{sent}th"
     # = "[{me}-{sid}-{other}] Message {received}"
@@ -41,60 +874,177 @@ class ImapCommSession(CommunicationSession):
     HEADER_SUBJECT = 'Subject'
     HEADER_FROM = 'From'
     HEADER_TO = 'To'
+    HEADER_CHUNKS = 'X-Remoteconanywhere-Chunks'
     
-    APPENDUID_RX = re.compile(r"(?i)APPENDUID\s+(?P<uidstatus>\d+)\s+(?P<uid>\d+)")
+    # mailbox of a session (see ownMailbox), the same for both sides
+    SESSION_MAILBOX = "{folder}-{first}-{second}-{sid}"
+    
+    PART_HEADER = b"Content-Type: application/octet-stream\r\nContent-Transfer-Encoding: %s\r\n\r\n"
+    PART_HEADER_BASE64 = PART_HEADER % b"base64"
+    PART_HEADER_BINARY = PART_HEADER % b"binary"
+    
+    # a uid set after a MULTIAPPEND
+    APPENDUID_RX = re.compile(r"(?i)APPENDUID\s+(?P<uidstatus>\d+)\s+(?:[\d:,]*[:,])?(?P<uid>\d+)")
 
     def subject2from(self, subject):
         return subject.split('-%s-' % self.sid)[0]
     
-    def __init__(self, me, other, sid, imapclient):
-        ''''@type imapclient: imaplib.IMAP4'''
-        super().__init__(me, other, sid)
-        #: :type imapclient: imaplib.IMAP4
-        self.imapclient = imapclient
-        self.cacheSubject = dict()
+    def __init__(self, me, other, sid, imapclient, dispatcher=None, binary=False, packChunks=1, ownMailbox=False, reclaimJournal=None):
+        '''@type imapclient: imaplib.IMAP4
+        @param dispatcher: the ImapDispatcher shared with other sessions, if None one is created around imapclient
+        @param binary: if True, the chunks are sent as application/octet-stream parts, without base64 encoding
+                       if the server supports it (BINARY)
+        @param packChunks: maximum number of chunks of one send() packed in one multipart e-mail
+        @param ownMailbox: if True, the e-mails of the session are in a mailbox created for it (see SESSION_MAILBOX),
+                           deleted when the session is closed
+        @param reclaimJournal: the ReclaimJournal of the consumed e-mails not deleted yet, not used with ownMailbox
+                               (uids of another mailbox)'''
+        super().__init__(me, other, sid, None if ownMailbox else reclaimJournal)
+        if sid == 0 or sid == '0':
+            # read by discover() from every peer
+            binary, packChunks, ownMailbox = False, 1, False
+        self.binary = binary
+        self.packChunks = packChunks
+        self.pendingChunks = [] # received in a multipart e-mail, not yet returned
+        self.headerTemplate = None # see mailHeader
+        self.ownMailbox = ownMailbox
+        self.peerClosed = False
+        mailbox = None
+        if ownMailbox:
+            folder = (imapclient or dispatcher.anyClient).forceMailbox or 'INBOX'
+            first, second = sorted([me, other])
+            mailbox = self.SESSION_MAILBOX.format(folder=folder, first=first, second=second, sid=sid)
+        self.ownDispatcher = dispatcher is None
+        if dispatcher is None:
+            dispatcher = ImapDispatcher(me, client=imapclient, pollInterval=0, mailbox=mailbox)
+        elif ownMailbox:
+            dispatcher = dispatcher.forMailbox(mailbox)
+        #: :type dispatcher: ImapDispatcher
+        self.dispatcher = dispatcher
+        if ownMailbox:
+            self.dispatcher.createMailbox()
         self.lastSentMessageUid = None
+        self.stagedUids = dict() # chunk number => uid of its e-mail, until published (see stageUnit)
         self.processed = set()
-        self.imapLock = threading.RLock()
-         
+        # one e-mail per chunk appended on several connections at the same time (see sendUnits)
+        self.sendWorkers = (dispatcher.parent or dispatcher).pool.size
+        self.recoverReclaims()
     
     def deleteLastMessage(self):
         self.sent -= 1
         if self.lastSentMessageUid is not None:
-            self.deleteemail(self.lastMessageUid)
+            self.dispatcher.delete(self.lastSentMessageUid, immediately=True)
     
-    def sendUnit(self, data):
-        '''Send some data'''
-        mime = MIMEText(self.data2payload(data))
-        subject = self.EXPECTED_SUBJECT_SENT.format(**self.__dict__)
-        mime[self.HEADER_SUBJECT] = subject
-        mime[self.HEADER_FROM] = self.imapclient.forceHeaderFrom if self.imapclient.forceHeaderFrom else self.me + self.SUFFIX_EMAIL
-        mime[self.HEADER_TO] = self.imapclient.forceHeaderTo if self.imapclient.forceHeaderTo else self.other + self.SUFFIX_EMAIL
-        
-        maildata = mime.as_bytes(POLICY)
-        # test parsing:
-        self.PARSER.parsebytes(maildata) # FIXME: remove me
-        
-        LOGGER.debug("Mail data of size %s to send: %s", len(maildata), "not displayable" if len(maildata) > 2000 else maildata)
-        with self.imapLock:
-            typ, response = self.imapclient.append(self.imapclient.forceMailbox, None, None, maildata)
+    def sendUnits(self, units):
+        '''Send several chunks, packChunks per e-mail (see sendMails), or one e-mail per chunk appended
+        in parallel when they are not packed and cannot be sent with one APPEND (see sendUnitsStaged)'''
+        if (len(units) > 1 and self.packChunks <= 1 and self.sendWorkers > 1
+                and not self.dispatcher.supports('MULTIAPPEND')):
+            # the e-mails can be there in any order, the other side reads them by their number
+            return self.sendUnitsStaged(units)
+        pack = max(1, self.packChunks)
+        self.sendMails([units[i:i+pack] for i in range(0, len(units), pack)])
+    
+    def mailHeader(self, count, first):
+        '''@return: the header of an e-mail with count chunks, the first one being number first'''
+        if self.headerTemplate is None:
+            # computed once, only the numbers change
+            client = self.dispatcher.anyClient
+            subject = self.EXPECTED_SUBJECT_SENT.format(me=self.me.replace('%', '%%'), sid=self.sid,
+                                                        other=self.other.replace('%', '%%'), sent='%d')
+            self.headerTemplate = ("%s: %s\r\n%s: %s\r\n%s: %s\r\nMIME-Version: 1.0\r\n%s: %%d\r\n" % (
+                self.HEADER_FROM, client.forceHeaderFrom if client.forceHeaderFrom else self.me + self.SUFFIX_EMAIL,
+                self.HEADER_TO, client.forceHeaderTo if client.forceHeaderTo else self.other + self.SUFFIX_EMAIL,
+                self.HEADER_SUBJECT, subject, self.HEADER_CHUNKS)).encode()
+        return self.headerTemplate % (first, count)
+    
+    def sendChunks(self, chunks):
+        '''Send some chunks in one e-mail, one application/octet-stream part per chunk'''
+        self.sendMails([chunks])
+    
+    def sendMails(self, packs):
+        '''Send e-mails of chunks (see sendChunks), all with one APPEND if the server supports MULTIAPPEND
+        @param packs: list of lists of chunks, one per e-mail'''
+        binary = self.binary and self.dispatcher.supports('BINARY')
+        if len(packs) > 1 and self.dispatcher.supports('MULTIAPPEND'):
+            first, maildatas = self.sent, []
+            for chunks in packs:
+                maildatas.append(self.mailData(chunks, first, binary))
+                first += len(chunks)
+            self.appendMail(maildatas, binary)
+            LOGGER.debug("Sent %s e-mails of %s chunks (%s, last uid: %s)", len(packs), first - self.sent, "binary" if binary else "base64", self.lastSentMessageUid)
+            self.sent = first
+            return
+        for chunks in packs:
+            self.appendMail(self.mailData(chunks, self.sent, binary), binary)
+            LOGGER.debug("Sent %s chunks (%s, uid: %s)", len(chunks), "binary" if binary else "base64", self.lastSentMessageUid)
+            self.sent += len(chunks)
+    
+    def mailData(self, chunks, first, binary):
+        '''@return: the e-mail of the chunks, the first one being number first'''
+        if binary:
+            partheader = self.PART_HEADER_BINARY
+            body = lambda chunk: chunk
+        else:
+            partheader = self.PART_HEADER_BASE64
+            body = lambda chunk: base64.encodebytes(chunk).replace(b'\n', b'\r\n')
+        header = self.mailHeader(len(chunks), first)
+        if len(chunks) == 1:
+            maildata = header + partheader + body(chunks[0])
+        else:
+            boundary = uuid.uuid4().hex.encode()
+            while binary and any(boundary in chunk for chunk in chunks):
+                boundary = uuid.uuid4().hex.encode()
+            parts = [header + b'Content-Type: multipart/mixed; boundary="%s"\r\n\r\n' % boundary]
+            for chunk in chunks:
+                parts.append(b'--' + boundary + b'\r\n' + partheader + body(chunk) + b'\r\n')
+            parts.append(b'--' + boundary + b'--\r\n')
+            maildata = b''.join(parts)
+        return maildata
+    
+    def appendMail(self, maildata, binary=False, record=True):
+        '''@param maildata: the e-mail, or a list of e-mails (see ImapDispatcher.append)
+        @param record: if True, the uid of the (last) e-mail becomes lastSentMessageUid
+        @return: the uid of the (last) e-mail, None if the server does not give it'''
+        if isinstance(maildata, list):
+            LOGGER.debug("%s e-mails of size %s to send", len(maildata), sum(len(data) for data in maildata))
+        else:
+            LOGGER.debug("Mail data of size %s to send: %s", len(maildata), "not displayable" if len(maildata) > 2000 else maildata)
+        typ, response = self.dispatcher.append(maildata, binary)
         LOGGER.debug("Response from imap server to append: %s %r", typ, response)
         if typ != 'OK':
             LOGGER.warning("Seemed to not being able to send data: %r", maildata)
             raise ValueError("%s" % response)
+        uid = None
         if "APPENDUID" in response[0].upper().decode():
             m = self.APPENDUID_RX.search(response[0].decode())
             if m:
-                self.lastSentMessageUid = m.group("uid")
-        LOGGER.debug("Sent data %s: (uid: %s)", "of size %s " % len(data) if len(data) > 50 else data, self.lastSentMessageUid)
-        self.sent += 1
-        
-        # test if e-mail possible to be fetched:
-        #mail = self.receiveEmail(self.lastSentMessageUid, False)
-        #if mail is None:
-        #    LOGGER.warn("E-mail cannot be retreived")
-        #else:
-        #    LOGGER.debug("Verification of sent e-mail: %s", self.payload2data(mail.get_payload()))
+                uid = m.group("uid")
+                if record:
+                    self.lastSentMessageUid = uid
+        return uid
+    
+    def stageUnit(self, number, data):
+        '''Appends the e-mail of one chunk, its uid recorded by publishUnit, in order'''
+        binary = self.binary and self.dispatcher.supports('BINARY')
+        self.stagedUids[number] = self.appendMail(self.mailData([data], number, binary), binary, record=False)
+    
+    def publishUnit(self, number):
+        uid = self.stagedUids.pop(number, None)
+        if uid is not None:
+            self.lastSentMessageUid = uid
+    
+    def discardUnit(self, number):
+        '''Deletes the e-mail of a chunk of a failed send, its subject is used again by the next one'''
+        uid = self.stagedUids.pop(number, None)
+        if uid is None:
+            LOGGER.warning("Uid of chunk %s of session %s unknown, its e-mail is not deleted", number, self.sid)
+            return
+        self.dispatcher.delete(uid, immediately=True)
+    
+    def sendUnit(self, data):
+        '''Send some data'''
+        self.sendChunks([data])
 
     
     def payload2data(self, payload):
@@ -105,11 +1055,14 @@ class ImapCommSession(CommunicationSession):
     
         
     def deleteemail(self, uid):
-        """Delete an used e-mail from the server"""
-        LOGGER.debug("Delete e-mail uid %s", uid)
-        with self.imapLock:
-            _typ, _resp = self.imapclient.uid('store', uid, r'+FLAGS.SILENT \Deleted')
-            self.imapclient.expunge()
+        """Delete an used e-mail from the server, in the background (see reclaim)"""
+        self.dispatcher.forget(uid)
+        self.reclaim(uid)
+    
+    def releaseConsumed(self, identifiers):
+        '''Deletes consumed e-mails (see reclaim), flagged and expunged by batch by the dispatcher'''
+        for uid in identifiers:
+            self.dispatcher.delete(uid)
     
     @classmethod
     def extractEmailContentFromResponseHelper(cls, response):
@@ -132,77 +1085,44 @@ class ImapCommSession(CommunicationSession):
     def nextSubjectToReceive(self):
         return self.EXPECTED_SUBJECT_RECEIVED.format(**self.__dict__)
     
-    def checkIfDataAvailable(self):
+    def checkIfRawDataAvailable(self):
         '''Returns True if a new chunk is available, False otherwise'''
-        #: :type client: imaplib.IMAP4
-        client = self.imapclient
-        subject = self.nextSubjectToReceive
-        if subject in self.cacheSubject:
-            return True# = uidstofetch
-        othersearch = ["HEADER", "Subject", subject, "NOT DELETED"
-                       ]
-        LOGGER.debug("Searching for emails that contains %s", othersearch)
-        with self.imapLock:
-            try:
-                _typ, uids = client.uid('search', *othersearch)
-            except Exception as e:
-                LOGGER.warning("While checking for e-mail, got error: %s", e)
-                uids = None
-        if not uids or not uids[0]:
-            LOGGER.debug("Nothing found.")
-            return False
-        uidstofetch = uids[0].decode().split()
-        
-        if len(uidstofetch) > 1:
-            LOGGER.warning("More than one e-mail correspond to the search")
-        
-        self.cacheSubject[subject] = uidstofetch
-        
-        return True
+        return bool(self.pendingChunks) or self.dispatcher.find(self.nextSubjectToReceive) is not None
     
     def discover(self, onlyOne=False):
         '''@return a list of [('other', b'data')]'''
         toreturn = []
-        #: :type client: imaplib.IMAP4
-        client = self.imapclient
-        
-        uptime = time.time() - client.startingtime
-        LOGGER.debug("Uptime of connection sid=%s: %s", self.sid, uptime)
-        if uptime > RESTART_AFTER:
-            LOGGER.info("Reconnection after %s hour", RESTART_AFTER/3600)
-            self.imapclient = client = client.renew()
-        
-        for delete, subjectbefore, subjectafter in [
-            [True] + self.nextSubjectToReceive.split(self.other),
-            [False] + self.EXPECTED_SUBJECT_SENT.format(**self.__dict__).split(self.me)]:
-            search = ['NOT DELETED']
-            if len(subjectbefore) > 2:
-                search += ["HEADER", "Subject", subjectbefore]
-            if len(subjectafter) > 2:
-                search += ["HEADER", "Subject", subjectafter]
-            LOGGER.debug("Searching for emails that contains %s", search)
-            with self.imapLock:
-                _typ, uids = client.uid('search', *search)
-            if not uids[0]:
-                LOGGER.debug("Nothing found.")
+        self.dispatcher.poll()
+        found = [] # (uid, other, delete)
+        for uid, (other, sid, me, received) in self.dispatcher.entries():
+            if sid != str(self.sid) or received != '0':
                 continue
-            uidstofetch = uids[0].decode().split()
-            
-            LOGGER.debug("%s corresponding e-mail found!", len(uidstofetch))
-            for uid in uidstofetch:
-                if uid in self.processed:
-                    continue
-                if not delete:
-                    self.processed.add(uid)
+            if me == self.me:
                 # read it, delete it
-                message = self.receiveEmail(uid, delete)
-                
-                subject = message['Subject']
-                data = self.payload2data(message.get_payload())
-                toreturn.append((self.subject2from(subject), data))
-                if onlyOne:
-                    return toreturn
-        LOGGER.info("Discovery loop found %s data", len(toreturn))
+                found.append((uid, other, True))
+            elif me == self.TOFROMANY:
+                # for everybody, do not process again
+                if uid not in self.processed:
+                    found.append((uid, other, False))
+            if onlyOne and found:
+                break
+        # all e-mails at once: only the text of ours, the whole e-mail otherwise
+        ours = {uid for uid, _other, _delete in found if self.dispatcher.chunkCount(uid) == 1}
+        texts = self.dispatcher.fetchMany(sorted(ours, key=int), 'BODY.PEEK[TEXT]')
+        mails = self.dispatcher.fetchMany([uid for uid, _other, _delete in found if uid not in ours])
+        for uid, other, delete in found:
+            if uid not in texts and uid not in mails:
+                LOGGER.warning("E-mail %s disappeared", uid)
+                continue
+            if delete:
+                self.deleteemail(uid)
+            else:
+                self.processed.add(uid)
+            chunks = [base64.b64decode(texts[uid])] if uid in texts else self.mailToChunks(mails[uid])
+            for data in chunks:
+                toreturn.append((other, data))
+        if toreturn:
+            LOGGER.info("Discovery loop found %s data", len(toreturn))
         return toreturn
     
     
@@ -211,21 +1131,91 @@ class ImapCommSession(CommunicationSession):
         @return: None if no more data available, a bytes if data available (possibly empty)'''
         if self.closed:
             return None
-        if not self.checkIfDataAvailable():
+        if self.pendingChunks:
+            return self.pendingChunks.pop(0)
+        uid = self.dispatcher.find(self.nextSubjectToReceive)
+        if uid is None:
             return b''
-        subject = self.nextSubjectToReceive
-        uidstofetch = self.cacheSubject[subject]
-        del self.cacheSubject[subject]
-        
-        uid = uidstofetch[0]
-        self.received += 1
-        return self.receiveEmailAsData(uid)
+        count = self.dispatcher.chunkCount(uid)
+        if count is None:
+            self.received += 1
+            return self.receiveEmailAsData(uid)
+        chunks = self.receiveChunks(uid, count)
+        self.received += len(chunks)
+        self.pendingChunks.extend(chunks[1:])
+        return chunks[0]
+    
+    def receiveRawChunks(self, maximum=None):
+        '''Receives the chunks available: the following e-mails already indexed are received too, the ones
+        of one chunk with one UID FETCH for all of them'''
+        if self.closed:
+            return []
+        toreturn = []
+        while self.pendingChunks and (maximum is None or len(toreturn) < maximum):
+            toreturn.append(self.pendingChunks.pop(0))
+        if maximum is not None and len(toreturn) >= maximum:
+            return toreturn
+        try:
+            found = [] # (uid, chunk count)
+            number = self.received
+            uid = self.dispatcher.find(self.nextSubjectToReceive)
+            while uid is not None and (maximum is None or len(toreturn) + len(found) < maximum):
+                count = self.dispatcher.chunkCount(uid)
+                found.append((uid, count))
+                number += count or 1
+                uid = self.dispatcher.find(self.EXPECTED_SUBJECT_RECEIVED.format(other=self.other, sid=self.sid, me=self.me, received=number), poll=False)
+            binary = self.dispatcher.supports('BINARY')
+            singles = [uid for uid, count in found if count == 1]
+            bodies = self.dispatcher.fetchMany(singles, 'BINARY.PEEK[1]' if binary else 'BODY.PEEK[TEXT]') if len(singles) > 1 else dict()
+            for uid, count in found:
+                if uid in bodies:
+                    chunks = [bodies[uid] if binary else base64.b64decode(bodies[uid])]
+                    self.deleteemail(uid)
+                elif count is None:
+                    chunks = [self.receiveEmailAsData(uid)]
+                else:
+                    chunks = self.receiveChunks(uid, count)
+                self.received += len(chunks)
+                toreturn.extend(chunks)
+        except Exception as e:
+            if not toreturn:
+                raise
+            # already counted as received: returned, the next call meets the error again
+            LOGGER.warning("Error after %s chunks of session %s, returning them: %s", len(toreturn), self.sid, e)
+        if maximum is not None:
+            # already counted as received
+            toreturn, self.pendingChunks = toreturn[:maximum], toreturn[maximum:]
+        return toreturn
+    
+    def receiveChunks(self, uid, count, delete=True):
+        '''Receives the chunks of an e-mail with octet-stream parts (see sendChunks)'''
+        if self.dispatcher.supports('BINARY'):
+            # decoded by the server
+            chunks = self.dispatcher.fetchBinaryParts(uid, count)
+        elif count == 1:
+            # one base64 part: no need to parse the e-mail
+            text = self.dispatcher.fetchMany([uid], 'BODY.PEEK[TEXT]').get(uid)
+            if text is None:
+                raise ValueError("Unable to fetch e-mail %s" % uid)
+            chunks = [base64.b64decode(text)]
+        else:
+            # parsed by the email package
+            chunks = self.mailToChunks(self.extractEmailContentFromResponse(self.dispatcher.fetch(uid)))
+        if delete:
+            self.deleteemail(uid)
+        return chunks
+    
+    def mailToChunks(self, maildata):
+        '''@return: the chunks of data in an e-mail, text or with octet-stream parts'''
+        message = self.PARSER.parsebytes(maildata)
+        if message[self.HEADER_CHUNKS] is None:
+            return [self.payload2data(message.get_payload())]
+        parts = message.get_payload() if message.is_multipart() else [message]
+        return [part.get_payload(decode=True) for part in parts]
 
     def receiveEmail(self, uid, delete=True):
         # fetch e-mail
-        with self.imapLock:
-            typ, resp = self.imapclient.uid('fetch', uid, '(RFC822)')
-        LOGGER.debug("Fetch response: %s %r", typ, resp)
+        resp = self.dispatcher.fetch(uid)
         if delete:
             self.deleteemail(uid)
         return self.PARSER.parsebytes(self.extractEmailContentFromResponse(resp))
@@ -243,11 +1233,34 @@ class ImapCommSession(CommunicationSession):
         # remember to increase received!
         return data
     
+    def receiveChunk(self):
+        wasclosed = self.closed
+        toreturn = super().receiveChunk()
+        if self.closed and not wasclosed:
+            # the other side closed the session
+            self.peerClosed = True
+        return toreturn
+    
+    def receiveAvailable(self, maximum=None):
+        wasclosed = self.closed
+        toreturn = super().receiveAvailable(maximum)
+        if self.closed and not wasclosed:
+            # the other side closed the session
+            self.peerClosed = True
+        return toreturn
+    
     def close(self, silently=False):
         CommunicationSession.close(self, silently=silently)
-        with self.imapLock:
-            self.imapclient.close()
-            self.imapclient.logout()
+        if self.dispatcher.closed:
+            return
+        if self.ownMailbox and (self.peerClosed or silently):
+            # the other side will not read it anymore
+            try:
+                self.dispatcher.deleteMailbox()
+            except Exception as e:
+                LOGGER.warning("Unable to delete mailbox %s: %s", self.dispatcher.mailbox, e)
+        if self.ownDispatcher or self.ownMailbox:
+            self.dispatcher.close()
         
 
 
@@ -302,6 +1315,7 @@ def createImapClient(hostname, port=None, ssl=True, tls=False, credmanager=Crede
     client.forceHeaderFrom = None
     client.forceHeaderTo = None
     client.forceMailbox = folder
+    client.selectedMailbox = folder or 'INBOX'
     client.login = login
     client.startingtime = time.time()
     
@@ -311,7 +1325,11 @@ def createImapClient(hostname, port=None, ssl=True, tls=False, credmanager=Crede
         newclient = createImapClient(hostname, port, ssl, tls, credmanager, folder, login)
         return newclient
     
+    def duplicate():
+        return createImapClient(hostname, port, ssl, tls, credmanager, folder, login)
+    
     client.renew = renew
+    client.duplicate = duplicate
     
     return client
 
@@ -324,39 +1342,31 @@ class Imap4CommServer(CommunicationServer):
         ind = self.SUBJECT_CAPABILITY.index('{rid}')
         return subject[ind:-2]
     
-    def __init__(self, rid, clientfactory, share=False):
-        '''Initializes a server'''
+    def __init__(self, rid, clientfactory, share=False, connections=1, idle=False, prewarm=0, **sessionOptions):
+        '''Initializes a server
+        @param share: if True, all sessions share the same connections (see ImapDispatcher)
+        @param connections: number of shared connections
+        @param idle: if True (and share), wait for notifications of the server instead of polling
+        @param prewarm: number of connections opened in advance for the new sessions (if not share)
+        @param sessionOptions: options of the sessions (see ImapCommSession)'''
         self.clientfactory = clientfactory
-        #: :type currentclient: imaplib.IMAP4
-        self.currentclient = None
+        self.sessionOptions = sessionOptions
+        #: :type pool: ImapConnectionPool
+        self.pool = ImapConnectionPool(clientfactory, prewarm=0 if share else prewarm)
         
         self.share = share
+        self.dispatcher = ImapDispatcher(rid, clientfactory, connections, idle=idle) if share else None
         super().__init__(rid)
     
     @property
     def imapclient(self):
-        # restart client after 1 hour
-        if self.currentclient is not None:
-            uptime = time.time() - self.currentclient.startingtime
-            LOGGER.debug("Uptime of server connection: %s", uptime)
-            if uptime > RESTART_AFTER:
-                LOGGER.info("Reconnection after %s hour", RESTART_AFTER/3600)
-                self.currentclient.close()
-                self.currentclient.logout()
-                self.currentclient = None
-        
-        # test connection
-        try:
-            self.currentclient.noop()
-        except:
-            LOGGER.debug("Initializing a new connection")
-            # new connection
-            self.currentclient = self.clientfactory()
-            
-        return self.currentclient
+        '''The connection of the server, checked only if not used for a while (see ImapConnectionPool)'''
+        return self.pool.client()
     
     def createSession(self, cid, rid, sid):
-        return ImapCommSession(rid, cid, sid, self.currentclient if self.share else self.clientfactory())
+        if self.share:
+            return ImapCommSession(rid, cid, sid, None, self.dispatcher, **self.sessionOptions)
+        return ImapCommSession(rid, cid, sid, self.pool.take(), **self.sessionOptions)
     
     
     def removeCapabilities(self, shouldexist=False):
@@ -393,6 +1403,19 @@ class Imap4CommServer(CommunicationServer):
             responses.add(typ)
         LOGGER.info("Cleaned %s e-mails: %s", len(uidstofetch), responses)
         client.expunge()
+        self.cleanUpMailboxes()
+    
+    def cleanUpMailboxes(self):
+        '''Deletes the mailboxes of the sessions of this server (see ImapCommSession.ownMailbox)'''
+        client = self.imapclient
+        _typ, mailboxes = client.list(pattern='%s-*' % (client.forceMailbox or 'INBOX'))
+        for line in mailboxes or []:
+            if not line:
+                continue
+            name = line.decode().rsplit(' ', 1)[-1].strip('"')
+            if '-%s-' % self.rid in name:
+                LOGGER.info("Deleting mailbox %s", name)
+                client.delete(name)
     
     def showCapabilities(self):
         '''Show the capabilities (and that I'm alive)'''
@@ -422,85 +1445,104 @@ class Imap4CommServer(CommunicationServer):
         super().stop()
         # remove capabilities e-mail
         self.removeCapabilities()
-        if self.currentclient is not None:
-            self.currentclient.close()
-            self.currentclient.logout()
+        self.pool.close()
+        if self.dispatcher is not None:
+            self.dispatcher.close()
+        else:
+            self.discoverySession.close()
 
 
 class Imap4CommClient(CommunicationClient):
+    
+    # what is needed of the capability e-mails: the subject gives the rid, the text the capabilities
+    CAPABILITY_ITEMS = '(BODY.PEEK[HEADER.FIELDS (SUBJECT CONTENT-TYPE CONTENT-TRANSFER-ENCODING)] BODY.PEEK[TEXT])'
 
-    def __init__(self, cid, clientfactory, share=False):
+    def __init__(self, cid, clientfactory, share=False, connections=1, idle=False, prewarm=0, **sessionOptions):
+        '''@param share: if True, all sessions share the same connections (see ImapDispatcher)
+        @param connections: number of shared connections
+        @param idle: if True (and share), wait for notifications of the server instead of polling
+        @param prewarm: number of connections opened in advance for the new sessions (if not share)
+        @param sessionOptions: options of the sessions (see ImapCommSession)'''
         self.clientfactory = clientfactory
-        self.currentclient = None
-        self.share = share # TODO: use me?
+        self.sessionOptions = sessionOptions
+        #: :type pool: ImapConnectionPool
+        self.pool = ImapConnectionPool(clientfactory, prewarm=0 if share else prewarm)
+        self.share = share
+        self.dispatcher = ImapDispatcher(cid, clientfactory, connections, idle=idle) if share else None
+        # uid of the capability e-mail => (rid, capabilities), see knownServers
+        self.capabilityMails = dict()
+        self.capabilityMailsChecked = 0
+        self.capabilityMailsLock = threading.Lock()
         super().__init__(cid)
 
     
     @property
     def imapclient(self):
-        # restart client after 1 hour
-        if self.currentclient is not None:
-            uptime = time.time() - self.currentclient.startingtime
-            LOGGER.debug("Uptime of client connection: %s", uptime)
-            if uptime > RESTART_AFTER:
-                LOGGER.info("Reconnection after %s hour", RESTART_AFTER/3600)
-                self.currentclient.close()
-                self.currentclient.logout()
-                self.currentclient = None
-        
-        try:
-            self.currentclient.noop()
-        except Exception as e:
-            LOGGER.debug("Initializing a new connection because %s", e)
-            # new connection
-            self.currentclient = self.clientfactory()
-        return self.currentclient
+        '''The connection of the client, checked only if not used for a while (see ImapConnectionPool)'''
+        return self.pool.client()
 
 
     def createSession(self, cid, rid, sid):
-        return ImapCommSession(cid, rid, sid, self.clientfactory())
+        if self.share:
+            return ImapCommSession(cid, rid, sid, None, self.dispatcher, **self.sessionOptions)
+        return ImapCommSession(cid, rid, sid, self.pool.take(), **self.sessionOptions)
+    
+    def knownServers(self, force=False):
+        '''Finds the servers with their capabilities, at most once per CAPABILITIES_TTL.
+        Only the capability e-mails not seen before (new uid) are fetched, all in one command.
+        @param force: if True, search even if the last search is recent
+        @return: dict rid => set of capabilities, ordered by registration'''
+        with self.capabilityMailsLock:
+            if force or time.time() - self.capabilityMailsChecked >= CAPABILITIES_TTL:
+                self.searchCapabilityMails()
+            toreturn = dict()
+            for uid in sorted(self.capabilityMails, key=int):
+                rid, capabilities = self.capabilityMails[uid]
+                if rid in toreturn:
+                    LOGGER.warning("More than one capability e-mail for rid %s", rid)
+                toreturn.setdefault(rid, set()).update(capabilities)
+            return toreturn
+    
+    def searchCapabilityMails(self):
+        '''Updates capabilityMails with one search, and one fetch of the new capability e-mails'''
+        subject = Imap4CommServer.SUBJECT_CAPABILITY.split('{rid}')[0]
+        client = self.imapclient
+        _typ, uids = client.uid('search', 'NOT DELETED', 'HEADER', 'Subject', subject)
+        uids = uids[0].decode().split() if uids and uids[0] else []
+        # the servers that stopped or registered again have a new uid
+        self.capabilityMails = {uid: self.capabilityMails[uid] for uid in uids if uid in self.capabilityMails}
+        uidstofetch = [uid for uid in uids if uid not in self.capabilityMails]
+        if uidstofetch:
+            typ, resp = client.uid('fetch', ",".join(uidstofetch), self.CAPABILITY_ITEMS)
+            LOGGER.debug("Fetching capability emails %s: %s %r", uidstofetch, typ, resp)
+            for uid, items in ImapDispatcher.parseFetchItems(resp).items():
+                header = b''.join(data for item, data in items.items() if item.startswith(b'BODY[HEADER'))
+                text = items.get(b'BODY[TEXT]', b'')
+                subject = ImapDispatcher.headerSubject(header)
+                if not subject or not subject.endswith(Imap4CommServer.SUBJECT_CAPABILITY[-2:]):
+                    continue
+                message = ImapCommSession.PARSER.parsebytes(header.rstrip(b'\r\n') + b'\r\n\r\n' + text)
+                payload = message.get_payload(decode=True) or b''
+                self.capabilityMails[uid] = (Imap4CommServer.subjectToRid(Imap4CommServer, subject),
+                                             set(payload.decode('utf-8', errors='replace').split()))
+        self.capabilityMailsChecked = time.time()
     
     def listServers(self):
         '''List the servers rid'''
-        # TODO: do it
-        toreturn = []
-        subject = Imap4CommServer.SUBJECT_CAPABILITY.split('{rid}')[0]
-        _typ, uids = self.imapclient.uid('search', 'NOT DELETED', 'HEADER', 'Subject', subject)
-        if not uids[0]:
-            # nothing to do
-            LOGGER.warn("No server is registered")
-            return toreturn
-        uidstofetch = uids[0].decode().split()
-        client = self.currentclient
-        for uid in uidstofetch:
-            typ, resp = client.uid('fetch', uid, '(RFC822)')
-            LOGGER.debug("Fetching capability email %s for name: %s %r", uid, typ, resp)
-            message = ImapCommSession.PARSER.parsebytes(ImapCommSession.extractEmailContentFromResponse(resp))
-            subject = message[ImapCommSession.HEADER_SUBJECT]
-            rid = Imap4CommServer.subjectToRid(Imap4CommServer, subject)
-            toreturn.append(rid)
+        toreturn = list(self.knownServers())
+        if not toreturn:
+            LOGGER.warning("No server is registered")
         return toreturn
     
     def capabilities(self, rid):
         '''Check the capabilities of a server'''
-        subject = Imap4CommServer.SUBJECT_CAPABILITY.format(rid=rid)
-        _typ, uids = self.imapclient.uid('search', 'NOT DELETED', 'HEADER', 'Subject', subject)
-        if not uids[0]:
-            # nothing to do
-            LOGGER.warn("No server named %s is registered", rid)
+        servers = self.knownServers()
+        if rid not in servers:
+            # registered since the last search?
+            servers = self.knownServers(force=True)
+        if rid not in servers:
+            LOGGER.warning("No server named %s is registered", rid)
             return []
-        uidstofetch = uids[0].decode().split()
-        client = self.currentclient
-        if len(uidstofetch) > 1:
-            LOGGER.warning("More than one capability e-mail for rid %s: %s", rid, uidstofetch)
-        toreturn = set()
-        for uid in uidstofetch:
-            typ, resp = client.uid('fetch', uid, '(RFC822)')
-            LOGGER.debug("Fetching capability email %s (rid %s) for capabilities: %s %r", uid, rid, typ, resp)
-            message = ImapCommSession.PARSER.parsebytes(ImapCommSession.extractEmailContentFromResponse(resp))
-            #subject = message[ImapCommSession.HEADER_SUBJECT]
-            #rid = Imap4CommServer.subjectToRid(Imap4CommServer, subject)
-            toreturn.update(message.get_payload().split())
-        return list(toreturn)
+        return list(servers[rid])
     
     
@@ -6,7 +6,7 @@ Created on 10 avr. 2020
 @author: Cedric
 '''
 
-from remoteconanywhere.communication import ActionServer, CommunicationSession
+from remoteconanywhere.communication import ActionServer, CommunicationSession, SEND_BATCH
 import threading
 import time
 import socket
@@ -68,6 +68,7 @@ class GenericTcpSocketActionServer(ActionServer):
         LOGGER.info("Session %s is now in loop", session.sid)
         continuing = True
         tosendtosession = bytearray()
+        batch = [] # full messages not sent yet
         while continuing:
             # read from socket
             r , _, _ = select([sock],[],[], 0.001) #timeout
@@ -82,31 +83,33 @@ class GenericTcpSocketActionServer(ActionServer):
                 else:
                     tosendtosession.extend(data)
                     if len(tosendtosession) + 1024 > session.maxdatalength:
-                        #LOGGER.debug("Size already too big: %s, sending...", len(tosendtosession))
-                        sendwhatisstored = True
+                        #LOGGER.debug("Size already too big: %s, keeping it for the batch...", len(tosendtosession))
+                        batch.append(HEADER_NORMAL + tosendtosession)
+                        tosendtosession.clear()
+                        sendwhatisstored = len(batch) >= SEND_BATCH
             else:
                 #if tosendtosession: LOGGER.debug("No more data in select, sending...")
                 sendwhatisstored = True
             if sendwhatisstored and tosendtosession:
-                session.send(HEADER_NORMAL + tosendtosession)
+                batch.append(HEADER_NORMAL + tosendtosession)
                 tosendtosession.clear()
-            # read from session
+            if sendwhatisstored and batch:
+                session.sendMany(batch)
+                batch = []
+            # read from session, all that is available
             if session.checkIfDataAvailable():
-                data = session.receiveChunk()
-                if data is not None:
-                    if data:
-                        if data.startswith(HEADER_NORMAL):
-                            toforward = data[len(HEADER_NORMAL):]
-                            sock.send(toforward)
-                        elif data.startswith(HEADER_STOP):
-                            sock.close()
-                            continuing = False
-                        else:
-                            LOGGER.warning("Unknown message received: %r", data)
-                    else:
-                        # no data received? Strange
-                        pass
-                else:
+                chunks = session.receiveAvailable()
+                for data in chunks or []:
+                    if data.startswith(HEADER_NORMAL):
+                        toforward = data[len(HEADER_NORMAL):]
+                        sock.send(toforward)
+                    elif data.startswith(HEADER_STOP):
+                        sock.close()
+                        continuing = False
+                        break
+                    elif data:
+                        LOGGER.warning("Unknown message received: %r", data)
+                if continuing and session.closed:
                     sock.close()
                     continuing = False
         LOGGER.info("Session %s is terminated", session.sid)
@@ -11,7 +11,7 @@ Created on 17 avr. 2020
 @author: Cedric
 '''
 
-from remoteconanywhere.communication import ActionServer
+from remoteconanywhere.communication import ActionServer, SEND_BATCH
 import threading
 import time
 import socket
@@ -58,20 +58,25 @@ class Socks4FrontEnd():
                     continue
                 try:
                     while s.checkIfDataAvailable():
-                        chunk = s.receiveChunk()
-                        if chunk:
+                        chunks = s.receiveAvailable()
+                        if not chunks:
+                            # closing connection from other point
+                            break
+                        tosend = bytearray()
+                        for chunk in chunks:
                             if chunk.startswith(self.HEADER_DATA) and len(chunk) > len(self.HEADER_DATA):
-                                # transmit data to connection
-                                try:
-                                    tosend = chunk[len(self.HEADER_DATA):]
-                                    LOGGER.debug("Sending to socket some data from sid=%s: %s", s.sid, tosend)
-                                    c.sendall(tosend)
-                                except:
-                                    s.close()
-                                    c.close()
-                            else:
+                                tosend += chunk[len(self.HEADER_DATA):]
+                            elif chunk:
                                 LOGGER.warning("Unable to process message %s", chunk)
-                        # closing connection from other point
+                        if tosend:
+                            # transmit data to connection, all the chunks at once
+                            try:
+                                LOGGER.debug("Sending to socket some data from sid=%s: %s", s.sid, tosend)
+                                c.sendall(tosend)
+                            except:
+                                s.close()
+                                c.close()
+                                break
                 except Exception as e:
                     if s.closed:
                         # normal
@@ -242,6 +247,7 @@ class Socks5FrontEnd(Socks4FrontEnd):
 
 def transmitDataBetween(session, connection, info=None, rest=None):
     tosend = bytearray()
+    batch = [] # full messages not sent yet
     if rest:
         LOGGER.debug("Sending immediately some data left after socks identification to %s: %r", info, rest)
         connection.sendall(rest)
@@ -262,31 +268,39 @@ def transmitDataBetween(session, connection, info=None, rest=None):
             LOGGER.debug("Receiving something on socket %s: %r", info, data)
             tosend.extend(data)
             if len(tosend) + Socks4FrontEnd.BLOCK_SIZE > session.maxdatalength:
-                LOGGER.debug("Sending back %r to session  %s", data, info)
-                session.send(Socks4FrontEnd.HEADER_DATA + tosend)
+                batch.append(Socks4FrontEnd.HEADER_DATA + tosend)
                 tosend.clear()
+                if len(batch) >= SEND_BATCH:
+                    LOGGER.debug("Sending back %s messages to session %s", len(batch), info)
+                    session.sendMany(batch)
+                    batch = []
         else:
             if tosend:
-                LOGGER.debug("Sending back %r to session %s as no more data", tosend, info)
-                session.send(Socks4FrontEnd.HEADER_DATA + tosend)
+                batch.append(Socks4FrontEnd.HEADER_DATA + tosend)
                 tosend.clear()
+            if batch:
+                LOGGER.debug("Sending back %s messages to session %s as no more data", len(batch), info)
+                session.sendMany(batch)
+                batch = []
         while session.checkIfDataAvailable():
-            data = session.receiveChunk()
-            if data is None:
+            chunks = session.receiveAvailable()
+            if not chunks:
                 # end of communication
                 break
-            LOGGER.debug("Receiving something on session %s: %r, sending it immediately", info, data)
-            if data.startswith(Socks4FrontEnd.HEADER_DATA):
-                try:
-                    connection.sendall(data[len(Socks4FrontEnd.HEADER_DATA):])
-                except:
-                    LOGGER.warning("Error while sending data:", exc_info=1)
-                    break
+            LOGGER.debug("Receiving %s chunks on session %s, sending them immediately", len(chunks), info)
+            try:
+                connection.sendall(b''.join(data[len(Socks4FrontEnd.HEADER_DATA):] for data in chunks
+                                            if data.startswith(Socks4FrontEnd.HEADER_DATA)))
+            except:
+                LOGGER.warning("Error while sending data:", exc_info=1)
+                break
     LOGGER.info("End of communication between sid=%s and %s", session.sid, info)
     if tosend:
-        LOGGER.debug("Sending back %r to session %s when closing connection", data, info)
-        session.send(Socks4FrontEnd.HEADER_DATA + tosend)
+        batch.append(Socks4FrontEnd.HEADER_DATA + tosend)
         tosend.clear()
+    if batch:
+        LOGGER.debug("Sending back %s messages to session %s when closing connection", len(batch), info)
+        session.sendMany(batch)
     connection.close()
     if not session.closed:
         session.close()
@@ -0,0 +1,400 @@
+'''
+In-process FTP stand-in server, for tests and benchmarks of the ftp module without a real FTP server.
+
+It implements only what the ftp module needs: USER, PASS, SYST, FEAT, OPTS, TYPE, PWD, CWD, MKD, PASV, EPSV,
+STOR, APPE, RETR, REST, SIZE, NLST, MLSD, DELE, RNFR, RNTO, NOOP, QUIT, over a directory of the local disk.
+
+A latency can be injected before each response, globally or by command, to simulate a distant server.
+Commands received are counted in commandCounts. dropConnections() closes all the control connections,
+as a server does after an idle timeout. dropOn(command) closes the connection receiving the next command,
+before running it or after running it without answering.
+
+Usage:
+    server = FtpStandInServer(rootdir, latency=0.01)
+    server.start()
+    ftp = ftplib.FTP()
+    ftp.connect('127.0.0.1', server.port)
+    ...
+    server.stop()
+
+Created on 19 oct. 2026
+
+@author: Cedric
+'''
+
+import os
+import socket
+import socketserver
+import threading
+import time
+import logging
+from collections import Counter
+
+LOGGER = logging.getLogger("ftp_standin")
+
+FEATURES = ['MLST type*;size*;modify*;', 'SIZE', 'REST STREAM', 'EPSV', 'PASV']
+
+DATA_TIMEOUT = 10 # seconds to wait for the client on the data connection
+
+
+class FtpError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class FtpStandInServer:
+    '''FTP server serving rootdir, with injected latency'''
+
+    def __init__(self, rootdir, host='127.0.0.1', port=0, latency=0., users=None):
+        '''@param latency: seconds before each response, or dict command => seconds (key None for the others)
+        @param users: dict login => password accepted, None to accept everybody'''
+        self.rootdir = os.path.realpath(rootdir)
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.users = users
+        self.commandCounts = Counter()
+        self.drops = dict() # command => True to drop after running it, False before
+        self.countsLock = threading.Lock()
+        self.connections = set()
+        self.server = None
+        self.thread = None
+
+    ################################################################# life cycle
+    def start(self):
+        '''Starts the server in a thread, @return the port'''
+        standin = self
+
+        class Handler(FtpStandInConnection):
+            server_standin = standin
+
+        self.server = socketserver.ThreadingTCPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name="ftp-standin", daemon=True)
+        self.thread.start()
+        LOGGER.info("FTP stand-in listening on %s:%s for %s", self.host, self.port, self.rootdir)
+        return self.port
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.dropConnections()
+        self.thread.join(5)
+        self.server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, _exc_type, _exc_val, _exc_tb):
+        self.stop()
+        return False
+
+    def resetCounts(self):
+        with self.countsLock:
+            self.commandCounts.clear()
+
+    def count(self, command):
+        with self.countsLock:
+            self.commandCounts[command] += 1
+
+    def dropConnections(self):
+        '''Closes the control connections, as after an idle timeout'''
+        for connection in list(self.connections):
+            connection.drop()
+
+    def dropOn(self, command, after=False):
+        '''Closes the control connection receiving the next command, as a server restarting in the middle of an operation
+        @param after: if True, the command is run but not answered'''
+        with self.countsLock:
+            self.drops[command] = after
+
+    def takeDrop(self, command):
+        '''@return: None if the connection must not be dropped, else the after parameter of dropOn'''
+        with self.countsLock:
+            return self.drops.pop(command, None)
+
+    def latencyOf(self, command):
+        if isinstance(self.latency, dict):
+            return self.latency.get(command, self.latency.get(None, 0.))
+        return self.latency
+
+
+class FtpStandInConnection(socketserver.StreamRequestHandler):
+    '''One control connection'''
+    server_standin = None
+
+    def setup(self):
+        super().setup()
+        self.standin = self.server_standin
+        self.standin.connections.add(self)
+        self.cwd = '/'
+        self.user = None
+        self.logged = False
+        self.passive = None
+        self.restart = 0
+        self.renameFrom = None
+        self.dropped = False
+        self.muted = False
+
+    def finish(self):
+        self.standin.connections.discard(self)
+        self.closePassive()
+        try:
+            super().finish()
+        except OSError:
+            pass
+
+    def drop(self):
+        self.dropped = True
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def reply(self, code, message):
+        if self.muted:
+            return
+        self.wfile.write(("%s %s\r\n" % (code, message)).encode('utf-8'))
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            self.reply(220, "FTP stand-in ready")
+            while not self.dropped:
+                line = self.rfile.readline()
+                if not line:
+                    break
+                line = line.decode('utf-8', errors='replace').rstrip('\r\n')
+                command, _sep, argument = line.partition(' ')
+                command = command.upper()
+                self.standin.count(command)
+                latency = self.standin.latencyOf(command)
+                if latency:
+                    time.sleep(latency)
+                drop = self.standin.takeDrop(command)
+                if drop is False:
+                    break
+                self.muted = bool(drop)
+                if command == 'QUIT':
+                    self.reply(221, "Bye")
+                    break
+                method = getattr(self, 'do' + command, None)
+                if method is None:
+                    self.reply(502, "Command %s not implemented" % command)
+                    continue
+                if not self.logged and command not in ('USER', 'PASS', 'FEAT', 'SYST'):
+                    self.reply(530, "Not logged in")
+                    continue
+                try:
+                    method(argument)
+                except FtpError as e:
+                    self.reply(e.code, e.message)
+                except OSError as e:
+                    if self.dropped:
+                        break
+                    self.reply(550, str(e))
+                if self.muted:
+                    break
+        except (ConnectionError, OSError):
+            pass
+
+    ################################################################# paths
+    def realPath(self, path):
+        '''@return: the path on disk of the given FTP path, which must stay in the root directory'''
+        virtual = os.path.normpath(os.path.join(self.cwd, path or '.')).replace('\\', '/')
+        if not virtual.startswith('/'):
+            virtual = '/' + virtual
+        real = os.path.realpath(os.path.join(self.standin.rootdir, virtual.lstrip('/')))
+        if real != self.standin.rootdir and not real.startswith(self.standin.rootdir + os.sep):
+            raise FtpError(550, "Outside of the root")
+        return real, virtual
+
+    ################################################################# data connection
+    def closePassive(self):
+        if self.passive is not None:
+            self.passive.close()
+            self.passive = None
+
+    def openPassive(self):
+        self.closePassive()
+        self.passive = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.passive.bind((self.request.getsockname()[0], 0))
+        self.passive.listen(1)
+        self.passive.settimeout(DATA_TIMEOUT)
+        return self.passive.getsockname()
+
+    def dataConnection(self):
+        if self.passive is None:
+            raise FtpError(425, "Use PASV first")
+        self.reply(150, "Opening data connection")
+        try:
+            connection, _address = self.passive.accept()
+        except socket.timeout:
+            raise FtpError(425, "No data connection")
+        finally:
+            self.closePassive()
+        return connection
+
+    def sendData(self, data):
+        connection = self.dataConnection()
+        try:
+            connection.sendall(data)
+        finally:
+            connection.close()
+        self.reply(226, "Transfer complete")
+
+    def receiveData(self, fout):
+        connection = self.dataConnection()
+        try:
+            while True:
+                block = connection.recv(65536)
+                if not block:
+                    break
+                fout.write(block)
+        finally:
+            connection.close()
+        self.reply(226, "Transfer complete")
+
+    ################################################################# commands
+    def doUSER(self, argument):
+        self.user = argument
+        self.reply(331, "Password required")
+
+    def doPASS(self, argument):
+        users = self.standin.users
+        if users is not None and users.get(self.user) != argument:
+            raise FtpError(530, "Login incorrect")
+        self.logged = True
+        self.reply(230, "Logged in")
+
+    def doSYST(self, _argument):
+        self.reply(215, "UNIX Type: L8")
+
+    def doFEAT(self, _argument):
+        self.wfile.write(b"211-Features:\r\n" + b"".join((" %s\r\n" % feature).encode() for feature in FEATURES))
+        self.reply(211, "End")
+
+    def doOPTS(self, _argument):
+        self.reply(200, "OK")
+
+    def doTYPE(self, _argument):
+        self.reply(200, "Type set")
+
+    def doNOOP(self, _argument):
+        self.reply(200, "NOOP ok")
+
+    def doPWD(self, _argument):
+        self.reply(257, '"%s" is the current directory' % self.cwd)
+
+    def doCWD(self, argument):
+        real, virtual = self.realPath(argument)
+        if not os.path.isdir(real):
+            raise FtpError(550, "No such directory")
+        self.cwd = virtual
+        self.reply(250, "Directory changed")
+
+    def doMKD(self, argument):
+        real, virtual = self.realPath(argument)
+        if os.path.exists(real):
+            raise FtpError(550, "Already exists")
+        os.mkdir(real)
+        self.reply(257, '"%s" created' % virtual)
+
+    def doPASV(self, _argument):
+        host, port = self.openPassive()
+        self.reply(227, "Entering Passive Mode (%s,%s,%s)." % (host.replace('.', ','), port >> 8, port & 0xff))
+
+    def doEPSV(self, _argument):
+        _host, port = self.openPassive()
+        self.reply(229, "Entering Extended Passive Mode (|||%s|)" % port)
+
+    def doREST(self, argument):
+        self.restart = int(argument)
+        self.reply(350, "Restarting at %s" % self.restart)
+
+    def doRETR(self, argument):
+        real, _virtual = self.realPath(argument)
+        offset, self.restart = self.restart, 0
+        if not os.path.isfile(real):
+            self.closePassive()
+            raise FtpError(550, "No such file")
+        with open(real, 'rb') as fin:
+            fin.seek(offset)
+            data = fin.read()
+        self.sendData(data)
+
+    def store(self, argument, mode):
+        real, _virtual = self.realPath(argument)
+        offset, self.restart = self.restart, 0
+        if offset and mode == 'wb':
+            mode = 'r+b' if os.path.exists(real) else 'wb'
+        with open(real, mode) as fout:
+            if offset:
+                fout.seek(offset)
+                fout.truncate()
+            self.receiveData(fout)
+
+    def doSTOR(self, argument):
+        self.store(argument, 'wb')
+
+    def doAPPE(self, argument):
+        self.store(argument, 'ab')
+
+    def doSIZE(self, argument):
+        real, _virtual = self.realPath(argument)
+        if not os.path.isfile(real):
+            raise FtpError(550, "No such file")
+        self.reply(213, str(os.path.getsize(real)))
+
+    def doDELE(self, argument):
+        real, _virtual = self.realPath(argument)
+        if not os.path.isfile(real):
+            raise FtpError(550, "No such file")
+        os.remove(real)
+        self.reply(250, "Deleted")
+
+    def doRNFR(self, argument):
+        real, _virtual = self.realPath(argument)
+        if not os.path.exists(real):
+            raise FtpError(550, "No such file")
+        self.renameFrom = real
+        self.reply(350, "Ready for RNTO")
+
+    def doRNTO(self, argument):
+        real, _virtual = self.realPath(argument)
+        if self.renameFrom is None:
+            raise FtpError(503, "RNFR first")
+        source, self.renameFrom = self.renameFrom, None
+        os.replace(source, real)
+        self.reply(250, "Renamed")
+
+    def listing(self, argument):
+        real, _virtual = self.realPath(argument if argument and not argument.startswith('-') else None)
+        if not os.path.isdir(real):
+            self.closePassive()
+            raise FtpError(550, "No such directory")
+        return real
+
+    def doNLST(self, argument):
+        real = self.listing(argument)
+        self.sendData(b"".join(name.encode('utf-8') + b"\r\n" for name in sorted(os.listdir(real))))
+
+    def doMLSD(self, argument):
+        real = self.listing(argument)
+        lines = []
+        with os.scandir(real) as entries:
+            for entry in entries:
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                modify = time.strftime("%Y%m%d%H%M%S", time.gmtime(st.st_mtime)) + ".%06d" % (st.st_mtime_ns // 1000 % 1000000)
+                kind = 'dir' if entry.is_dir() else 'file'
+                lines.append("type=%s;size=%s;modify=%s; %s\r\n" % (kind, st.st_size, modify, entry.name))
+        self.sendData("".join(lines).encode('utf-8'))
@@ -0,0 +1,674 @@
+'''
+In-process IMAP4rev1 stand-in server, for tests and benchmarks of the imap module without a real mail server.
+
+It implements only what the imap module needs: CAPABILITY, LOGIN, LOGOUT, NOOP, SELECT, EXAMINE, CREATE, DELETE,
+LIST, STATUS, APPEND (with MULTIAPPEND and literal8), CLOSE, EXPUNGE, IDLE, SEARCH/FETCH/STORE/EXPUNGE (with UID),
+over mailboxes kept in memory.
+
+A latency can be injected before each response, globally or by command, to simulate a distant server.
+Commands received are counted in commandCounts, and listed in the order received in commandLog.
+
+Usage:
+    server = ImapStandInServer(latency=0.01)
+    server.start()
+    client = imaplib.IMAP4('127.0.0.1', server.port)
+    ...
+    server.stop()
+
+Created on 19 oct. 2026
+
+@author: Cedric
+'''
+
+import asyncio
+import threading
+import time
+import re
+import logging
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import compat32
+
+LOGGER = logging.getLogger("imap_standin")
+
+CAPABILITIES = ['IMAP4rev1', 'IDLE', 'UIDPLUS', 'CONDSTORE', 'BINARY', 'MULTIAPPEND', 'LITERAL+']
+
+LITERAL_RX = re.compile(rb'(~?)\{(\d+)(\+?)\}$')
+
+
+class StandInMessage:
+    '''A message in a mailbox'''
+    def __init__(self, uid, data, flags=(), modseq=1):
+        self.uid = uid
+        self.data = data
+        self.flags = set(flags)
+        self.modseq = modseq
+        self.internaldate = time.time()
+        self.parsed = BytesParser(policy=compat32).parsebytes(data)
+
+    @property
+    def header(self):
+        '''Header, including the empty line'''
+        index = self.data.find(b'\r\n\r\n')
+        return self.data if index < 0 else self.data[:index+4]
+
+    @property
+    def text(self):
+        index = self.data.find(b'\r\n\r\n')
+        return b'' if index < 0 else self.data[index+4:]
+
+    def headerFields(self, fields, exclude=False):
+        '''Lines of the header for the given fields (or for the other ones)'''
+        fields = [f.upper() for f in fields]
+        lines = []
+        for line in re.split(rb'\r\n(?![ \t])', self.header.rstrip(b'\r\n')):
+            name = line.split(b':', 1)[0].strip().decode('ascii', errors='replace').upper()
+            if (name in fields) != exclude:
+                lines.append(line + b'\r\n')
+        return b''.join(lines) + b'\r\n'
+
+    def part(self, section):
+        '''Part of a (possibly multipart) message, given its number 1.2.3'''
+        part = self.parsed
+        for number in section.split('.'):
+            number = int(number)
+            if part.is_multipart():
+                part = part.get_payload()[number-1]
+            elif number != 1:
+                return None
+        return part
+
+
+class StandInMailbox:
+    '''A mailbox, with its messages'''
+    NEXT_UIDVALIDITY = int(time.time())
+
+    def __init__(self, name):
+        self.name = name
+        StandInMailbox.NEXT_UIDVALIDITY += 1
+        self.uidvalidity = StandInMailbox.NEXT_UIDVALIDITY
+        self.uidnext = 1
+        self.highestmodseq = 1
+        self.messages = []
+
+    def append(self, data, flags=()):
+        self.highestmodseq += 1
+        message = StandInMessage(self.uidnext, data, flags, self.highestmodseq)
+        self.uidnext += 1
+        self.messages.append(message)
+        return message
+
+    def expunge(self, uids=None):
+        '''Removes the messages flagged as deleted (with the given uids if any)
+        @return: the sequence numbers removed, in the order of the EXPUNGE responses'''
+        removed = []
+        for seq in range(len(self.messages), 0, -1):
+            message = self.messages[seq-1]
+            if '\\Deleted' in message.flags and (uids is None or message.uid in uids):
+                del self.messages[seq-1]
+                removed.append(seq)
+        if removed:
+            self.highestmodseq += 1
+        return removed
+
+
+class ImapStandInServer:
+    '''The server, running its asyncio loop in its own thread'''
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0., capabilities=CAPABILITIES, users=None):
+        '''@param latency: seconds before each response, or dict command name => seconds (key None for the others)
+        @param users: dict login => password, any login accepted if None'''
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.capabilities = list(capabilities)
+        self.users = users
+        self.mailboxes = {'INBOX': StandInMailbox('INBOX')}
+        self.commandCounts = Counter()
+        self.commandLog = []
+        self.connections = set()
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.started = threading.Event()
+
+    ################################################################# life cycle
+    def start(self):
+        '''Starts the server in a thread, @return the port'''
+        self.thread = threading.Thread(target=self.run, name="imap-standin", daemon=True)
+        self.thread.start()
+        self.started.wait()
+        return self.port
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, self.host, self.port))
+        self.port = self.server.sockets[0].getsockname()[1]
+        LOGGER.info("IMAP stand-in listening on %s:%s", self.host, self.port)
+        self.started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def stop(self):
+        if self.loop is None:
+            return
+        async def closing():
+            self.server.close()
+            for connection in list(self.connections):
+                connection.writer.close()
+            # IDLE waits and latencies still pending
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.server.wait_closed()
+            self.loop.stop()
+        asyncio.run_coroutine_threadsafe(closing(), self.loop)
+        self.thread.join(5)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, _exc_type, _exc_val, _exc_tb):
+        self.stop()
+        return False
+
+    def resetCounts(self):
+        self.commandCounts.clear()
+        self.commandLog.clear()
+
+    async def handle(self, reader, writer):
+        connection = StandInConnection(self, reader, writer)
+        self.connections.add(connection)
+        try:
+            await connection.run()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # disconnected, or server stopped
+            pass
+        finally:
+            self.connections.discard(connection)
+            writer.close()
+
+    def latencyOf(self, command):
+        if isinstance(self.latency, dict):
+            return self.latency.get(command, self.latency.get(None, 0.))
+        return self.latency
+
+    def notifyChanges(self, mailbox, origin):
+        '''Tells the connections that selected a mailbox that it changed'''
+        for connection in self.connections:
+            if connection is not origin and connection.mailbox is mailbox:
+                connection.changed.set()
+
+
+class ImapError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def tokenize(data):
+    '''Parses a command into a list of bytes (atoms, strings, literals) and lists (parenthesized).
+    Literals must already be given as bytes objects in data (list of bytes lines and literal contents).'''
+    stack = [[]]
+    for segment in data:
+        if isinstance(segment, Literal):
+            # kept as Literal: an APPEND tells the e-mails from the dates
+            stack[-1].append(segment)
+            continue
+        i = 0
+        while i < len(segment):
+            c = segment[i:i+1]
+            if c == b' ':
+                i += 1
+            elif c == b'(':
+                stack.append([])
+                i += 1
+            elif c == b')':
+                if len(stack) == 1:
+                    raise ImapError('BAD', 'Unbalanced parenthesis')
+                finished = stack.pop()
+                stack[-1].append(finished)
+                i += 1
+            elif c == b'"':
+                j = i + 1
+                value = bytearray()
+                while j < len(segment) and segment[j:j+1] != b'"':
+                    if segment[j:j+1] == b'\\':
+                        j += 1
+                    value.extend(segment[j:j+1])
+                    j += 1
+                stack[-1].append(bytes(value))
+                i = j + 1
+            else:
+                j = i
+                depth = 0
+                while j < len(segment):
+                    cj = segment[j:j+1]
+                    if cj == b'[':
+                        depth += 1
+                    elif cj == b']':
+                        depth -= 1
+                    elif depth == 0 and cj in (b' ', b'(', b')'):
+                        break
+                    j += 1
+                stack[-1].append(segment[i:j])
+                i = j
+    if len(stack) != 1:
+        raise ImapError('BAD', 'Unbalanced parenthesis')
+    return stack[0]
+
+
+class Literal(bytes):
+    '''Content of a literal in a command'''
+
+
+def parseSequenceSet(sequenceset, maximum):
+    '''@return a function telling if a number is in the set'''
+    ranges = []
+    for part in sequenceset.decode().split(','):
+        if ':' in part:
+            a, b = part.split(':')
+            a = maximum if a == '*' else int(a)
+            b = maximum if b == '*' else int(b)
+            ranges.append((min(a, b), max(a, b)))
+        else:
+            a = maximum if part == '*' else int(part)
+            ranges.append((a, a))
+    return lambda n: any(a <= n <= b for a, b in ranges)
+
+
+def quoted(value):
+    return b'"' + value.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+
+
+class StandInConnection:
+    '''One client connection'''
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.authenticated = False
+        self.mailbox = None
+        self.readonly = False
+        self.changed = asyncio.Event()
+        self.knownExists = 0
+        self.knownUidNext = 0
+
+    def send(self, line):
+        self.writer.write(line + b'\r\n')
+
+    async def readCommand(self):
+        '''Reads a full command, with its literals
+        @return the list of segments (bytes and Literal)'''
+        segments = []
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError("Connection closed")
+            line = line.rstrip(b'\r\n')
+            m = LITERAL_RX.search(line)
+            if not m:
+                segments.append(line)
+                return segments
+            segments.append(line[:m.start()])
+            if not m.group(3):
+                self.send(b'+ Ready for literal data')
+                await self.writer.drain()
+            segments.append(Literal(await self.reader.readexactly(int(m.group(2)))))
+
+    async def run(self):
+        self.send(b'* OK [CAPABILITY ' + ' '.join(self.server.capabilities).encode() + b'] IMAP stand-in ready')
+        await self.writer.drain()
+        while True:
+            segments = await self.readCommand()
+            try:
+                tokens = tokenize(segments)
+            except ImapError as e:
+                self.send(b'* BAD ' + str(e).encode())
+                continue
+            if len(tokens) < 2:
+                self.send(b'* BAD Missing command')
+                continue
+            tag, command, args = tokens[0], tokens[1].decode().upper(), tokens[2:]
+            uid = False
+            if command == 'UID' and args:
+                uid = True
+                command, args = args[0].decode().upper(), args[1:]
+            name = 'UID ' + command if uid else command
+            self.server.commandCounts[name] += 1
+            self.server.commandLog.append(name)
+            latency = self.server.latencyOf(name)
+            if latency:
+                await asyncio.sleep(latency)
+            method = getattr(self, 'do' + command.capitalize(), None)
+            try:
+                if method is None:
+                    raise ImapError('BAD', 'Unknown command %s' % command)
+                if command not in ('CAPABILITY', 'LOGIN', 'LOGOUT', 'NOOP') and not self.authenticated:
+                    raise ImapError('NO', 'Not authenticated')
+                if uid:
+                    result = await method(args, uid=True)
+                else:
+                    result = await method(args)
+            except ImapError as e:
+                self.send(tag + b' ' + e.status.encode() + b' ' + str(e).encode())
+            except (ValueError, IndexError, KeyError) as e:
+                self.send(tag + b' BAD ' + repr(e).encode())
+            else:
+                self.send(tag + b' OK ' + (result or (name + ' completed').encode()))
+            await self.writer.drain()
+            if command == 'LOGOUT':
+                self.writer.close()
+                return
+
+    ################################################################# helpers
+    def requireSelected(self):
+        if self.mailbox is None:
+            raise ImapError('BAD', 'No mailbox selected')
+        return self.mailbox
+
+    def getMailbox(self, name):
+        name = name.decode()
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+        if name not in self.server.mailboxes:
+            raise ImapError('NO', '[TRYCREATE] Mailbox %s does not exist' % name)
+        return self.server.mailboxes[name]
+
+    def sendUpdates(self):
+        '''Untagged EXISTS/EXPUNGE for the changes made by other connections'''
+        if self.mailbox is None:
+            return
+        if self.mailbox.name not in self.server.mailboxes:
+            self.mailbox = None
+            return
+        exists = len(self.mailbox.messages)
+        # an arrival after an expunge does not change the count
+        if exists != self.knownExists or self.mailbox.uidnext != self.knownUidNext:
+            self.send(b'* %d EXISTS' % exists)
+            self.knownExists = exists
+            self.knownUidNext = self.mailbox.uidnext
+        self.changed.clear()
+
+    def messagesFor(self, sequenceset, uid):
+        mailbox = self.requireSelected()
+        if uid:
+            maximum = mailbox.messages[-1].uid if mailbox.messages else 0
+            contains = parseSequenceSet(sequenceset, maximum)
+            toreturn = [(seq+1, m) for seq, m in enumerate(mailbox.messages) if contains(m.uid)]
+            if not toreturn and sequenceset.endswith(b'*') and mailbox.messages:
+                # n:* always includes the last message
+                toreturn = [(len(mailbox.messages), mailbox.messages[-1])]
+            return toreturn
+        contains = parseSequenceSet(sequenceset, len(mailbox.messages))
+        return [(seq+1, m) for seq, m in enumerate(mailbox.messages) if contains(seq+1)]
+
+    ################################################################# commands
+    async def doCapability(self, args):
+        self.send(b'* CAPABILITY ' + ' '.join(self.server.capabilities).encode())
+
+    async def doNoop(self, args):
+        self.sendUpdates()
+
+    async def doLogin(self, args):
+        login, password = args[0].decode(), args[1].decode()
+        if self.server.users is not None and self.server.users.get(login) != password:
+            raise ImapError('NO', '[AUTHENTICATIONFAILED] Invalid credentials')
+        self.authenticated = True
+        return b'[CAPABILITY ' + ' '.join(self.server.capabilities).encode() + b'] Logged in'
+
+    async def doLogout(self, args):
+        self.send(b'* BYE Logging out')
+
+    async def doSelect(self, args, readonly=False):
+        mailbox = self.getMailbox(args[0])
+        self.mailbox = mailbox
+        self.readonly = readonly
+        self.knownExists = len(mailbox.messages)
+        self.knownUidNext = mailbox.uidnext
+        self.send(b'* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)')
+        self.send(b'* %d EXISTS' % len(mailbox.messages))
+        self.send(b'* 0 RECENT')
+        self.send(b'* OK [UIDVALIDITY %d] UIDs valid' % mailbox.uidvalidity)
+        self.send(b'* OK [UIDNEXT %d] Predicted next UID' % mailbox.uidnext)
+        if 'CONDSTORE' in self.server.capabilities:
+            self.send(b'* OK [HIGHESTMODSEQ %d] Highest' % mailbox.highestmodseq)
+        return b'[READ-ONLY] EXAMINE completed' if readonly else b'[READ-WRITE] SELECT completed'
+
+    async def doExamine(self, args):
+        return await self.doSelect(args, readonly=True)
+
+    async def doCreate(self, args):
+        name = args[0].decode()
+        if name in self.server.mailboxes:
+            raise ImapError('NO', '[ALREADYEXISTS] Mailbox already exists')
+        self.server.mailboxes[name] = StandInMailbox(name)
+
+    async def doDelete(self, args):
+        mailbox = self.getMailbox(args[0])
+        if mailbox.name == 'INBOX':
+            raise ImapError('NO', 'INBOX cannot be deleted')
+        del self.server.mailboxes[mailbox.name]
+        if self.mailbox is mailbox:
+            self.mailbox = None
+
+    async def doList(self, args):
+        pattern = args[1].decode()
+        rx = re.compile('^' + re.escape(pattern).replace(r'\*', '.*').replace('%', '[^/]*') + '$')
+        for name in sorted(self.server.mailboxes):
+            if rx.match(name):
+                self.send(b'* LIST () "/" ' + quoted(name.encode()))
+
+    async def doStatus(self, args):
+        mailbox = self.getMailbox(args[0])
+        values = []
+        for item in args[1]:
+            item = item.decode().upper()
+            value = {'MESSAGES': len(mailbox.messages),
+                     'UIDNEXT': mailbox.uidnext,
+                     'UIDVALIDITY': mailbox.uidvalidity,
+                     'UNSEEN': sum(1 for m in mailbox.messages if '\\Seen' not in m.flags),
+                     'RECENT': 0,
+                     'HIGHESTMODSEQ': mailbox.highestmodseq}.get(item)
+            if value is None:
+                raise ImapError('BAD', 'Unknown status item %s' % item)
+            values.append(b'%s %d' % (item.encode(), value))
+        self.send(b'* STATUS ' + quoted(mailbox.name.encode()) + b' (' + b' '.join(values) + b')')
+
+    async def doAppend(self, args):
+        mailbox = self.getMailbox(args[0])
+        args = args[1:]
+        uids = []
+        while args:
+            flags = ()
+            if isinstance(args[0], list):
+                flags = [f.decode() for f in args[0]]
+                args = args[1:]
+            if not isinstance(args[0], bytes) or args[0].startswith(b'"'):
+                raise ImapError('BAD', 'Missing message')
+            if len(args) > 1 and not isinstance(args[0], Literal) and isinstance(args[1], bytes):
+                # date
+                args = args[1:]
+            data = args[0]
+            args = args[1:]
+            uids.append(mailbox.append(data, flags).uid)
+        self.server.notifyChanges(mailbox, self)
+        if self.mailbox is mailbox:
+            self.sendUpdates()
+        if 'UIDPLUS' in self.server.capabilities:
+            return b'[APPENDUID %d %s] APPEND completed' % (mailbox.uidvalidity, ','.join(str(u) for u in uids).encode())
+
+    async def doClose(self, args):
+        mailbox = self.requireSelected()
+        if not self.readonly:
+            mailbox.expunge()
+            self.server.notifyChanges(mailbox, self)
+        self.mailbox = None
+
+    async def doExpunge(self, args, uid=False):
+        mailbox = self.requireSelected()
+        uids = None
+        if uid:
+            uids = set(m.uid for _, m in self.messagesFor(args[0], True))
+        for seq in mailbox.expunge(uids):
+            self.send(b'* %d EXPUNGE' % seq)
+        self.knownExists = len(mailbox.messages)
+        self.server.notifyChanges(mailbox, self)
+
+    async def doIdle(self, args):
+        self.requireSelected()
+        self.send(b'+ idling')
+        await self.writer.drain()
+        self.sendUpdates()
+        await self.writer.drain()
+        done = asyncio.ensure_future(self.reader.readline())
+        while True:
+            changed = asyncio.ensure_future(self.changed.wait())
+            finished, _ = await asyncio.wait([done, changed], return_when=asyncio.FIRST_COMPLETED)
+            if changed in finished:
+                self.sendUpdates()
+                await self.writer.drain()
+            else:
+                changed.cancel()
+            if done in finished:
+                line = done.result()
+                if not line:
+                    raise ConnectionError("Connection closed")
+                if line.strip().upper() != b'DONE':
+                    raise ImapError('BAD', 'Expected DONE')
+                return b'IDLE terminated'
+
+    async def doStore(self, args, uid=False):
+        mailbox = self.requireSelected()
+        action = args[1].decode().upper()
+        flags = args[2:]
+        if len(flags) == 1 and isinstance(flags[0], list):
+            flags = flags[0]
+        flags = set(f.decode() for f in flags)
+        silent = action.endswith('.SILENT')
+        action = action.replace('.SILENT', '')
+        mailbox.highestmodseq += 1
+        for seq, message in self.messagesFor(args[0], uid):
+            if action == '+FLAGS':
+                message.flags |= flags
+            elif action == '-FLAGS':
+                message.flags -= flags
+            elif action == 'FLAGS':
+                message.flags = set(flags)
+            else:
+                raise ImapError('BAD', 'Unknown store action %s' % action)
+            message.modseq = mailbox.highestmodseq
+            if not silent:
+                self.send(b'* %d FETCH (%sFLAGS (%s))' % (seq, b'UID %d ' % message.uid if uid else b'',
+                                                          ' '.join(sorted(message.flags)).encode()))
+        self.server.notifyChanges(mailbox, self)
+
+    async def doSearch(self, args, uid=False):
+        mailbox = self.requireSelected()
+        if args and args[0].upper() == b'CHARSET':
+            args = args[2:]
+        found = []
+        for seq, message in enumerate(mailbox.messages, 1):
+            if self.matchAll(list(args), seq, message, mailbox):
+                found.append(message.uid if uid else seq)
+        self.send(b'* SEARCH' + b''.join(b' %d' % n for n in found))
+
+    def matchAll(self, args, seq, message, mailbox):
+        while args:
+            if not self.matchOne(args, seq, message, mailbox):
+                return False
+        return True
+
+    def matchOne(self, args, seq, message, mailbox):
+        '''Evaluates (and consumes) the first search key of args'''
+        key = args.pop(0)
+        if isinstance(key, list):
+            return self.matchAll(key, seq, message, mailbox)
+        upper = key.decode().upper()
+        if upper == 'ALL':
+            return True
+        if upper == 'NOT':
+            return not self.matchOne(args, seq, message, mailbox)
+        if upper == 'OR':
+            first = self.matchOne(args, seq, message, mailbox)
+            second = self.matchOne(args, seq, message, mailbox)
+            return first or second
+        if upper in ('DELETED', 'SEEN', 'FLAGGED', 'ANSWERED', 'DRAFT'):
+            return '\\' + upper.capitalize() in message.flags
+        if upper in ('UNDELETED', 'UNSEEN'):
+            return '\\' + upper[2:].capitalize() not in message.flags
+        if upper == 'HEADER':
+            field, value = args.pop(0).decode(), args.pop(0).decode().lower()
+            return any(value in str(v).lower() for v in message.parsed.get_all(field, []))
+        if upper in ('SUBJECT', 'FROM', 'TO'):
+            value = args.pop(0).decode().lower()
+            return any(value in str(v).lower() for v in message.parsed.get_all(upper, []))
+        if upper == 'UID':
+            maximum = mailbox.messages[-1].uid if mailbox.messages else 0
+            return parseSequenceSet(args.pop(0), maximum)(message.uid)
+        if upper == 'MODSEQ':
+            return message.modseq >= int(args.pop(0))
+        if re.match(r'^[\d*:,]+$', upper):
+            return parseSequenceSet(key, len(mailbox.messages))(seq)
+        raise ImapError('BAD', 'Unknown search key %s' % upper)
+
+    async def doFetch(self, args, uid=False):
+        items = args[1] if isinstance(args[1], list) else [args[1]]
+        for seq, message in self.messagesFor(args[0], uid):
+            response = []
+            if uid:
+                response.append(b'UID %d' % message.uid)
+            for item in items:
+                response.append(self.fetchItem(item, message))
+            self.send(b'* %d FETCH (' % seq + b' '.join(response) + b')')
+
+    def fetchItem(self, item, message):
+        upper = item.upper()
+        if upper == b'UID':
+            return b'UID %d' % message.uid
+        if upper == b'FLAGS':
+            return b'FLAGS (%s)' % ' '.join(sorted(message.flags)).encode()
+        if upper == b'MODSEQ':
+            return b'MODSEQ (%d)' % message.modseq
+        if upper == b'RFC822.SIZE':
+            return b'RFC822.SIZE %d' % len(message.data)
+        if upper in (b'RFC822', b'BODY[]', b'BODY.PEEK[]'):
+            return self.literal(b'RFC822' if upper == b'RFC822' else b'BODY[]', message.data)
+        if upper == b'RFC822.HEADER':
+            return self.literal(upper, message.header)
+        m = re.match(rb'^(BODY|BINARY)(\.PEEK)?\[(.*)\]$', item, re.I)
+        if not m:
+            raise ImapError('BAD', 'Unknown fetch item %s' % item.decode())
+        kind, section = m.group(1).upper(), m.group(3)
+        name = kind + b'[' + section + b']'
+        usection = section.upper()
+        if usection == b'TEXT':
+            return self.literal(name, message.text)
+        if usection == b'HEADER':
+            return self.literal(name, message.header)
+        fm = re.match(rb'^HEADER\.FIELDS(\.NOT)?\s*\((.*)\)$', section, re.I)
+        if fm:
+            fields = [f.decode() for f in fm.group(2).split()]
+            return self.literal(name, message.headerFields(fields, bool(fm.group(1))))
+        part = message.part(section.decode())
+        if part is None:
+            return self.literal(name, b'')
+        if kind == b'BINARY':
+            if 'BINARY' not in self.server.capabilities:
+                raise ImapError('BAD', 'BINARY not supported')
+            content = part.get_payload(decode=True) or b''
+            return name + b' ~{%d}\r\n' % len(content) + content
+        if part is message.parsed and not part.is_multipart():
+            return self.literal(name, message.text)
+        return self.literal(name, part.get_payload(decode=False).encode('ascii', errors='surrogateescape')
+                            if isinstance(part.get_payload(), str) else part.as_bytes())
+
+    @staticmethod
+    def literal(name, content):
+        return name + b' {%d}\r\n' % len(content) + content
@@ -4,8 +4,9 @@ Created on 4 avr. 2020
 @author: Cedric
 '''
 import unittest
-from remoteconanywhere.communication import QueueCommunicationSession, QueueCommClient, QueueCommServer
-import time
+from remoteconanywhere.communication import QueueCommunicationSession, QueueCommClient, QueueCommServer,\
+    CommunicationSession, ReclaimJournal, EchoActionServer
+import os, shutil, tempfile, threading, time
 
 # initiate logging
 import abstract_comm_test
@@ -83,6 +84,298 @@ class TestQueueCommunication(unittest.TestCase):
         data = sessionClient.receiveChunk()
         self.assertTrue(sessionClient.closed)
         self.assertEqual(data, None)
+    
+    def testQueueCommSessionBatches(self):
+        session = QueueCommunicationSession('batches')
+        session.maxdatalength = 4
+        session.sendMany([b'Hello', b' world'])
+        self.assertEqual([b'Hell', b'o', b' wor', b'ld'], [session.memoryGetSentData() for _ in range(4)])
+        self.assertEqual(11, session.dataSent)
+        for data in (b'a', b'b', b'c', session.data_to_close_session):
+            session.memoryPutSomeData(data)
+        self.assertEqual([b'a', b'b'], session.receiveAvailable(2))
+        # the chunks before the close message are returned, then None
+        self.assertEqual([b'c'], session.receiveAvailable())
+        self.assertTrue(session.closed)
+        self.assertIsNone(session.receiveAvailable())
+    
+    def testQueueCommSessionBatchError(self):
+        session = QueueCommunicationSession('batch-error')
+        for data in (b'a', b'b', b'c'):
+            session.memoryPutSomeData(data)
+        reads = [0]
+        receiveRawChunk = session.receiveRawChunk
+        def failingSecond():
+            reads[0] += 1
+            if reads[0] == 2:
+                raise OSError("connection lost")
+            return receiveRawChunk()
+        session.receiveRawChunk = failingSecond
+        # the chunk already read is returned, not lost
+        self.assertEqual([b'a'], session.receiveAvailable())
+        self.assertEqual([b'b', b'c'], session.receiveAvailable())
+        # with nothing read, the error is raised
+        reads[0] = 1
+        self.assertRaises(OSError, session.receiveAvailable)
+
+
+class TestPrefetch(unittest.TestCase):
+    
+    def waitFor(self, condition, timeout=5):
+        end = time.time() + timeout
+        while time.time() < end:
+            if condition():
+                return True
+            time.sleep(0.01)
+        return False
+    
+    def testBoundedByChunks(self):
+        session = QueueCommunicationSession('prefetch-chunks')
+        for i in range(10):
+            session.memoryPutSomeData(b'chunk %d' % i)
+        session.startPrefetch(maxChunks=3)
+        self.assertTrue(self.waitFor(lambda: len(session.prefetcher.chunks) == 3))
+        time.sleep(0.2)
+        # the others are left to the transport
+        self.assertEqual(3, len(session.prefetcher.chunks))
+        self.assertEqual(7, session.recqueue.qsize())
+        self.assertTrue(session.checkIfDataAvailable())
+        self.assertEqual([b'chunk %d' % i for i in range(10)], [session.receiveChunkWait(5) for _i in range(10)])
+        self.assertFalse(session.checkIfDataAvailable())
+        session.close(True)
+    
+    def testBoundedByBytes(self):
+        session = QueueCommunicationSession('prefetch-bytes')
+        session.maxdatalength = 10
+        for _i in range(10):
+            session.memoryPutSomeData(b'0123456789')
+        session.startPrefetch(maxBytes=25)
+        self.assertTrue(self.waitFor(lambda: session.prefetcher.size >= 25))
+        time.sleep(0.2)
+        # one chunk more at most
+        self.assertLessEqual(session.prefetcher.size, 25 + 10)
+        self.assertEqual([b'0123456789'] * 3, session.receiveAvailable())
+        # fetched again up to the limit
+        self.assertTrue(self.waitFor(lambda: session.recqueue.qsize() == 4))
+        session.close(True)
+    
+    def testTransportError(self):
+        session = QueueCommunicationSession('prefetch-error')
+        receiveRawChunks = session.receiveRawChunks
+        def failingAfterFirst(maximum=None):
+            session.receiveRawChunks = lambda maximum=None: ([] if session.closed else 1 / 0)
+            session.memoryPutSomeData(b'first chunk')
+            return receiveRawChunks(maximum)
+        session.receiveRawChunks = failingAfterFirst
+        session.startPrefetch()
+        self.assertTrue(self.waitFor(lambda: session.prefetcher.finished))
+        # the chunk fetched before the error, then the error, as without prefetching
+        self.assertEqual(b'first chunk', session.receiveChunkWait(5))
+        self.assertRaises(ZeroDivisionError, session.receiveChunkWait, 5)
+        self.assertRaises(ZeroDivisionError, session.receiveAvailable)
+        self.assertRaises(ZeroDivisionError, session.checkIfDataAvailable)
+        session.close(True)
+    
+    def testWaitWokenUp(self):
+        session = QueueCommunicationSession('prefetch-wait')
+        session.startPrefetch()
+        threading.Timer(0.3, session.memoryPutSomeData, (b'late chunk',)).start()
+        start = time.time()
+        self.assertEqual(b'late chunk', session.receiveChunkWait(5))
+        self.assertLess(time.time() - start, 1)
+        with self.assertRaises(TimeoutError):
+            session.receiveChunkWait(0.2)
+        session.memoryPutSomeData(session.data_to_close_session)
+        self.assertIsNone(session.receiveChunkWait(5))
+        self.assertTrue(session.closed)
+        self.assertTrue(self.waitFor(lambda: session.prefetcher.finished))
+    
+    def testOptInByActionServer(self):
+        server = QueueCommServer('prefetch-server')
+        echo = EchoActionServer()
+        echo.prefetch = (4, 1024)
+        server.registerCapability(echo)
+        server.handleNoSessionMessage('prefetch-client', QueueCommClient.SPECIAL_MESSAGE_START_SESSION + b'echo')
+        session = echo.session
+        self.assertEqual((4, 1024), (session.prefetcher.maxChunks, session.prefetcher.maxBytes))
+        session.memoryPutSomeData(b'Hello')
+        self.assertTrue(self.waitFor(lambda: session.memoryGetSentData() == b'Hello' or False))
+        server.stop()
+
+
+class ReleasingSession(CommunicationSession):
+    '''Records the released identifiers, blocked while release is cleared'''
+    def __init__(self, sid=1, reclaimJournal=None):
+        super().__init__('me', 'other', sid, reclaimJournal)
+        self.releases = []
+        self.release = threading.Event()
+        self.release.set()
+        self.recoverReclaims()
+    
+    def releaseConsumed(self, identifiers):
+        self.release.wait(5)
+        self.releases.append(list(identifiers))
+
+
+class TestReclaim(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="journal")
+        self.journalPath = os.path.join(self.folder, "reclaim.journal")
+    
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+    
+    def testBatches(self):
+        session = ReleasingSession()
+        session.reclaimBatch = 10
+        session.release.clear()
+        for i in range(25):
+            session.reclaim(str(i))
+        session.release.set()
+        self.assertTrue(session.flushReclaims(5))
+        self.assertEqual([str(i) for i in range(25)], [identifier for batch in session.releases for identifier in batch])
+        # at most 10 by 10, the first ones while the others were put
+        self.assertTrue(all(len(batch) <= 10 for batch in session.releases))
+        self.assertLessEqual(len(session.releases), 4)
+        self.assertEqual(25, session.reclaimedCount)
+        session.close(True)
+    
+    def testDiscoveryAtOnce(self):
+        session = ReleasingSession(sid=0)
+        session.reclaim('0')
+        self.assertEqual([['0']], session.releases)
+        self.assertIsNone(session.reclaimThread)
+    
+    def testJournal(self):
+        journal = ReclaimJournal(self.journalPath)
+        session = ReleasingSession(reclaimJournal=journal)
+        session.reclaim('a')
+        self.assertTrue(session.flushReclaims(5))
+        session.release.clear()
+        session.reclaim('b')
+        session.reclaim('c')
+        self.assertIn('c', journal)
+        self.assertNotIn('a', journal)
+        # crash before the release of b and c: the next run releases them at once
+        journal2 = ReclaimJournal(self.journalPath)
+        session2 = ReleasingSession(reclaimJournal=journal2)
+        self.assertEqual([['b', 'c']], session2.releases)
+        self.assertEqual([], journal2.takeOrphans())
+        journal3 = ReclaimJournal(self.journalPath)
+        self.assertEqual([], journal3.takeOrphans())
+        session.release.set()
+        for tocl in (session, session2):
+            tocl.close(True)
+            self.assertTrue(tocl.flushReclaims(5))
+        for tocl in (journal, journal2, journal3):
+            tocl.close()
+    
+    def testJournalError(self):
+        journal = ReclaimJournal(self.journalPath)
+        session = ReleasingSession(reclaimJournal=journal)
+        released = journal.released
+        def full(identifiers):
+            journal.released = released
+            raise OSError(28, "No space left on device")
+        journal.released = full
+        session.reclaim('a')
+        self.assertTrue(session.flushReclaims(5))
+        # still released by the next batches
+        session.reclaim('b')
+        self.assertTrue(session.flushReclaims(5))
+        self.assertEqual([['a'], ['b']], session.releases)
+        self.assertNotIn('b', journal)
+        session.close(True)
+        self.assertTrue(session.flushReclaims(5))
+        journal.close()
+        # refused without error once closed
+        journal.consumed(['c'])
+        self.assertNotIn('c', journal)
+
+
+class StagingSession(CommunicationSession):
+    '''CONCURRENT_SEND session recording the staged chunks and the published ones, some stages failing'''
+    CONCURRENT_SEND = True
+    
+    def __init__(self):
+        super().__init__('me', 'other', 1)
+        self.staged = dict()
+        self.stages = []
+        self.published = []
+        self.discarded = []
+        self.failures = dict() # chunk number => stages still failing
+        self.running = 0
+        self.maxRunning = 0
+        self.lock = threading.Lock()
+    
+    def stageUnit(self, number, data):
+        with self.lock:
+            self.running += 1
+            self.maxRunning = max(self.maxRunning, self.running)
+        try:
+            # the last ones are the fastest
+            time.sleep(0.01 * (5 - number % 5))
+            if self.failures.get(number):
+                self.failures[number] -= 1
+                raise OSError("stage of %s failed" % number)
+            self.staged[number] = data
+            self.stages.append(number)
+        finally:
+            with self.lock:
+                self.running -= 1
+    
+    def publishUnit(self, number):
+        self.published.append((number, self.staged[number]))
+    
+    def discardUnit(self, number):
+        self.discarded.append(number)
+        del self.staged[number]
+
+
+class TestStagedSend(unittest.TestCase):
+    def setUp(self):
+        self.session = StagingSession()
+        self.session.maxdatalength = 2
+        self.session.sendBackoff = 0.01
+    
+    def tearDown(self):
+        self.session.close(True)
+    
+    def testPublishedInOrder(self):
+        self.session.send(b'0123456789')
+        self.assertEqual([(0, b'01'), (1, b'23'), (2, b'45'), (3, b'67'), (4, b'89')], self.session.published)
+        self.assertEqual(5, self.session.sent)
+        self.assertGreater(self.session.maxRunning, 1)
+        self.assertLessEqual(self.session.maxRunning, self.session.sendWorkers)
+    
+    def testSequential(self):
+        self.session.sendWorkers = 1
+        self.session.send(b'0123456789')
+        self.assertEqual([0, 1, 2, 3, 4], [number for number, _ in self.session.published])
+        self.assertEqual(1, self.session.maxRunning)
+        self.assertIsNone(self.session.sendExecutor)
+    
+    def testRetried(self):
+        self.session.failures[2] = self.session.sendRetries
+        self.session.send(b'0123456789')
+        self.assertEqual([0, 1, 2, 3, 4], [number for number, _ in self.session.published])
+        self.assertEqual(0, self.session.failures[2])
+        # the ones staged before the failure are only published
+        self.assertEqual([1, 1, 1, 1, 1], [self.session.stages.count(number) for number in range(5)])
+        self.assertEqual([], self.session.discarded)
+    
+    def testDroppedAfterFailure(self):
+        self.session.failures[2] = self.session.sendRetries + 1
+        self.assertRaises(OSError, self.session.send, b'0123456789')
+        # the chunks before the failed one are readable, the others are removed
+        self.assertEqual([0, 1], [number for number, _ in self.session.published])
+        self.assertEqual([3, 4], self.session.discarded)
+        self.assertEqual(set(), self.session.stagedUnits)
+        self.assertEqual(2, self.session.sent)
+        # nothing of the failed send with the next one, sent after the readable chunks
+        self.session.send(b'ab')
+        self.assertEqual([(0, b'01'), (1, b'23'), (2, b'ab')], self.session.published)
+        self.assertEqual(3, self.session.sent)
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
@@ -4,9 +4,14 @@ Created on 4 avr. 2020
 @author: Cedric
 '''
 import unittest
-from remoteconanywhere.folder import FolderCommClient, FolderCommServer
+from remoteconanywhere.folder import FolderCommClient, FolderCommServer, FolderCommunicationSession,\
+    DURABILITY_NONE, DURABILITY_FSYNC, DURABILITY_GROUP
 from abstract_comm_test import AbstractCommTest
+from remoteconanywhere.communication import ReclaimJournal
 import os
+import shutil
+import tempfile
+import time
 
 def patch_os_remove():
     temp = os.remove
@@ -35,6 +40,425 @@ class TestFolderComm(AbstractCommTest):
             print("File", fil, "still exists at the end.")
         os.rmdir(self.sharedfolder)
 
+class TestFolderCommHintFile(TestFolderComm):
+    def setUp(self):
+        AbstractCommTest.setUp(self)
+        self.sharedfolder = sharedfolder = os.path.join(os.getcwd(), "reception")
+        self.server = FolderCommServer("localhost-server", sharedfolder, useHintFile=True)
+        self.client = FolderCommClient("localhost-client", sharedfolder, useHintFile=True)
+
+
+class TestFolderHintFile(unittest.TestCase):
+    def setUp(self):
+        self.sharedfolder = tempfile.mkdtemp(prefix="reception")
+        self.sess1 = FolderCommunicationSession('1', '2', 99, self.sharedfolder, None, useHintFile=True)
+        self.sess2 = FolderCommunicationSession('2', '1', 99, self.sharedfolder, None, useHintFile=True)
+    
+    def tearDown(self):
+        # consumed files deleted in the background
+        self.sess2.flushReclaims(5)
+        shutil.rmtree(self.sharedfolder)
+    
+    def testHighWaterMark(self):
+        self.assertFalse(self.sess2.checkIfDataAvailable())
+        for i in range(3):
+            self.sess1.send(b'Some data %d' % i)
+        self.assertEqual(3, self.sess2.readHintFile())
+        # chunks below the mark are known without checking their existence
+        exists = os.path.exists
+        for i in range(3):
+            os.path.exists = lambda path: self.fail("No stat expected for %s" % path)
+            try:
+                self.assertTrue(self.sess2.checkIfDataAvailable())
+            finally:
+                os.path.exists = exists
+            self.assertEqual(b'Some data %d' % i, self.sess2.receiveChunk())
+        self.assertFalse(self.sess2.checkIfDataAvailable())
+    
+    def testWithoutHintFileFromOtherSide(self):
+        self.sess1.useHintFile = False
+        self.sess1.send(b'Some data')
+        self.assertTrue(self.sess2.checkIfDataAvailable())
+        self.assertEqual(b'Some data', self.sess2.receiveChunk())
+    
+    def testHintFileRemovedOnClose(self):
+        self.sess1.send(b'Some data')
+        self.sess1.close()
+        self.assertEqual(b'Some data', self.sess2.receiveChunk())
+        self.assertEqual(None, self.sess2.receiveChunk())
+        self.assertFalse([f for f in os.listdir(self.sharedfolder) if f.endswith('.hwm')])
+
+
+class TestFolderCommReadAhead(TestFolderComm):
+    def setUp(self):
+        AbstractCommTest.setUp(self)
+        self.sharedfolder = sharedfolder = os.path.join(os.getcwd(), "reception")
+        self.server = FolderCommServer("localhost-server", sharedfolder, readAhead=4)
+        self.client = FolderCommClient("localhost-client", sharedfolder, readAhead=4)
+
+
+class TestFolderReadAhead(unittest.TestCase):
+    def setUp(self):
+        self.sharedfolder = tempfile.mkdtemp(prefix="reception")
+        self.sess1 = FolderCommunicationSession('1', '2', 99, self.sharedfolder, None)
+        self.sess2 = FolderCommunicationSession('2', '1', 99, self.sharedfolder, None, readAhead=4, readAheadWorkers=2)
+    
+    def tearDown(self):
+        self.sess2.close(True)
+        shutil.rmtree(self.sharedfolder)
+    
+    def testReadAhead(self):
+        self.assertEqual(b'', self.sess2.receiveChunk())
+        for i in range(10):
+            self.sess1.send(b'Some data %d' % i)
+        self.assertEqual(b'Some data 0', self.sess2.receiveChunk())
+        # next chunks are being read
+        self.assertEqual(set(range(1, 5)), set(self.sess2.readAheadFutures))
+        for i in range(1, 10):
+            self.assertEqual(b'Some data %d' % i, self.sess2.receiveChunk())
+        self.assertFalse(self.sess2.checkIfDataAvailable())
+        self.assertEqual(b'', self.sess2.receiveChunk())
+        # chunks written after a prefetch that found nothing
+        self.sess1.send(b'Some more data')
+        self.assertEqual(b'Some more data', self.sess2.receiveChunk())
+        # consumed files deleted in the background
+        self.sess2.reclaimQueue.join()
+        self.assertFalse([f for f in os.listdir(self.sharedfolder) if f.endswith('.bin')])
+    
+    def testReadAheadLiveStream(self):
+        self.sess1.send(b'Some data 0')
+        self.assertEqual(b'Some data 0', self.sess2.receiveChunk())
+        # read before being written
+        for future in list(self.sess2.readAheadFutures.values()):
+            self.assertIsNone(future.result(5))
+        for i in range(1, 4):
+            self.sess1.send(b'Some data %d' % i)
+        self.assertEqual(b'Some data 1', self.sess2.receiveChunk())
+        # the ones that found nothing are read again
+        self.assertEqual(b'Some data 2', self.sess2.readAheadFutures[2].result(5))
+        self.assertEqual(b'Some data 3', self.sess2.readAheadFutures[3].result(5))
+        for i in range(2, 4):
+            self.assertEqual(b'Some data %d' % i, self.sess2.receiveChunk())
+
+
+class TestFolderReclaim(unittest.TestCase):
+    def setUp(self):
+        self.sharedfolder = tempfile.mkdtemp(prefix="reception")
+        self.journalPath = os.path.join(tempfile.mkdtemp(prefix="journal"), "reclaim.journal")
+        self.journal = ReclaimJournal(self.journalPath)
+        self.sess1 = FolderCommunicationSession('1', '2', 99, self.sharedfolder, None)
+        self.sess2 = FolderCommunicationSession('2', '1', 99, self.sharedfolder, None, reclaimJournal=self.journal)
+    
+    def tearDown(self):
+        self.sess2.close(True)
+        self.journal.close()
+        shutil.rmtree(self.sharedfolder)
+        shutil.rmtree(os.path.dirname(self.journalPath))
+    
+    def chunkFiles(self):
+        return [f for f in os.listdir(self.sharedfolder) if f.endswith('.bin')]
+    
+    def testDeletedInBackground(self):
+        for i in range(10):
+            self.sess1.send(b'Some data %d' % i)
+        for i in range(10):
+            self.assertEqual(b'Some data %d' % i, self.sess2.receiveChunk())
+        self.assertEqual(b'', self.sess2.receiveChunk())
+        self.assertTrue(self.sess2.flushReclaims(5))
+        self.assertEqual([], self.chunkFiles())
+        self.assertEqual(10, self.sess2.reclaimedCount)
+        self.assertFalse(self.journal.pending)
+    
+    def testRecoveredAfterRestart(self):
+        self.sess1.send(b'Some data')
+        # consumed, the process stopped before the deletion
+        self.journal.consumed([self.sess2.receptionFilePath(0)])
+        journal = ReclaimJournal(self.journalPath)
+        sess = FolderCommunicationSession('2', '1', 99, self.sharedfolder, None, reclaimJournal=journal)
+        self.assertEqual([], self.chunkFiles())
+        self.assertEqual(b'', sess.receiveChunk())
+        sess.close(True)
+        journal.close()
+
+
+class TestFolderBatches(unittest.TestCase):
+    def setUp(self):
+        self.sharedfolder = tempfile.mkdtemp(prefix="reception")
+        self.sess1 = FolderCommunicationSession('1', '2', 99, self.sharedfolder, None)
+        self.sess2 = FolderCommunicationSession('2', '1', 99, self.sharedfolder, None)
+        self.sess1.maxdatalength = 4
+    
+    def tearDown(self):
+        self.sess2.close(True)
+        self.sess2.flushReclaims(5)
+        shutil.rmtree(self.sharedfolder)
+    
+    def testReceiveAvailable(self):
+        self.assertEqual([], self.sess2.receiveAvailable())
+        self.sess1.sendMany([b'Some data', b'More'])
+        listings = []
+        scandir = os.scandir
+        def countingScandir(path):
+            listings.append(path)
+            return scandir(path)
+        os.scandir = countingScandir
+        try:
+            self.assertEqual([b'Some'], self.sess2.receiveAvailable(1))
+            self.assertEqual([b' dat', b'a', b'More'], self.sess2.receiveAvailable())
+        finally:
+            os.scandir = scandir
+        # the folder listed once to find the 3 following chunks
+        self.assertEqual(1, len(listings))
+        self.assertEqual(4, self.sess2.received)
+        # the close message in one chunk
+        self.sess1.maxdatalength = 1000
+        self.sess1.close()
+        self.assertIsNone(self.sess2.receiveAvailable())
+    
+    def testHintFileOncePerBatch(self):
+        sess = FolderCommunicationSession('3', '2', 99, self.sharedfolder, None, useHintFile=True)
+        sess.maxdatalength = 4
+        writes = []
+        sess.writeHintFile = lambda: writes.append(sess.sent)
+        sess.sendMany([b'Some data', b'More'])
+        self.assertEqual([4], writes)
+        sess.close(True)
+
+
+class TestFolderPrefetch(unittest.TestCase):
+    def setUp(self):
+        self.sharedfolder = tempfile.mkdtemp(prefix="reception")
+        self.sess1 = FolderCommunicationSession('1', '2', 99, self.sharedfolder, None)
+        self.sess2 = FolderCommunicationSession('2', '1', 99, self.sharedfolder, None)
+    
+    def tearDown(self):
+        self.sess2.close(True)
+        self.sess2.flushReclaims(5)
+        shutil.rmtree(self.sharedfolder)
+    
+    def testPrefetch(self):
+        self.sess2.startPrefetch(maxChunks=2)
+        for i in range(5):
+            self.sess1.send(b'Some data %d' % i)
+        end = time.time() + 5
+        while len(self.sess2.prefetcher.chunks) < 2 and time.time() < end:
+            time.sleep(0.01)
+        time.sleep(0.2)
+        # the following ones are not read yet
+        self.assertEqual(2, self.sess2.received)
+        self.assertTrue(self.sess2.flushReclaims(5))
+        self.assertEqual(3, len([f for f in os.listdir(self.sharedfolder) if f.startswith('1,2,99,')]))
+        for i in range(5):
+            self.assertEqual(b'Some data %d' % i, self.sess2.receiveChunkWait(5))
+        self.sess1.close()
+        self.assertIsNone(self.sess2.receiveChunkWait(5))
+
+
+class TestFolderDiscovery(unittest.TestCase):
+    def setUp(self):
+        self.sharedfolder = tempfile.mkdtemp(prefix="reception")
+        self.discovery = FolderCommunicationSession('server', 'ANY', 0, self.sharedfolder, None)
+    
+    def tearDown(self):
+        shutil.rmtree(self.sharedfolder)
+    
+    def age(self, *paths):
+        '''Makes the files and the folder look older than the modification time resolution'''
+        past = time.time() - 10
+        for path in paths + (self.sharedfolder,):
+            os.utime(path, (past, past))
+    
+    def testUnicastAndBroadcast(self):
+        FolderCommunicationSession('client', 'server', 0, self.sharedfolder, None).send(b'for server')
+        broadcast = FolderCommunicationSession('client2', 'ANY', 0, self.sharedfolder, None)
+        broadcast.send(b'for everyone')
+        self.assertEqual(sorted([('client', b'for server'), ('client2', b'for everyone')]), sorted(self.discovery.discover()))
+        # broadcast kept, but not processed again
+        self.assertEqual(1, len(os.listdir(self.sharedfolder)))
+        self.assertEqual([], self.discovery.discover())
+        # broadcast rewritten
+        broadcast.sent = 0
+        broadcast.send(b'for everyone again')
+        self.age(os.path.join(self.sharedfolder, os.listdir(self.sharedfolder)[0]))
+        self.assertEqual([('client2', b'for everyone again')], self.discovery.discover())
+    
+    def testNoListingIfUnchanged(self):
+        self.age()
+        self.assertEqual([], self.discovery.discover())
+        scandir = os.scandir
+        os.scandir = lambda path: self.fail("No listing expected for %s" % path)
+        try:
+            self.assertEqual([], self.discovery.discover())
+        finally:
+            os.scandir = scandir
+        FolderCommunicationSession('client', 'server', 0, self.sharedfolder, None).send(b'for server')
+        self.assertEqual([('client', b'for server')], self.discovery.discover())
+
+
+class TestFolderGarbageCollection(unittest.TestCase):
+    def setUp(self):
+        self.sharedfolder = tempfile.mkdtemp(prefix="reception")
+        self.server = FolderCommServer("server", self.sharedfolder, useHintFile=True)
+    
+    def tearDown(self):
+        shutil.rmtree(self.sharedfolder)
+    
+    def testCollectDeadSessions(self):
+        dead = FolderCommunicationSession('client', 'server', 5, self.sharedfolder, None, useHintFile=True)
+        dead.send(b'0123456789')
+        dead.send(b'0123456789')
+        alive = FolderCommunicationSession('client', 'server', 6, self.sharedfolder, None)
+        alive.send(b'alive')
+        opened = self.server.createSession('client', 'server', 7)
+        self.server.openedsessions.add(opened)
+        opened.send(b'opened')
+        abandoned = os.path.join(self.sharedfolder, '.client,server,8,0.bin.tmp')
+        with open(abandoned, 'wb') as fout:
+            fout.write(b'01234')
+        # make everything old, except the live session
+        past = time.time() - 3600 * 48
+        for fil in os.listdir(self.sharedfolder):
+            if ',6,' not in fil:
+                os.utime(os.path.join(self.sharedfolder, fil), (past, past))
+        
+        reclaimed = self.server.collectGarbage()
+        
+        remaining = sorted(os.listdir(self.sharedfolder))
+        self.assertEqual(['.server,client,7.hwm', 'client,server,6,0.bin', 'server,client,7,0.bin'], remaining)
+        # two chunks, the hint file and the temporary file
+        self.assertEqual(10 + 10 + 1 + 5, reclaimed)
+        self.assertEqual(reclaimed, self.server.reclaimedBytes)
+        self.assertEqual(0, self.server.collectGarbage())
+    
+    def testCollectIncrementally(self):
+        dead = FolderCommunicationSession('client', 'server', 5, self.sharedfolder, None)
+        for _ in range(5):
+            dead.send(b'0')
+        past = time.time() - 3600 * 48
+        for fil in os.listdir(self.sharedfolder):
+            os.utime(os.path.join(self.sharedfolder, fil), (past, past))
+        self.assertEqual(3, self.server.collectGarbage(maxFiles=3))
+        self.assertEqual(2, self.server.collectGarbage(maxFiles=3))
+        self.assertEqual([], os.listdir(self.sharedfolder))
+    
+    def testCleanUp(self):
+        FolderCommunicationSession('client', 'server', 5, self.sharedfolder, None).send(b'0')
+        self.server.cleanUp()
+        self.assertEqual([], os.listdir(self.sharedfolder))
+    
+    def testGarbageCollectorStopped(self):
+        self.server.showCapabilities()
+        self.server.startGarbageCollector(3600)
+        gcThread = self.server.gcThread
+        self.server.stop()
+        # not after the next collection
+        gcThread.join(1)
+        self.assertFalse(gcThread.is_alive())
+
+
+class TestFolderDurability(unittest.TestCase):
+    def setUp(self):
+        self.sharedfolder = tempfile.mkdtemp(prefix="reception")
+        self.sessions = []
+    
+    def tearDown(self):
+        for session in self.sessions:
+            session.flushReclaims(5)
+        shutil.rmtree(self.sharedfolder)
+    
+    def createSessions(self, durability):
+        sess1 = FolderCommunicationSession('1', '2', 99, self.sharedfolder, None, durability, 0.01)
+        sess2 = FolderCommunicationSession('2', '1', 99, self.sharedfolder, None, durability, 0.01)
+        self.sessions += [sess1, sess2]
+        return sess1, sess2
+    
+    def testNoFsync(self):
+        sess1, sess2 = self.createSessions(DURABILITY_NONE)
+        sess1.send(b'Some data')
+        self.assertEqual(b'Some data', sess2.receiveChunk())
+        self.assertEqual(0, sess1.fsyncCount)
+    
+    def testFsyncEachChunk(self):
+        sess1, sess2 = self.createSessions(DURABILITY_FSYNC)
+        for i in range(3):
+            sess1.send(b'Some data %d' % i)
+        # one for the file, one for the directory
+        self.assertEqual(6 if os.name != 'nt' else 3, sess1.fsyncCount)
+        self.assertGreaterEqual(sess1.fsyncMaxTime, sess1.fsyncMeanTime)
+        for i in range(3):
+            self.assertEqual(b'Some data %d' % i, sess2.receiveChunk())
+    
+    def testGroupCommit(self):
+        sess1, sess2 = self.createSessions(DURABILITY_GROUP)
+        for i in range(5):
+            sess1.send(b'Some data %d' % i)
+        self.assertEqual(0, sess1.fsyncCount)
+        time.sleep(0.2)
+        # five files and the directory, at once
+        self.assertEqual(6 if os.name != 'nt' else 5, sess1.fsyncCount)
+        self.assertEqual([], sess1.groupCommitPending)
+        for i in range(5):
+            self.assertEqual(b'Some data %d' % i, sess2.receiveChunk())
+    
+    def testGroupCommitOnClose(self):
+        sess1, _sess2 = self.createSessions(DURABILITY_GROUP)
+        sess1.groupCommitInterval = 60
+        sess1.send(b'Some data')
+        sess1.close()
+        self.assertEqual([], sess1.groupCommitPending)
+        self.assertGreater(sess1.fsyncCount, 0)
+    
+    def testGroupCommitRetried(self):
+        sess1, sess2 = self.createSessions(DURABILITY_GROUP)
+        sess1.groupCommitRetry = 0.05
+        timedFsync = sess1.timedFsync
+        def failingOnce(fd):
+            sess1.timedFsync = timedFsync
+            raise OSError(5, "Input/output error")
+        sess1.timedFsync = failingOnce
+        sess1.send(b'Some data')
+        # published by the next try, the sender is not told of an error
+        deadline = time.time() + 5
+        while not sess2.checkIfDataAvailable() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(b'Some data', sess2.receiveChunk())
+        sess1.send(b'More data')
+        sess1.commitGroup()
+        self.assertEqual(b'More data', sess2.receiveChunk())
+    
+    def testGroupCommitFailed(self):
+        sess1, sess2 = self.createSessions(DURABILITY_GROUP)
+        sess1.groupCommitInterval = sess1.groupCommitRetry = 60
+        timedFsync = sess1.timedFsync
+        def failing(fd):
+            raise OSError(28, "No space left on device")
+        sess1.timedFsync = failing
+        sess1.send(b'Some data')
+        sess1.commitGroup()
+        self.assertFalse(sess2.checkIfDataAvailable())
+        # the sender is told, the chunk still pending
+        self.assertRaises(OSError, sess1.send, b'More data')
+        self.assertEqual(1, len(sess1.groupCommitPending))
+        sess1.timedFsync = timedFsync
+        sess1.send(b'More data')
+        sess1.commitGroup()
+        self.assertEqual(b'Some data', sess2.receiveChunk())
+        self.assertEqual(b'More data', sess2.receiveChunk())
+        self.assertEqual(2, sess1.groupCommitted)
+    
+    def testGroupCommitBeforePublication(self):
+        sess1 = FolderCommunicationSession('1', '2', 98, self.sharedfolder, None, DURABILITY_GROUP, 60, useHintFile=True)
+        sess2 = FolderCommunicationSession('2', '1', 98, self.sharedfolder, None, useHintFile=True)
+        self.sessions += [sess1, sess2]
+        sess1.sendMany([b'Some data', b'More data'])
+        # not durable yet: neither the chunks nor the hint file are visible
+        self.assertFalse(sess2.checkIfDataAvailable())
+        self.assertEqual([], [f for f in os.listdir(self.sharedfolder) if not f.startswith('.')])
+        self.assertIsNone(sess2.readHintFile())
+        sess1.commitGroup()
+        self.assertEqual(2, sess2.readHintFile())
+        self.assertEqual([b'Some data', b'More data'], sess2.receiveAvailable())
+
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
@@ -5,9 +5,12 @@ Created on 13 avr. 2020
 '''
 import unittest
 from configurationoftests import ftpFactory, FOLDER_SHARED_WITH_FTP, FTPFOLDER
-from remoteconanywhere.ftp import FtpCommClient, FtpCommServer, FtpCommunicationSession
+from ftp_standin import FtpStandInServer
+from remoteconanywhere.cred import MyCredManager
+from remoteconanywhere.ftp import FtpCommClient, FtpCommServer, FtpCommunicationSession, FtpConnectionPool, FtpPoller,\
+    createFtpConnection
 from abstract_comm_test import AbstractCommTest
-import os
+import ftplib, os, shutil, socket, tempfile, threading, time
 from remoteconanywhere.folder import FolderCommServer, FolderCommClient
 
 SHAREDFOLDER = os.path.join(os.getcwd(), "reception",FTPFOLDER)
@@ -26,15 +29,20 @@ else:
     def cleaning():
         pass
 
+CREDFILE = os.path.join(os.path.dirname(__file__), "credentials.json")
+
 class TestFtpCommunication(unittest.TestCase):
+    ftpFactory = staticmethod(ftpFactory)
+    cleaning = staticmethod(cleaning)
+    
     def setUp(self):
-        self.sess1 = FtpCommunicationSession('1', '2', 99, ftpFactory())
-        self.sess2 = FtpCommunicationSession('2', '1', 99, ftpFactory())
+        self.sess1 = FtpCommunicationSession('1', '2', 99, self.ftpFactory())
+        self.sess2 = FtpCommunicationSession('2', '1', 99, self.ftpFactory())
     
     def tearDown(self):
         self.sess1.close(True)
         self.sess2.close(True)
-        cleaning()
+        self.cleaning()
 
     def testSimpleCommunication(self):
         tosend = b"Some data"
@@ -74,6 +82,163 @@ class TestFtpCommunication(unittest.TestCase):
         self.assertEqual(b'a', self.sess2.receiveOneByte(0.01))
         self.assertEqual(None, self.sess2.receiveOneByte(0.01))
 
+class TestFtpConnectionPool(unittest.TestCase):
+    ftpFactory = staticmethod(ftpFactory)
+    cleaning = staticmethod(cleaning)
+    
+    def setUp(self):
+        self.pool = FtpConnectionPool(self.ftpFactory, size=2, keepalive=0.2)
+    
+    def tearDown(self):
+        self.pool.close()
+        self.cleaning()
+    
+    def testReuse(self):
+        with self.pool.connection() as ftp:
+            first = ftp
+        with self.pool.connection() as ftp:
+            self.assertIs(first, ftp)
+        self.assertEqual(1, len(self.pool.connections))
+    
+    def testSize(self):
+        borrowed = []
+        def borrowing():
+            with self.pool.connection() as ftp:
+                borrowed.append(ftp)
+                time.sleep(0.3)
+        threads = [threading.Thread(target=borrowing) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(4, len(borrowed))
+        self.assertEqual(2, len(set(borrowed)))
+        self.assertEqual(2, len(self.pool.connections))
+    
+    def testKeepalive(self):
+        with self.pool.connection() as ftp:
+            ftp.pwd()
+        time.sleep(0.5)
+        self.assertGreater(self.pool.noopCount, 0)
+        with self.pool.connection() as ftp:
+            ftp.pwd()
+    
+    def testBrokenConnectionDiscarded(self):
+        with self.assertRaises((OSError, EOFError)):
+            with self.pool.connection() as ftp:
+                broken = ftp
+                # as after an idle timeout of the server
+                ftp.sock.shutdown(socket.SHUT_RDWR)
+                ftp.pwd()
+        self.assertNotIn(broken, self.pool.connections)
+        with self.pool.connection() as ftp:
+            self.assertIsNot(broken, ftp)
+            ftp.pwd()
+
+
+class TestFtpPoller(unittest.TestCase):
+    ftpFactory = staticmethod(ftpFactory)
+    cleaning = staticmethod(cleaning)
+    
+    def setUp(self):
+        self.pool = FtpConnectionPool(self.ftpFactory)
+        self.poller = FtpPoller(self.pool, pollInterval=10)
+        self.sessions = [FtpCommunicationSession('1', '2', sid, self.pool, self.poller) for sid in range(1, 6)]
+    
+    def tearDown(self):
+        for session in self.sessions:
+            session.close(True)
+        self.pool.close()
+        self.cleaning()
+    
+    def testOneListingForAllSessions(self):
+        writer = FtpCommunicationSession('2', '1', 3, self.pool, self.poller)
+        writer.send(b"Some data")
+        self.poller.poll(force=True)
+        self.assertEqual([False, False, True, False, False], [session.checkIfDataAvailable() for session in self.sessions])
+        self.assertEqual(b"Some data", self.sessions[2].receiveChunk())
+        self.assertFalse(self.sessions[2].checkIfDataAvailable())
+        # answered from the index
+        self.assertEqual(1, self.poller.pollCount)
+
+
+class TestFtpParallelTransfers(unittest.TestCase):
+    ftpFactory = staticmethod(ftpFactory)
+    cleaning = staticmethod(cleaning)
+    
+    def setUp(self):
+        self.pool = FtpConnectionPool(self.ftpFactory)
+        self.sess1 = FtpCommunicationSession('1', '2', 98, self.pool)
+        self.sess2 = FtpCommunicationSession('2', '1', 98, self.pool)
+    
+    def tearDown(self):
+        self.sess1.close(True)
+        self.sess2.close(True)
+        self.pool.close()
+        self.cleaning()
+    
+    def testBigSend(self):
+        self.sess1.maxdatalength = 1000
+        tosend = os.urandom(10500)
+        self.sess1.send(tosend)
+        self.assertEqual(11, self.sess1.sent)
+        received = b''
+        while len(received) < len(tosend):
+            chunk = self.sess2.receiveChunkWait(10)
+            self.assertTrue(chunk)
+            received += chunk
+        self.assertEqual(tosend, received)
+        self.assertEqual(11, self.sess2.received)
+        self.assertFalse(self.sess2.checkIfDataAvailable(), "data available??")
+
+
+class TestFtpStreamMode(unittest.TestCase):
+    ftpFactory = staticmethod(ftpFactory)
+    cleaning = staticmethod(cleaning)
+    
+    def setUp(self):
+        self.pool = FtpConnectionPool(self.ftpFactory)
+        self.sess1 = FtpCommunicationSession('1', '2', 97, self.pool, streamMode=True, rotateSize=3000)
+        self.sess2 = FtpCommunicationSession('2', '1', 97, self.pool, streamMode=True, rotateSize=3000)
+    
+    def tearDown(self):
+        self.sess1.close()
+        # the reader deletes the stream file when it receives the closing
+        while self.sess2.receiveChunkWait(5, False) is not None:
+            pass
+        self.sess2.close(True)
+        self.pool.close()
+        self.cleaning()
+    
+    def testSmallChunks(self):
+        tosend = [os.urandom(100) for _i in range(50)]
+        for chunk in tosend:
+            self.sess1.send(chunk)
+        received = []
+        while len(received) < len(tosend):
+            chunk = self.sess2.receiveChunkWait(10)
+            self.assertTrue(chunk)
+            received.append(chunk)
+        self.assertEqual(tosend, received)
+        # rotated at 3000 bytes, the files read are deleted
+        self.assertEqual(self.sess1.streamSent, self.sess2.streamReceived)
+        self.assertGreater(self.sess2.streamReceived, 0)
+        self.assertFalse(self.sess2.checkIfDataAvailable(), "data available??")
+    
+    def testBigSend(self):
+        self.sess1.maxdatalength = 1000
+        tosend = os.urandom(10500)
+        self.sess1.send(tosend)
+        self.assertEqual(11, self.sess1.sent)
+        received = b''
+        while len(received) < len(tosend):
+            chunk = self.sess2.receiveChunkWait(10)
+            self.assertTrue(chunk)
+            received += chunk
+        self.assertEqual(tosend, received)
+        self.assertEqual(11, self.sess2.received)
+
+
 class TestFullFtp(AbstractCommTest):
     def setUp(self):
         #self.skipTest("because")
@@ -88,6 +253,30 @@ class TestFullFtp(AbstractCommTest):
     #skipped = True
     
 
+class TestFullFtpShared(AbstractCommTest):
+    def setUp(self):
+        super().setUp()
+        self.server = FtpCommServer("localhost-server", ftpFactory, share=True)
+        self.client = FtpCommClient("localhost-client", ftpFactory, share=True)
+
+    def tearDown(self):
+        super().tearDown()
+        self.client.close()
+        cleaning()
+    
+
+class TestFullFtpStream(AbstractCommTest):
+    def setUp(self):
+        super().setUp()
+        self.server = FtpCommServer("localhost-server", ftpFactory, streamMode=True)
+        self.client = FtpCommClient("localhost-client", ftpFactory, streamMode=True)
+
+    def tearDown(self):
+        super().tearDown()
+        self.client.close()
+        cleaning()
+    
+
 class TestClientFtp(AbstractCommTest):
     def setUp(self):
         #self.skipTest("because")
@@ -122,6 +311,297 @@ class TestServerFtp(AbstractCommTest):
         skipped = True
 
 
+class StandIn:
+    '''Starts a fresh in-process FTP server over a temporary folder for each test, no FTP server needed'''
+    latency = 0.
+    
+    def startStandIn(self):
+        self.standinRoot = tempfile.mkdtemp(prefix="ftpstandin")
+        self.standin = FtpStandInServer(self.standinRoot, latency=self.latency)
+        self.standin.start()
+    
+    def stopStandIn(self):
+        self.standin.stop()
+        shutil.rmtree(self.standinRoot, ignore_errors=True)
+    
+    def ftpFactory(self):
+        return createFtpConnection(FTPFOLDER, '127.0.0.1', MyCredManager(CREDFILE), port=self.standin.port)
+    
+    def cleaning(self):
+        # the temporary folder is removed with the server
+        pass
+
+
+class StandInTest(StandIn):
+    def setUp(self):
+        self.startStandIn()
+        super().setUp()
+    
+    def tearDown(self):
+        super().tearDown()
+        self.stopStandIn()
+
+
+class TestStandInFtpCommunication(StandInTest, TestFtpCommunication):
+    
+    def testCommandsPerChunk(self):
+        self.assertFalse(self.sess2.checkIfDataAvailable(), "data available??")
+        self.standin.resetCounts()
+        self.sess1.send(b"Some data")
+        self.assertEqual(b"Some data", self.sess2.receiveChunkWait(10))
+        counts = self.standin.commandCounts
+        self.assertEqual(1, counts['STOR'])
+        self.assertEqual(1, counts['RETR'])
+        # no new connection, no probe
+        self.assertEqual(0, counts['USER'] + counts['PWD'] + counts['SIZE'])
+    
+    def testCommandsInStreamMode(self):
+        sess1 = FtpCommunicationSession('1', '2', 96, self.ftpFactory(), streamMode=True)
+        sess2 = FtpCommunicationSession('2', '1', 96, self.ftpFactory(), streamMode=True)
+        try:
+            self.standin.resetCounts()
+            tosend = [os.urandom(100) for _i in range(10)]
+            for chunk in tosend:
+                sess1.send(chunk)
+            self.assertEqual(tosend, [sess2.receiveChunkWait(10) for _i in range(10)])
+            counts = self.standin.commandCounts
+            self.assertEqual(10, counts['STOR'] + counts['APPE'])
+            self.assertEqual(0, counts['RNFR'] + counts['DELE'])
+            # all the chunks in one retrieval
+            self.assertEqual(1, counts['RETR'])
+        finally:
+            sess1.close(True)
+            sess2.close(True)
+    
+    def testBatches(self):
+        tosend = [os.urandom(100) for _i in range(10)]
+        self.sess1.sendMany(tosend)
+        self.standin.resetCounts()
+        self.assertEqual(tosend, self.sess2.receiveAvailable())
+        # one listing for all the chunks
+        self.assertEqual(1, self.standin.commandCounts['MLSD'])
+        self.assertEqual(10, self.standin.commandCounts['RETR'])
+        sess1 = FtpCommunicationSession('1', '2', 95, self.ftpFactory(), streamMode=True)
+        sess2 = FtpCommunicationSession('2', '1', 95, self.ftpFactory(), streamMode=True)
+        try:
+            self.standin.resetCounts()
+            sess1.sendMany(tosend)
+            self.assertEqual(1, self.standin.commandCounts['STOR'] + self.standin.commandCounts['APPE'])
+            self.standin.resetCounts()
+            self.assertEqual(tosend, sess2.receiveAvailable())
+            self.assertEqual(1, self.standin.commandCounts['MLSD'])
+            self.assertEqual(1, self.standin.commandCounts['RETR'])
+        finally:
+            sess1.close(True)
+            sess2.close(True)
+
+
+    def testDeletedInBackground(self):
+        for i in range(10):
+            self.sess1.send(b"Some data %d" % i)
+        self.standin.resetCounts()
+        for i in range(10):
+            self.assertEqual(b"Some data %d" % i, self.sess2.receiveChunkWait(10))
+        self.assertTrue(self.sess2.flushReclaims(5))
+        self.assertEqual(10, self.standin.commandCounts['DELE'])
+        self.assertEqual([], [f for f in os.listdir(os.path.join(self.standinRoot, FTPFOLDER)) if f.endswith('.bin')])
+    
+    def testDeletedBeforeSharedPoolClosed(self):
+        pool = FtpConnectionPool(self.ftpFactory)
+        sess = FtpCommunicationSession('2', '1', 94, pool)
+        sender = FtpCommunicationSession('1', '2', 94, self.ftpFactory())
+        try:
+            for i in range(3):
+                sender.send(b"Some data %d" % i)
+            for i in range(3):
+                self.assertEqual(b"Some data %d" % i, sess.receiveChunkWait(10))
+            self.standin.latency = {'DELE': 0.1}
+            # the session does not own the pool: its close waits for the deletions anyway
+            sess.close(True)
+            pool.close()
+            self.assertEqual([], [f for f in os.listdir(os.path.join(self.standinRoot, FTPFOLDER)) if ',94,' in f])
+        finally:
+            sender.close(True)
+
+
+class TestStandInFtpLatency(TestStandInFtpCommunication):
+    latency = 0.005
+
+
+class TestStandInFtpConnectionPool(StandInTest, TestFtpConnectionPool):
+    
+    def testConnectionsDropped(self):
+        with self.pool.connection() as ftp:
+            ftp.pwd()
+        self.standin.dropConnections()
+        with self.assertRaises((OSError, EOFError)):
+            with self.pool.connection() as ftp:
+                ftp.pwd()
+        self.assertEqual([], self.pool.connections)
+
+
+class TestStandInFtpReconnect(StandIn, unittest.TestCase):
+    def setUp(self):
+        self.startStandIn()
+        self.pool = FtpConnectionPool(self.ftpFactory, retries=3, backoff=0.01)
+        self.sess1 = FtpCommunicationSession('1', '2', 95, self.pool)
+        self.sess2 = FtpCommunicationSession('2', '1', 95, self.pool)
+    
+    def tearDown(self):
+        self.sess1.close(True)
+        self.sess2.close(True)
+        self.pool.close()
+        self.stopStandIn()
+    
+    def exchange(self, *tosend):
+        for data in tosend:
+            self.sess1.send(data)
+        for data in tosend:
+            self.assertEqual(data, self.sess2.receiveChunkWait(10))
+        self.assertFalse(self.sess2.checkIfDataAvailable(), "data available??")
+    
+    def testIdleDisconnect(self):
+        self.exchange(b"Some data")
+        self.standin.dropConnections()
+        self.exchange(b"Some more data")
+        self.assertGreater(self.pool.reconnectCount, 0)
+    
+    def testUploadRetried(self):
+        self.standin.dropOn('STOR')
+        self.exchange(b"Some data", b"Some more data")
+        self.assertEqual(1, self.pool.reconnectCount)
+        self.assertEqual(3, self.standin.commandCounts['STOR'])
+    
+    def testRenamedBeforeDisconnect(self):
+        self.standin.dropOn('RNTO', after=True)
+        self.exchange(b"Some data", b"Some more data")
+        self.assertEqual(1, self.pool.reconnectCount)
+    
+    def testRenameRefused(self):
+        stageUnit = self.sess1.stageUnit
+        def lostOnce(number, data):
+            self.sess1.stageUnit = stageUnit
+            stageUnit(number, data)
+            os.remove(os.path.join(self.standinRoot, FTPFOLDER, "." + self.sess1.sendFileName(number) + ".tmp"))
+        self.sess1.stageUnit = lostOnce
+        # not taken as already renamed: the chunk does not exist, uploaded again by the next try
+        self.sess1.sendRetries = 1
+        self.sess1.sendBackoff = 0.01
+        self.exchange(b"Some data", b"Some more data")
+        self.assertEqual(3, self.standin.commandCounts['STOR'])
+    
+    def testRenameRefusedDropped(self):
+        self.sess1.maxdatalength = 4
+        self.exchange(b"Some")
+        rename = self.sess1.rename
+        def refused(ftp, filename):
+            if filename == self.sess1.sendFileName(2):
+                raise ftplib.error_perm("550 Permission denied")
+            rename(ftp, filename)
+        self.sess1.rename = refused
+        with self.assertRaises(ftplib.error_perm):
+            self.sess1.send(b"Some data")
+        self.sess1.rename = rename
+        # the chunk before is readable, the temporary files of the others are deleted
+        self.assertEqual(2, self.sess1.sent)
+        self.assertEqual(set(), self.sess1.stagedUnits)
+        self.assertEqual([], [name for name in os.listdir(os.path.join(self.standinRoot, FTPFOLDER)) if name.endswith(".tmp")])
+        self.sess1.send(b"More")
+        self.assertEqual(b"Some", self.sess2.receiveChunkWait(10))
+        self.assertEqual(b"More", self.sess2.receiveChunkWait(10))
+        self.assertFalse(self.sess2.checkIfDataAvailable(), "data available??")
+    
+    def testDeletedBeforeDisconnect(self):
+        self.sess1.send(b"Some data")
+        self.sess1.send(b"Some more data")
+        self.standin.dropOn('DELE', after=True)
+        self.assertEqual(b"Some data", self.sess2.receiveChunkWait(10))
+        self.assertEqual(b"Some more data", self.sess2.receiveChunkWait(10))
+        self.assertTrue(self.sess2.flushReclaims(5))
+        self.assertEqual(1, self.pool.reconnectCount)
+        self.assertEqual(2, self.sess2.reclaimedCount)
+    
+    def testStreamRewritten(self):
+        self.sess1.streamMode = self.sess2.streamMode = True
+        self.standin.dropOn('APPE')
+        # the first one stored, the second one appended then rewritten, the third one appended
+        self.exchange(b"Some data", b"Some more data", b"And more")
+        self.assertEqual(1, self.pool.reconnectCount)
+        self.assertEqual(2, self.standin.commandCounts['STOR'])
+    
+    def testServerGone(self):
+        self.exchange(b"Some data")
+        self.stopStandIn()
+        with self.assertRaises((OSError, EOFError)):
+            self.sess1.send(b"Some more data")
+        self.assertEqual(3, self.pool.reconnectCount)
+        self.assertEqual(1, self.sess1.sent)
+        # dropped, not sent with the next data
+        self.startStandIn()
+        self.sess1.send(b"And more")
+        self.assertEqual(b"And more", self.sess2.receiveChunkWait(10))
+        self.assertFalse(self.sess2.checkIfDataAvailable(), "data available??")
+
+
+class TestStandInFtpPoller(StandInTest, TestFtpPoller):
+    pass
+
+
+class TestStandInFtpParallelTransfers(StandInTest, TestFtpParallelTransfers):
+    
+    def testUploadDropped(self):
+        self.sess1.maxdatalength = 1000
+        tosend = os.urandom(8000)
+        self.standin.resetCounts()
+        self.standin.dropOn('STOR')
+        self.sess1.send(tosend)
+        counts = self.standin.commandCounts
+        # the dropped upload done again on a new connection, each chunk renamed once
+        self.assertEqual(9, counts['STOR'])
+        self.assertEqual(8, counts['RNFR'])
+        self.assertEqual(set(), self.sess1.stagedUnits)
+        received = b''
+        while len(received) < len(tosend):
+            chunk = self.sess2.receiveChunkWait(10)
+            self.assertTrue(chunk)
+            received += chunk
+        self.assertEqual(tosend, received)
+
+
+class TestStandInFtpStreamMode(StandInTest, TestFtpStreamMode):
+    pass
+
+
+class StandInCommTest(StandIn, AbstractCommTest):
+    skipped = True
+    options = {}
+    
+    def setUp(self):
+        super().setUp()
+        self.startStandIn()
+        self.server = FtpCommServer("localhost-server", self.ftpFactory, **self.options)
+        self.client = FtpCommClient("localhost-client", self.ftpFactory, **self.options)
+    
+    def tearDown(self):
+        super().tearDown()
+        self.client.close()
+        self.stopStandIn()
+
+
+class TestFullStandInFtp(StandInCommTest):
+    skipped = False
+
+
+class TestFullStandInFtpShared(StandInCommTest):
+    skipped = False
+    options = dict(share=True)
+
+
+class TestFullStandInFtpStream(StandInCommTest):
+    skipped = False
+    options = dict(streamMode=True)
+
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
@@ -3,22 +3,103 @@ Created on 23 avr. 2020
 
 @author: Cedric
 '''
-import unittest
+import unittest, os, time
+import unittest.mock as mock
 import abstract_comm_test
+from remoteconanywhere.communication import EchoActionServer, StoreAllActionServer
 from configurationoftests import imapFactory
+from imap_standin import ImapStandInServer
+from remoteconanywhere.cred import MyCredManager
 from remoteconanywhere.imap import ImapCommSession , Imap4CommServer,\
-    Imap4CommClient
+    Imap4CommClient, ImapDispatcher, ImapConnectionPool, createImapClient
+
+CREDFILE = os.path.join(os.path.dirname(__file__), "credentials.json")
+
+class TestImapParsing(unittest.TestCase):
+    def testParseFetch(self):
+        response = [(b'1 (UID 12 RFC822 {5}', b'mail1'), b')',
+                    (b'2 (RFC822 {5}', b'mail2'), b' UID 13)']
+        self.assertEqual({'12': b'mail1', '13': b'mail2'}, ImapDispatcher.parseFetch(response))
+    
+    def testParseSubjects(self):
+        response = [(b'1 (UID 3 BODY[HEADER.FIELDS (SUBJECT)] {39}', b'Subject: a-0-b-\r\n Message-0th\r\n\r\n'), b')']
+        self.assertEqual({'3': 'a-0-b- Message-0th'}, ImapDispatcher.parseSubjects(response))
+    
+    def testParseBinaryParts(self):
+        response = [(b'1 (UID 12 BINARY[1] ~{2}', b'\x00\x01'), (b' BINARY[2] ~{1}', b'\n'), b')']
+        self.assertEqual({1: b'\x00\x01', 2: b'\n'}, ImapDispatcher.parseBinaryParts(response))
+    
+    def testParseFetchItems(self):
+        response = [(b'1 (UID 3 BODY[HEADER.FIELDS (SUBJECT)] {22}', b'Subject: a-K\r\n\r\n'), (b' BODY[TEXT] {5}', b'echo\n'), b')',
+                    (b'2 (BODY[TEXT] {0}', b''), b' UID 4)']
+        self.assertEqual({'3': {b'BODY[HEADER.FIELDS (SUBJECT)]': b'Subject: a-K\r\n\r\n', b'BODY[TEXT]': b'echo\n'},
+                          '4': {b'BODY[TEXT]': b''}}, ImapDispatcher.parseFetchItems(response))
+    
+    def testMailToChunks(self):
+        session = ImapCommSession('1', '2', 5, None)
+        mail = (b'Subject: 2-5-1-Message-0th\r\nX-Remoteconanywhere-Chunks: 2\r\n'
+                b'Content-Type: multipart/mixed; boundary="b"\r\n\r\n'
+                b'--b\r\nContent-Type: application/octet-stream\r\nContent-Transfer-Encoding: base64\r\n\r\nAAE=\r\n'
+                b'--b\r\nContent-Type: application/octet-stream\r\nContent-Transfer-Encoding: base64\r\n\r\nCg==\r\n'
+                b'--b--\r\n')
+        self.assertEqual([b'\x00\x01', b'\n'], session.mailToChunks(mail))
+        mail = b'Subject: 2-5-1-Message-0th\r\nContent-Type: text/plain\r\n\r\nAAE='
+        self.assertEqual([b'\x00\x01'], session.mailToChunks(mail))
+
 
 class TestImapComm(unittest.TestCase):
+    imapFactory = staticmethod(imapFactory)
 
     def setUp(self):
-        self.sess1 = ImapCommSession('1', '2', 99, imapFactory())
-        self.sess2 = ImapCommSession('2', '1', 99, imapFactory())
+        self.sess1 = ImapCommSession('1', '2', 99, self.imapFactory())
+        self.sess2 = ImapCommSession('2', '1', 99, self.imapFactory())
     
     def tearDown(self):
         self.sess1.close(True)
         self.sess2.close(True)
 
+    def testBinaryPackedCommunication(self):
+        sess1 = ImapCommSession('1', '2', 98, self.imapFactory(), binary=True, packChunks=3)
+        sess2 = ImapCommSession('2', '1', 98, self.imapFactory(), binary=True, packChunks=3)
+        try:
+            sess1.maxdatalength = 1000
+            tosend = os.urandom(3500) + b'\r\n\n\r'
+            sess1.send(tosend)
+            # 4 chunks in 2 e-mails
+            self.assertEqual(4, sess1.sent)
+            received = b''
+            while len(received) < len(tosend):
+                chunk = sess2.receiveChunkWait(10)
+                self.assertTrue(chunk)
+                received += chunk
+            self.assertEqual(tosend, received)
+            self.assertEqual(4, sess2.received)
+            self.assertFalse(sess2.checkIfDataAvailable(), "data available??")
+        finally:
+            sess1.close(True)
+            sess2.close(True)
+    
+    def testOwnMailbox(self):
+        sess1 = ImapCommSession('1', '2', 97, self.imapFactory(), ownMailbox=True)
+        sess2 = ImapCommSession('2', '1', 97, self.imapFactory(), ownMailbox=True)
+        mailbox = sess1.dispatcher.mailbox
+        self.assertEqual(mailbox, sess2.dispatcher.mailbox)
+        try:
+            sess1.send(b"Some data")
+            self.assertEqual(b"Some data", sess2.receiveChunkWait(10))
+            sess2.send(b"Some data in return")
+            self.assertEqual(b"Some data in return", sess1.receiveChunkWait(10))
+            sess1.close()
+            self.assertIsNone(sess2.receiveChunkWait(10))
+            sess2.close()
+            client = self.imapFactory()
+            _typ, mailboxes = client.list(pattern=mailbox)
+            self.assertEqual([None], mailboxes, "mailbox not deleted")
+            client.logout()
+        finally:
+            sess1.close(True)
+            sess2.close(True)
+    
     def testSimpleCommunication(self):
         tosend = b"Some data"
         self.assertFalse(self.sess2.checkIfDataAvailable(), "data available??")
@@ -69,6 +150,348 @@ class TestFullImap(abstract_comm_test.AbstractCommTest):
         #cleaning()
     
 
+class TestFullImapShared(abstract_comm_test.AbstractCommTest):
+    def setUp(self):
+        super().setUp()
+        self.server = Imap4CommServer("localhost-server", imapFactory, share=True)
+        self.client = Imap4CommClient("localhost-client", imapFactory, share=True, connections=2)
+
+
+class TestFullImapIdle(abstract_comm_test.AbstractCommTest):
+    def setUp(self):
+        super().setUp()
+        self.server = Imap4CommServer("localhost-server", imapFactory, share=True, idle=True)
+        self.client = Imap4CommClient("localhost-client", imapFactory, share=True, idle=True)
+
+
+class TestFullImapBinary(abstract_comm_test.AbstractCommTest):
+    def setUp(self):
+        super().setUp()
+        self.server = Imap4CommServer("localhost-server", imapFactory, share=True, binary=True, packChunks=4)
+        self.client = Imap4CommClient("localhost-client", imapFactory, share=True, binary=True, packChunks=4)
+
+
+class TestFullImapOwnMailbox(abstract_comm_test.AbstractCommTest):
+    def setUp(self):
+        super().setUp()
+        self.server = Imap4CommServer("localhost-server", imapFactory, share=True, ownMailbox=True)
+        self.client = Imap4CommClient("localhost-client", imapFactory, share=True, ownMailbox=True)
+
+
+class TestFullImapPrewarm(abstract_comm_test.AbstractCommTest):
+    def setUp(self):
+        super().setUp()
+        self.server = Imap4CommServer("localhost-server", imapFactory, prewarm=2)
+        self.client = Imap4CommClient("localhost-client", imapFactory, prewarm=2)
+
+
+class StandIn:
+    '''Starts a fresh in-process IMAP server for each test, no mail server or credentials needed'''
+    latency = 0.
+    
+    def startStandIn(self):
+        self.standin = ImapStandInServer(latency=self.latency)
+        self.standin.start()
+    
+    def stopStandIn(self):
+        self.standin.stop()
+    
+    def imapFactory(self):
+        return createImapClient('127.0.0.1', self.standin.port, ssl=False, credmanager=MyCredManager(CREDFILE), folder='testcomm')
+
+
+class TestStandInImapComm(StandIn, TestImapComm):
+    def setUp(self):
+        self.startStandIn()
+        super().setUp()
+    
+    def tearDown(self):
+        super().tearDown()
+        self.stopStandIn()
+    
+    def testNoSearchWhenNothingArrived(self):
+        self.sess2.checkIfDataAvailable()
+        self.standin.resetCounts()
+        for _ in range(5):
+            self.sess2.dispatcher.poll(force=True)
+        # the mailbox is selected: no STATUS on it, the NOOP tells nothing changed
+        self.assertEqual(5, self.standin.commandCounts['NOOP'])
+        self.assertEqual(0, self.standin.commandCounts['UID SEARCH'])
+        self.assertEqual(0, self.standin.commandCounts['STATUS'])
+    
+    def testSearchWhenArrived(self):
+        dispatcher = self.sess2.dispatcher
+        dispatcher.poll(force=True)
+        self.sess1.send(b"Some data")
+        self.standin.resetCounts()
+        dispatcher.poll(force=True)
+        # EXISTS in the answer of the NOOP
+        self.assertEqual(1, self.standin.commandCounts['UID SEARCH'])
+        self.assertIsNotNone(dispatcher.find(self.sess2.nextSubjectToReceive, poll=False))
+        dispatcher.poll(force=True)
+        self.assertEqual(1, self.standin.commandCounts['UID SEARCH'])
+        self.assertEqual(b"Some data", self.sess2.receiveChunk())
+    
+    def testStatusWhenNotSelected(self):
+        dispatcher = self.sess2.dispatcher
+        dispatcher.poll(force=True)
+        with dispatcher.connection(select=False) as client:
+            client.select('INBOX')
+            client.selectedMailbox = 'INBOX'
+        self.standin.resetCounts()
+        dispatcher.poll(force=True)
+        # another mailbox selected on the connection: STATUS is reliable
+        self.assertEqual(1, self.standin.commandCounts['STATUS'])
+        self.assertEqual(0, self.standin.commandCounts['NOOP'])
+    
+    def testCommandsPerChunk(self):
+        sess1 = ImapCommSession('1', '2', 96, self.imapFactory(), binary=True, packChunks=4)
+        sess2 = ImapCommSession('2', '1', 96, self.imapFactory(), binary=True, packChunks=4)
+        try:
+            sess1.maxdatalength = 100
+            self.standin.resetCounts()
+            tosend = os.urandom(1600)
+            sess1.send(tosend)
+            received = b''
+            while len(received) < len(tosend):
+                chunk = sess2.receiveChunkWait(10)
+                self.assertTrue(chunk)
+                received += chunk
+            self.assertEqual(tosend, received)
+            # 16 chunks in 4 e-mails, appended with one command (MULTIAPPEND), each fetched once
+            self.assertEqual(1, self.standin.commandCounts['APPEND'])
+            self.assertLessEqual(self.standin.commandCounts['UID FETCH'], 4 + 4)
+        finally:
+            sess1.close(True)
+            sess2.close(True)
+    
+    def testBatches(self):
+        sess1 = ImapCommSession('1', '2', 95, self.imapFactory())
+        sess2 = ImapCommSession('2', '1', 95, self.imapFactory())
+        try:
+            sess1.maxdatalength = 100
+            self.standin.resetCounts()
+            tosend = [os.urandom(100), os.urandom(150), b'last']
+            sess1.sendMany(tosend)
+            self.assertEqual(4, sess1.sent)
+            self.assertEqual(1, self.standin.commandCounts['APPEND'])
+            self.assertTrue(sess2.checkIfDataAvailable())
+            self.standin.resetCounts()
+            # all the e-mails indexed, fetched with one command
+            self.assertEqual(b''.join(tosend), b''.join(sess2.receiveAvailable()))
+            self.assertEqual(1, self.standin.commandCounts['UID FETCH'])
+            self.assertEqual(4, sess2.received)
+            sess1.close()
+            self.assertIsNone(sess2.receiveAvailable())
+            self.assertTrue(sess2.peerClosed)
+        finally:
+            sess1.close(True)
+            sess2.close(True)
+    
+    def testParallelAppends(self):
+        self.standin.capabilities.remove('MULTIAPPEND')
+        dispatcher = ImapDispatcher('1', self.imapFactory, connections=3, pollInterval=0)
+        sess1 = ImapCommSession('1', '2', 94, None, dispatcher=dispatcher)
+        sess2 = ImapCommSession('2', '1', 94, self.imapFactory())
+        try:
+            sess1.maxdatalength = 100
+            self.standin.resetCounts()
+            tosend = os.urandom(1000)
+            sess1.send(tosend)
+            # one e-mail per chunk, on the 3 connections
+            self.assertEqual(10, self.standin.commandCounts['APPEND'])
+            self.assertEqual(10, sess1.sent)
+            self.assertEqual(3, sess1.sendWorkers)
+            received = b''
+            while len(received) < len(tosend):
+                chunk = sess2.receiveChunkWait(10)
+                self.assertTrue(chunk)
+                received += chunk
+            self.assertEqual(tosend, received)
+            # chunk 12 not appended: the e-mails after it are deleted, not sent with the next send
+            sess1.sendRetries = 0
+            appendMail = sess1.appendMail
+            def failing(maildata, binary=False, record=True):
+                if b'-Message-12th' in maildata:
+                    sess1.appendMail = appendMail
+                    raise ValueError("NO [OVERQUOTA]")
+                return appendMail(maildata, binary, record)
+            sess1.appendMail = failing
+            tosend = os.urandom(500)
+            self.standin.resetCounts()
+            self.assertRaises(ValueError, sess1.send, tosend)
+            self.assertEqual(4, self.standin.commandCounts['APPEND'])
+            self.assertEqual(12, sess1.sent)
+            self.assertEqual(dict(), sess1.stagedUids)
+            sess1.send(b'end')
+            self.assertEqual(4 + 1, self.standin.commandCounts['APPEND'])
+            self.assertEqual(13, sess1.sent)
+            received = b''
+            while len(received) < 200 + 3:
+                chunk = sess2.receiveChunkWait(10)
+                self.assertTrue(chunk)
+                received += chunk
+            self.assertEqual(tosend[:200] + b'end', received)
+            self.assertFalse(sess2.checkIfDataAvailable(), "data available??")
+        finally:
+            sess1.close(True)
+            sess2.close(True)
+            dispatcher.close()
+
+
+class TestStandInImapLatency(TestStandInImapComm):
+    latency = 0.005
+
+
+class TestStandInImapDiscovery(StandIn, unittest.TestCase):
+    def setUp(self):
+        self.startStandIn()
+        self.servers = [Imap4CommServer("server%d" % i, self.imapFactory) for i in range(3)]
+        for server in self.servers:
+            server.registerCapability(EchoActionServer())
+            server.showCapabilities()
+        self.client = Imap4CommClient("client", self.imapFactory)
+    
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        self.client.pool.close()
+        self.stopStandIn()
+    
+    def testOneFetchForAllServers(self):
+        self.standin.resetCounts()
+        self.assertEqual(["server0", "server1", "server2"], self.client.listServers())
+        for server in self.servers:
+            self.assertEqual(["echo"], self.client.capabilities(server.rid))
+        self.assertEqual(1, self.standin.commandCounts['UID SEARCH'])
+        self.assertEqual(1, self.standin.commandCounts['UID FETCH'])
+    
+    def testNewCapabilityMailFetchedAgain(self):
+        self.client.listServers()
+        self.servers[1].registerCapability(StoreAllActionServer())
+        self.servers[1].showCapabilities()
+        # still in cache
+        self.assertEqual(["echo"], self.client.capabilities("server1"))
+        self.standin.resetCounts()
+        self.assertEqual({"echo", "dummy"}, self.client.knownServers(force=True)["server1"])
+        self.assertEqual(1, self.standin.commandCounts['UID FETCH'])
+        self.assertEqual([], self.client.capabilities("nobody"))
+
+
+class TestStandInImapPool(StandIn, unittest.TestCase):
+    def setUp(self):
+        self.startStandIn()
+        self.pool = None
+    
+    def tearDown(self):
+        if self.pool is not None:
+            self.pool.close()
+        self.stopStandIn()
+    
+    def waitFor(self, condition, timeout=5):
+        end = time.time() + timeout
+        while time.time() < end:
+            if condition():
+                return True
+            time.sleep(0.01)
+        return False
+    
+    def testNoopAfterHealthTTL(self):
+        self.pool = ImapConnectionPool(self.imapFactory, size=1, healthTTL=0.3)
+        with self.pool.connection():
+            pass
+        self.pool.client()
+        self.standin.resetCounts()
+        # used less than healthTTL ago: not checked
+        with self.pool.connection() as client:
+            client.noop()
+        self.pool.client()
+        self.assertEqual(1, self.standin.commandCounts['NOOP'])
+        time.sleep(0.4)
+        # checked once each
+        with self.pool.connection():
+            pass
+        self.pool.client()
+        self.assertEqual(3, self.standin.commandCounts['NOOP'])
+        self.assertEqual(2, self.pool.noopCount)
+        self.assertEqual(0, self.standin.commandCounts['LOGIN'])
+    
+    @mock.patch('remoteconanywhere.imap.RETIRE_GRACE', 0.3)
+    def testRenewalOverlapped(self):
+        self.pool = ImapConnectionPool(self.imapFactory)
+        old = self.pool.client()
+        old.startingtime -= 2 * 3600
+        self.standin.resetCounts()
+        self.assertIs(old, self.pool.client())
+        self.assertTrue(self.waitFor(lambda: self.pool.renewCount == 1))
+        new = self.pool.client()
+        self.assertIsNot(old, new)
+        # the old one still usable by the threads that have it
+        self.assertEqual('OK', old.noop()[0])
+        self.assertTrue(self.waitFor(lambda: self.standin.commandCounts['LOGOUT'] == 1))
+        log = self.standin.commandLog
+        self.assertLess(log.index('LOGIN'), log.index('LOGOUT'))
+        self.assertLess(log.index('NOOP'), log.index('LOGOUT'))
+        self.assertEqual(1, self.standin.commandCounts['LOGIN'])
+        self.assertEqual('OK', new.noop()[0])
+    
+    def testPrewarmedTake(self):
+        self.pool = ImapConnectionPool(self.imapFactory, prewarm=2)
+        self.assertTrue(self.waitFor(lambda: len(self.pool.spares) == 2))
+        self.standin.resetCounts()
+        client = self.pool.take()
+        try:
+            # ready: no login, not checked
+            self.assertEqual(0, self.standin.commandCounts['LOGIN'])
+            self.assertEqual(0, self.standin.commandCounts['NOOP'])
+            self.assertEqual('OK', client.noop()[0])
+            self.assertEqual('testcomm', client.selectedMailbox)
+            # replaced in the background
+            self.assertTrue(self.waitFor(lambda: len(self.pool.spares) == 2))
+            self.assertEqual(1, self.standin.commandCounts['LOGIN'])
+        finally:
+            ImapConnectionPool.shutdown(client)
+
+
+class StandInCommTest(StandIn, abstract_comm_test.AbstractCommTest):
+    skipped = True
+    options = {}
+    
+    def setUp(self):
+        super().setUp()
+        self.startStandIn()
+        self.server = Imap4CommServer("localhost-server", self.imapFactory, **self.options)
+        self.client = Imap4CommClient("localhost-client", self.imapFactory, **self.options)
+    
+    def tearDown(self):
+        super().tearDown()
+        self.stopStandIn()
+
+
+class TestFullStandInImap(StandInCommTest):
+    skipped = False
+
+
+class TestFullStandInImapIdle(StandInCommTest):
+    skipped = False
+    options = dict(share=True, idle=True)
+
+
+class TestFullStandInImapBinary(StandInCommTest):
+    skipped = False
+    options = dict(share=True, binary=True, packChunks=4)
+
+
+class TestFullStandInImapOwnMailbox(StandInCommTest):
+    skipped = False
+    options = dict(share=True, ownMailbox=True)
+
+
+class TestFullStandInImapPrewarm(StandInCommTest):
+    skipped = False
+    options = dict(prewarm=2)
+
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file